@@ -0,0 +1,526 @@
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+import argparse
+import contextlib
+import hashlib
+import http.client
+import json
+import os
+import queue
+import re
+import threading
+import time
+
+from decoding import JsonSchema, truncate_after_json_object
+from utils.metrics import REGISTRY
+from utils.profiling import GenerationStats
+from utils.response_cache import ResponseCache, make_cache_key
+
+# Backend names accepted by the `backend` key of an agent entry
+BACKENDS = ('hf', 'openai', 'fake')
+
+# Errors of a pooled keep-alive connection the server had already closed: the
+# request was never processed, so it is safe to send again on a new connection
+_STALE_CONNECTION_ERRORS = (ConnectionResetError, BrokenPipeError, http.client.RemoteDisconnected)
+
+GENERATION_SECONDS = REGISTRY.histogram(
+    "debias_generation_seconds", "Latency of batched generation calls, per model"
+)
+GENERATIONS = REGISTRY.counter("debias_generations_total", "Generated responses, per model")
+RESPONSE_CACHE_HITS = REGISTRY.counter("debias_response_cache_hits_total", "Responses served from the response cache, per model")
+
+
+class GenerationBackend:
+    """
+    Interface between agents and whatever produces their generations.
+
+    Subclasses implement `_generate_batch`; the base class adds the response cache
+    shared by every backend. Backends whose calls must not overlap (an in-process
+    model owning its device) set `serialize = True`.
+    """
+    backend_name = "base"
+    serialize = False
+
+    def __init__(self, model_name: str, response_cache: Optional[ResponseCache] = None):
+        self.model_name = model_name
+        # Persistent store of greedy generations, consulted before running the backend
+        self.response_cache = response_cache
+        self._lock = threading.Lock()
+
+    @property
+    def cache_name(self) -> str:
+        """Model identity in response cache keys"""
+        return f"{self.backend_name}:{self.model_name}"
+
+    def generate(
+        self,
+        messages: List[Dict[str, str]],
+        max_new_tokens: int = 64,
+        temperature: float = 0.0,
+        json_schema: Optional[JsonSchema] = None,
+        stop_at_json_end: bool = False
+    ) -> str:
+        json_schemas = [json_schema] if json_schema is not None else None
+        return self.generate_batch([messages], max_new_tokens, temperature, json_schemas, stop_at_json_end)[0]
+
+    def generate_batch(
+        self,
+        batch_messages: List[List[Dict[str, str]]],
+        max_new_tokens: int = 64,
+        temperature: float = 0.0,
+        json_schemas: Optional[List[JsonSchema]] = None,
+        stop_at_json_end: bool = False,
+        stats: Optional[GenerationStats] = None
+    ) -> List[str]:
+        """
+        Generate one response per chat.
+
+        If `json_schemas` is given (one per chat), each reply is constrained to a JSON
+        object of that shape. With `stop_at_json_end`, replies end as soon as their
+        first top-level JSON object is complete instead of running to `max_new_tokens`.
+        `stats`, sized to the batch, receives token counts, cache hits and timings.
+        """
+        if not batch_messages:
+            return []
+
+        # Sampled generations are not reproducible, so only greedy ones are cached
+        if self.response_cache is None or temperature > 0.0:
+            return self._run_rows(
+                list(range(len(batch_messages))), batch_messages, max_new_tokens, temperature, json_schemas, stop_at_json_end, stats
+            )
+
+        keys = [
+            make_cache_key(
+                self.cache_name,
+                messages,
+                max_new_tokens=max_new_tokens,
+                temperature=temperature,
+                json_schema=[list(json_schemas[i].analysis_keys), json_schemas[i].output_key] if json_schemas else None,
+                stop_at_json_end=stop_at_json_end
+            )
+            for i, messages in enumerate(batch_messages)
+        ]
+        responses = [self.response_cache.get(key) for key in keys]
+        misses = [i for i, response in enumerate(responses) if response is None]
+        if len(misses) < len(responses):
+            RESPONSE_CACHE_HITS.inc(len(responses) - len(misses), model=self.model_name)
+        if stats is not None:
+            for i, response in enumerate(responses):
+                stats.cached[i] = response is not None
+        if misses:
+            generated = self._run_rows(
+                misses, batch_messages, max_new_tokens, temperature, json_schemas, stop_at_json_end, stats
+            )
+            for i, response in zip(misses, generated):
+                self.response_cache.put(keys[i], response)
+                responses[i] = response
+        return responses
+
+    def _run_rows(
+        self,
+        rows: List[int],
+        batch_messages: List[List[Dict[str, str]]],
+        max_new_tokens: int,
+        temperature: float,
+        json_schemas: Optional[List[JsonSchema]],
+        stop_at_json_end: bool,
+        stats: Optional[GenerationStats]
+    ) -> List[str]:
+        """Generate the chats at `rows` of the batch, recording their stats at those rows"""
+        row_stats = GenerationStats.for_rows(len(rows)) if stats is not None else None
+        with self._lock if self.serialize else contextlib.nullcontext():
+            start = time.perf_counter()
+            generated = self._generate_batch(
+                [batch_messages[i] for i in rows],
+                max_new_tokens,
+                temperature,
+                [json_schemas[i] for i in rows] if json_schemas else None,
+                stop_at_json_end,
+                row_stats
+            )
+            GENERATION_SECONDS.observe(time.perf_counter() - start, model=self.model_name)
+        GENERATIONS.inc(len(rows), model=self.model_name)
+        if stats is not None:
+            stats.scatter(rows, row_stats)
+        return generated
+
+    def _generate_batch(
+        self,
+        batch_messages: List[List[Dict[str, str]]],
+        max_new_tokens: int,
+        temperature: float,
+        json_schemas: Optional[List[JsonSchema]] = None,
+        stop_at_json_end: bool = False,
+        stats: Optional[GenerationStats] = None
+    ) -> List[str]:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        """Release connections or memory held by the backend"""
+
+
+class OpenAIBackend(GenerationBackend):
+    """
+    Client of an OpenAI-compatible chat completions server (vLLM, TGI, llama.cpp server).
+
+    A batch is sent as concurrent requests over a pool of at most `max_connections`
+    keep-alive connections, letting the server batch them. JSON schemas are passed
+    as `response_format`; stopping at the end of the JSON object is applied to the
+    returned text.
+    """
+    backend_name = "openai"
+
+    def __init__(
+        self,
+        model_name: str,
+        base_url: str,
+        api_key: Optional[str] = None,
+        response_cache: Optional[ResponseCache] = None,
+        max_connections: int = 8,
+        timeout: float = 600.0
+    ):
+        super().__init__(model_name, response_cache)
+        url = urlsplit(base_url)
+        if url.scheme not in ('http', 'https'):
+            raise ValueError(f"Unsupported base_url: {base_url}")
+        self.base_url = base_url
+        self.api_key = api_key
+        self.timeout = timeout
+        self._scheme = url.scheme
+        self._netloc = url.netloc
+        self._path = url.path.rstrip('/')
+        self._connections: "queue.LifoQueue[http.client.HTTPConnection]" = queue.LifoQueue()
+        self._executor = ThreadPoolExecutor(max_workers=max_connections, thread_name_prefix=f"http-{model_name}")
+
+    @property
+    def cache_name(self) -> str:
+        return f"{self.backend_name}:{self.base_url}:{self.model_name}"
+
+    def _connect(self) -> http.client.HTTPConnection:
+        try:
+            return self._connections.get_nowait()
+        except queue.Empty:
+            connection_class = http.client.HTTPSConnection if self._scheme == 'https' else http.client.HTTPConnection
+            return connection_class(self._netloc, timeout=self.timeout)
+
+    def _post(self, path: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+        body = json.dumps(payload).encode('utf-8')
+        headers = {"Content-Type": "application/json"}
+        if self.api_key:
+            headers["Authorization"] = f"Bearer {self.api_key}"
+
+        for attempt in range(2):
+            connection = self._connect()
+            reused = connection.sock is not None
+            try:
+                connection.request("POST", self._path + path, body=body, headers=headers)
+                response = connection.getresponse()
+                data = response.read()
+            except (http.client.HTTPException, OSError) as e:
+                connection.close()
+                # Retry only when the request cannot have reached the server: a refused
+                # connection, or a pooled one dropped while idle. Timeouts and other
+                # failures are not retried, as the server may still be generating
+                retryable = isinstance(e, ConnectionRefusedError) or (reused and isinstance(e, _STALE_CONNECTION_ERRORS))
+                if attempt == 1 or not retryable:
+                    raise
+                continue
+            self._connections.put(connection)
+            if response.status != 200:
+                raise RuntimeError(
+                    f"{self.base_url} returned HTTP {response.status}: {data[:500].decode('utf-8', 'replace')}"
+                )
+            return json.loads(data)
+
+    def _complete(
+        self,
+        messages: List[Dict[str, str]],
+        max_new_tokens: int,
+        temperature: float,
+        json_schema: Optional[JsonSchema],
+        stop_at_json_end: bool
+    ) -> Tuple[str, Dict[str, int]]:
+        """Reply text and the server's token usage"""
+        payload = {
+            "model": self.model_name,
+            "messages": messages,
+            "max_tokens": max_new_tokens,
+            "temperature": temperature,
+        }
+        if json_schema is not None:
+            payload["response_format"] = {
+                "type": "json_schema",
+                "json_schema": {"name": "agent_reply", "schema": json_schema.json_schema(), "strict": True},
+            }
+        data = self._post("/chat/completions", payload)
+        content = data["choices"][0]["message"]["content"] or ""
+        return truncate_after_json_object(content) if stop_at_json_end else content, data.get("usage") or {}
+
+    def _generate_batch(
+        self,
+        batch_messages: List[List[Dict[str, str]]],
+        max_new_tokens: int,
+        temperature: float,
+        json_schemas: Optional[List[JsonSchema]] = None,
+        stop_at_json_end: bool = False,
+        stats: Optional[GenerationStats] = None
+    ) -> List[str]:
+        schemas = json_schemas or [None] * len(batch_messages)
+        start = time.perf_counter()
+        completions = list(self._executor.map(
+            lambda args: self._complete(args[0], max_new_tokens, temperature, args[1], stop_at_json_end),
+            zip(batch_messages, schemas)
+        ))
+        if stats is not None:
+            stats.decode_seconds += time.perf_counter() - start
+            for i, (_, usage) in enumerate(completions):
+                stats.prompt_tokens[i] = usage.get("prompt_tokens", 0)
+                stats.generated_tokens[i] = usage.get("completion_tokens", 0)
+        return [content for content, _ in completions]
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=True)
+        while not self._connections.empty():
+            self._connections.get_nowait().close()
+
+
+_REVISION_MARKER = re.compile(r" \(revision (\d+)\)$")
+
+
+class FakeBackend(GenerationBackend):
+    """
+    Deterministic stand-in that answers every prompt with well-formed JSON, for tests
+    and for benchmarking the orchestration on CPU.
+
+    The reply shape (analysis keys, "response" or "recommendations") is read from the
+    system prompt. Rewrites echo the text under review, so queries converge after one
+    round, unless `revisions` is set: each rewrite then bumps a "(revision k)" marker
+    at the end of the text until it reaches `revisions`, so a query changes (slightly,
+    by one word) for that many rewrites before it stabilizes. A harm type is flagged
+    when a hash of (key, text) falls below `flag_rate`. `latency` seconds per call
+    and `token_latency` seconds per generated word simulate inference cost.
+    """
+    backend_name = "fake"
+
+    def __init__(
+        self,
+        model_name: str = "fake",
+        response_cache: Optional[ResponseCache] = None,
+        flag_rate: float = 0.0,
+        latency: float = 0.0,
+        token_latency: float = 0.0,
+        revisions: int = 0
+    ):
+        super().__init__(model_name, response_cache)
+        self.flag_rate = flag_rate
+        self.revisions = revisions
+        self.latency = latency
+        self.token_latency = token_latency
+        self.calls = 0
+        self.generated_tokens = 0
+
+    @staticmethod
+    def _subject(messages: List[Dict[str, str]]) -> str:
+        """Text under review: the first "...RESPONSE:" block of the chat"""
+        for message in messages:
+            match = re.search(r"RESPONSE:\n(.*?)(?:\n\nReturn your findings|\Z)", message["content"], re.DOTALL)
+            if match:
+                return match.group(1).strip()
+        return messages[-1]["content"] if messages else ""
+
+    def _flagged(self, key: str, text: str) -> bool:
+        digest = hashlib.sha256(f"{key}\0{text}".encode('utf-8')).digest()
+        return int.from_bytes(digest[:8], 'big') / 2 ** 64 < self.flag_rate
+
+    def _revise(self, text: str) -> str:
+        match = _REVISION_MARKER.search(text)
+        revision = int(match.group(1)) if match else 0
+        if revision >= self.revisions:
+            return text
+        base = text[:match.start()] if match else text
+        return f"{base} (revision {revision + 1})"
+
+    def reply(self, messages: List[Dict[str, str]]) -> str:
+        system = messages[0]["content"] if messages and messages[0]["role"] == "system" else ""
+        keys = re.findall(r'"([A-Z_]+)": "<explanation or \'none\'>"', system)
+        text = self._subject(messages)
+
+        analysis = {
+            key: f"Possible {key.lower()} issue." if self._flagged(key, text) else "none"
+            for key in keys
+        }
+        if '"recommendations"' in system:
+            recommendations = [f"Address the {key.lower()} issue." for key, value in analysis.items() if value != "none"]
+            return json.dumps({"analysis": analysis, "recommendations": recommendations})
+        return json.dumps({"analysis": analysis, "response": self._revise(text)})
+
+    def _generate_batch(
+        self,
+        batch_messages: List[List[Dict[str, str]]],
+        max_new_tokens: int,
+        temperature: float,
+        json_schemas: Optional[List[JsonSchema]] = None,
+        stop_at_json_end: bool = False,
+        stats: Optional[GenerationStats] = None
+    ) -> List[str]:
+        replies = [self.reply(messages) for messages in batch_messages]
+        tokens = sum(len(reply.split()) for reply in replies)
+        if self.latency or self.token_latency:
+            # A batched call costs one latency plus its longest reply, like a real batch
+            time.sleep(self.latency + self.token_latency * max(len(reply.split()) for reply in replies))
+        if stats is not None:
+            # Words stand in for tokens; `latency` plays the prefill and `token_latency` the decode
+            for i, (messages, reply) in enumerate(zip(batch_messages, replies)):
+                stats.prompt_tokens[i] = sum(len(message["content"].split()) for message in messages)
+                stats.generated_tokens[i] = len(reply.split())
+            stats.prefill_seconds += self.latency
+            stats.decode_seconds += self.token_latency * max(len(reply.split()) for reply in replies)
+        with self._lock:
+            self.calls += 1
+            self.generated_tokens += tokens
+        return replies
+
+
+class FakeOpenAIServer:
+    """
+    Local OpenAI-compatible chat completions server answering with a FakeBackend,
+    so OpenAIBackend and the orchestration can be exercised without a GPU.
+
+    Usable as a context manager; `base_url` points at the running server.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, **fake_options):
+        backend = FakeBackend(**fake_options)
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                request = json.loads(self.rfile.read(length) or b"{}")
+                if not self.path.endswith("/chat/completions"):
+                    self._send(404, {"error": {"message": f"Unknown path {self.path}"}})
+                    return
+                stats = GenerationStats.for_rows(1)
+                content = backend.generate_batch([request.get("messages", [])], stats=stats)[0]
+                self._send(200, {
+                    "object": "chat.completion",
+                    "model": request.get("model", backend.model_name),
+                    "choices": [{
+                        "index": 0,
+                        "message": {"role": "assistant", "content": content},
+                        "finish_reason": "stop",
+                    }],
+                    "usage": {
+                        "prompt_tokens": stats.prompt_tokens[0],
+                        "completion_tokens": stats.generated_tokens[0],
+                        "total_tokens": stats.prompt_tokens[0] + stats.generated_tokens[0],
+                    },
+                })
+
+            def _send(self, status: int, payload: Dict[str, Any]) -> None:
+                body = json.dumps(payload).encode('utf-8')
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.backend = backend
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self) -> "FakeOpenAIServer":
+        self._thread = threading.Thread(target=self.server.serve_forever, name="fake-openai-server", daemon=True)
+        self._thread.start()
+        return self
+
+    def close(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self) -> "FakeOpenAIServer":
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+def create_backend(
+    model_name: str,
+    backend: str = "hf",
+    response_cache: Optional[ResponseCache] = None,
+    base_url: Optional[str] = None,
+    api_key_env: Optional[str] = None,
+    max_connections: int = 8,
+    **options
+) -> GenerationBackend:
+    """
+    Build the backend of one agent entry.
+
+    Args:
+        backend: 'hf' (in-process transformers model, configured by `options`, e.g.
+                 `prefix_cache_bytes` or `compile_mode`), 'openai' (HTTP server at
+                 `base_url`, key read from the `api_key_env` environment variable,
+                 requests cut off after the `timeout` option, in seconds) or 'fake'
+                 (FakeBackend, configured by `options`)
+
+    Raises:
+        ValueError: For an unknown backend, or options the 'openai' backend does not take
+    """
+    if backend == "hf":
+        from models import LLMModel
+        return LLMModel(model_name, response_cache=response_cache, **options)
+    if backend == "openai":
+        if not base_url:
+            raise ValueError(f"Backend 'openai' of {model_name} requires a base_url")
+        timeout = options.pop("timeout", 600.0)
+        if options:
+            raise ValueError(
+                f"Unknown options of backend 'openai' of {model_name}: {', '.join(sorted(options))} "
+                "(expected base_url, api_key_env, max_connections, timeout)"
+            )
+        api_key = os.environ.get(api_key_env) if api_key_env else None
+        return OpenAIBackend(
+            model_name, base_url, api_key, response_cache, max_connections=max_connections, timeout=timeout
+        )
+    if backend == "fake":
+        return FakeBackend(model_name, response_cache, **options)
+    raise ValueError(f"Unknown backend: {backend} (expected one of {', '.join(BACKENDS)})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Serve FakeBackend replies over an OpenAI-compatible API')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--flag-rate', type=float, default=0.0,
+                       help='Fraction of harm types reported as issues')
+    parser.add_argument('--latency', type=float, default=0.0,
+                       help='Simulated seconds per request')
+    parser.add_argument('--token-latency', type=float, default=0.0,
+                       help='Simulated seconds per generated word')
+    args = parser.parse_args()
+
+    server = FakeOpenAIServer(
+        args.host,
+        args.port,
+        flag_rate=args.flag_rate,
+        latency=args.latency,
+        token_latency=args.token_latency
+    )
+    print(f"Serving fake completions at {server.base_url}")
+    try:
+        server.server.serve_forever()
+    except KeyboardInterrupt:
+        server.close()
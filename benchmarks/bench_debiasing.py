@@ -0,0 +1,254 @@
+"""
+End-to-end throughput benchmark of MultiLLMDebiasing.
+
+Runs each strategy over a synthetic query set, by default on the deterministic fake
+backend so only the orchestration (reducers, prompt building, batching, parsing) is
+measured. Its rewrites keep changing the text for `--revisions` rounds, so the
+multi-round, convergence and incremental paths run as they would on real models.
+`--model` runs every agent on a small local checkpoint instead. Each case
+runs in a fresh process so its peak RSS is its own.
+
+    python benchmarks/bench_debiasing.py --queries 200 --output benchmarks/results/baseline.json
+"""
+from collections import Counter
+from pathlib import Path
+from typing import Any, Dict, List
+import argparse
+import json
+import logging
+import multiprocessing
+import platform
+import random
+import resource
+import subprocess
+import sys
+import time
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_ROOT))
+
+STRATEGIES = ('centralized', 'decentralized')
+
+_GROUPS = [
+    "women", "men", "immigrants", "older workers", "teenagers", "disabled people",
+    "rural families", "non-native speakers", "single parents", "religious minorities",
+]
+_CLAIMS = [
+    "are naturally worse at negotiating salaries",
+    "should not be trusted with leadership roles",
+    "tend to need extra supervision at work",
+    "are the main reason the neighborhood changed",
+    "rarely understand modern technology",
+    "usually prefer jobs that require less responsibility",
+]
+_FILLER = [
+    "According to a colleague, this has always been the case.",
+    "Most people I talked to agreed with this view.",
+    "The hiring committee took this into account last year.",
+    "It is common sense, so there is no need for statistics.",
+    "This explains the results of the latest internal survey.",
+]
+
+
+def synthetic_queries(num_queries: int, seed: int = 0, max_sentences: int = 6) -> List[str]:
+    """Deterministic biased-sounding statements of varying length"""
+    rng = random.Random(seed)
+    queries = []
+    for _ in range(num_queries):
+        sentences = [f"{rng.choice(_GROUPS).capitalize()} {rng.choice(_CLAIMS)}."]
+        sentences.extend(rng.choice(_FILLER) for _ in range(rng.randint(0, max_sentences - 1)))
+        queries.append(" ".join(sentences))
+    return queries
+
+
+def synthetic_assignments(strategy: str, num_agents: int) -> Dict[str, List[str]]:
+    """Harm types dealt round-robin to `num_agents` agents, plus a leader when centralized"""
+    from prompts import HARM_DESCRIPTIONS
+
+    agents = {f"agent_{i}": [] for i in range(num_agents)}
+    for i, harm_type in enumerate(HARM_DESCRIPTIONS):
+        agents[f"agent_{i % num_agents}"].append(harm_type)
+    if strategy == 'centralized':
+        return {"leader": [], **agents}
+    return agents
+
+
+def _count_generations(backend, counters: Dict[str, int]) -> None:
+    """Count the prompts and generated tokens of every call to `backend`"""
+    generate_batch = backend.generate_batch
+
+    def counted(batch_messages, *args, **kwargs):
+        outputs = generate_batch(batch_messages, *args, **kwargs)
+        tokenizer = getattr(backend, 'tokenizer', None)
+        counters['generations'] += len(outputs)
+        counters['tokens'] += sum(
+            len(tokenizer(text, add_special_tokens=False)['input_ids']) if tokenizer is not None else len(text.split())
+            for text in outputs
+        )
+        return outputs
+
+    backend.generate_batch = counted
+
+
+def _peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def run_case(strategy: str, params: Dict[str, Any]) -> Dict[str, Any]:
+    """Debias the synthetic query set with one strategy and measure it"""
+    import main
+    main.logger.setLevel(logging.WARNING)
+
+    harm_assignments = synthetic_assignments(strategy, params['agents'])
+    if params['model']:
+        agent_models = {name: params['model'] for name in harm_assignments}
+        agent_backends = {}
+    else:
+        agent_models = {}
+        fake_options = {
+            'backend': 'fake',
+            'flag_rate': params['flag_rate'],
+            'latency': params['latency'],
+            'token_latency': params['token_latency'],
+            'revisions': params['revisions'],
+        }
+        agent_backends = {name: fake_options for name in harm_assignments}
+
+    config = {
+        'max_rounds': params['max_rounds'],
+        'max_new_tokens': params['max_new_tokens'],
+        'temperature': 0.0,
+        'feedback_workers': params['feedback_workers'],
+        'prefix_cache_mb': 0,
+        'seed': params['seed'],
+        'convergence': [name.strip() for name in params['convergence'].split(',') if name.strip()],
+        'incremental': params['incremental'],
+        'scheduler': params['scheduler'],
+        'max_inflight': params['max_inflight'],
+        'scheduler_batch_size': params['batch_size'],
+    }
+    queries = synthetic_queries(params['queries'], params['seed'])
+
+    debiaser = main.MultiLLMDebiasing(harm_assignments, config, strategy, agent_models, agent_backends)
+    counters = {'generations': 0, 'tokens': 0}
+    for model in {id(agent.model): agent.model for agent in debiaser.specialized_agents}.values():
+        _count_generations(model, counters)
+
+    rounds = 0
+    errors = 0
+    stop_reasons: Counter = Counter()
+    start = time.perf_counter()
+    try:
+        for _, result in debiaser.iter_debiased_responses(enumerate(queries), batch_size=params['batch_size']):
+            if isinstance(result, Exception):
+                errors += 1
+                continue
+            rounds += result.rounds
+            stop_reasons[result.stop_reason] += 1
+    finally:
+        seconds = time.perf_counter() - start
+        debiaser.close()
+
+    completed = max(len(queries) - errors, 1)
+    return {
+        'strategy': strategy,
+        'backend': 'hf' if params['model'] else 'fake',
+        'queries': len(queries),
+        'errors': errors,
+        'seconds': round(seconds, 4),
+        'queries_per_sec': round(len(queries) / seconds, 3) if seconds else None,
+        'generations_per_query': round(counters['generations'] / len(queries), 3),
+        'rounds_per_query': round(rounds / completed, 3),
+        'generated_tokens': counters['tokens'],
+        'tokens_per_sec': round(counters['tokens'] / seconds, 1) if seconds else None,
+        'peak_rss_mb': round(_peak_rss_mb(), 1),
+        'stop_reasons': dict(stop_reasons),
+    }
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=REPO_ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='End-to-end debiasing throughput benchmark')
+    parser.add_argument('--strategies', type=str, default=','.join(STRATEGIES),
+                       help='Comma-separated strategies to benchmark')
+    parser.add_argument('--queries', type=int, default=200,
+                       help='Number of synthetic queries')
+    parser.add_argument('--agents', type=int, default=3,
+                       help='Number of specialized agents (plus a leader when centralized)')
+    parser.add_argument('--model', type=str, default=None,
+                       help='Local checkpoint used by every agent instead of the fake backend')
+    parser.add_argument('--flag-rate', type=float, default=0.3,
+                       help='Fake backend: probability that a harm type is flagged')
+    parser.add_argument('--latency', type=float, default=0.0,
+                       help='Fake backend: seconds per generation call')
+    parser.add_argument('--token-latency', type=float, default=0.0,
+                       help='Fake backend: seconds per generated word')
+    parser.add_argument('--revisions', type=int, default=2,
+                       help='Fake backend: rewrites that change the text before it stabilizes '
+                            '(0 converges every query in the first round)')
+    parser.add_argument('--convergence', type=str, default='exact',
+                       help='Comma-separated convergence criteria (see main.py)')
+    parser.add_argument('--incremental', action='store_true',
+                       help='Centralized only: skip re-querying followers whose feedback is clean and whose text barely changed')
+    parser.add_argument('--max-rounds', type=int, default=3,
+                       help='Maximum number of refinement rounds')
+    parser.add_argument('--max-new-tokens', type=int, default=64,
+                       help='Maximum number of new tokens per generation')
+    parser.add_argument('--batch-size', type=int, default=16,
+                       help='Queries advanced together (batch scheduler) or prompts per model call (pipeline)')
+    parser.add_argument('--feedback-workers', type=int, default=1,
+                       help='Agents queried concurrently within a round')
+    parser.add_argument('--scheduler', type=str, default='batch', choices=['batch', 'pipeline'],
+                       help='How queries are scheduled (see main.py)')
+    parser.add_argument('--max-inflight', type=int, default=16,
+                       help='Queries in flight with the pipeline scheduler')
+    parser.add_argument('--seed', type=int, default=0,
+                       help='Seed of the synthetic queries and feedback shuffling')
+    parser.add_argument('--output', type=str, default=None,
+                       help='JSON file the results are written to (printed either way)')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    params = vars(args)
+    strategies = [name.strip() for name in args.strategies.split(',') if name.strip()]
+    unknown = [name for name in strategies if name not in STRATEGIES]
+    if unknown:
+        raise SystemExit(f"Unknown strategies: {unknown} (expected any of {', '.join(STRATEGIES)})")
+
+    results = []
+    context = multiprocessing.get_context('spawn')
+    for strategy in strategies:
+        # A fresh process per case, so peak RSS and lazily loaded state do not carry over
+        with context.Pool(1) as pool:
+            results.append(pool.apply(run_case, (strategy, params)))
+
+    report = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'commit': _git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'params': params,
+        'results': results,
+    }
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+        Path(args.output).write_text(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
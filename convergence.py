@@ -0,0 +1,126 @@
+from typing import Callable, Dict, List, Optional, Sequence
+import json
+import re
+
+# Stop reason of queries that used up every round without converging
+MAX_ROUNDS = "max_rounds"
+
+CONVERGENCE_CRITERIA = ("exact", "edit_distance", "jaccard", "followers_clean")
+
+
+def _tokens(text: str) -> List[str]:
+    """Lowercased word tokens, so whitespace and punctuation edits do not count"""
+    return re.findall(r"\w+", text.lower())
+
+
+def edit_distance(text1: str, text2: str, max_distance: Optional[float] = None) -> float:
+    """
+    Word-level Levenshtein distance normalized by the longer text (0.0 identical, 1.0 disjoint).
+
+    With `max_distance` only edits up to that bound are tracked (a band around the
+    diagonal, stopping early once every path exceeds it): distances within the bound
+    are exact, larger ones come back as some value above `max_distance`.
+    """
+    words1, words2 = _tokens(text1), _tokens(text2)
+    longest = max(len(words1), len(words2))
+    if words1 == words2:
+        return 0.0
+    limit = longest if max_distance is None else int(max_distance * longest)
+    if abs(len(words1) - len(words2)) > limit:
+        return abs(len(words1) - len(words2)) / longest
+
+    beyond = limit + 1  # Any count past the bound; cells outside the band hold it
+    previous = [j if j <= limit else beyond for j in range(len(words2) + 1)]
+    for i, word1 in enumerate(words1, start=1):
+        low, high = max(1, i - limit), min(len(words2), i + limit)
+        current = [beyond] * (len(words2) + 1)
+        current[0] = i if i <= limit else beyond
+        for j in range(low, high + 1):
+            current[j] = min(
+                previous[j] + 1,
+                current[j - 1] + 1,
+                previous[j - 1] + (word1 != words2[j - 1])
+            )
+        if min(current[low - 1:high + 1]) > limit:
+            return beyond / longest
+        previous = current
+    return min(previous[-1], beyond) / longest
+
+
+def jaccard_similarity(text1: str, text2: str) -> float:
+    """Word overlap similarity, as `get_text_similarity` in visualization/analysis_plots.py"""
+    words1, words2 = set(_tokens(text1)), set(_tokens(text2))
+    if not words1 and not words2:
+        return 1.0
+    return len(words1 & words2) / len(words1 | words2)
+
+
+def is_clean_feedback(feedback: str) -> bool:
+    """Whether a follower's feedback reports 'none' for every harm type it analyzed"""
+    try:
+        analysis = json.loads(feedback).get("analysis")
+    except (json.JSONDecodeError, AttributeError, TypeError):
+        return False
+    if not isinstance(analysis, dict) or not analysis:
+        return False
+    return all(str(verdict).strip().strip(".'\"").lower() == "none" for verdict in analysis.values())
+
+
+class ConvergenceChecker:
+    """
+    Decides when a query has stopped changing.
+
+    Text criteria compare a response with its previous version:
+        exact: identical strings
+        edit_distance: normalized word-level edit distance <= `edit_distance_threshold`
+        jaccard: word overlap similarity >= `jaccard_threshold`
+
+    The feedback criterion `followers_clean` stops a query as soon as every piece of
+    feedback of a round reports 'none' for all its harm types.
+
+    Criteria are checked in the order given; the first one met is the stop reason.
+    """
+
+    def __init__(
+        self,
+        criteria: Sequence[str] = ("exact",),
+        edit_distance_threshold: float = 0.05,
+        jaccard_threshold: float = 0.95
+    ):
+        unknown = [name for name in criteria if name not in CONVERGENCE_CRITERIA]
+        if unknown:
+            raise ValueError(
+                f"Unknown convergence criteria: {unknown} (expected any of {', '.join(CONVERGENCE_CRITERIA)})"
+            )
+        self.criteria = list(criteria)
+        self.edit_distance_threshold = edit_distance_threshold
+        self.jaccard_threshold = jaccard_threshold
+        self._text_criteria: Dict[str, Callable[[str, str], bool]] = {
+            "exact": lambda previous, current: previous == current,
+            "edit_distance": lambda previous, current: (
+                edit_distance(previous, current, self.edit_distance_threshold) <= self.edit_distance_threshold
+            ),
+            "jaccard": lambda previous, current: jaccard_similarity(previous, current) >= self.jaccard_threshold,
+        }
+
+    @classmethod
+    def from_config(cls, config: Dict) -> "ConvergenceChecker":
+        return cls(
+            config.get('convergence', ("exact",)),
+            edit_distance_threshold=config.get('edit_distance_threshold', 0.05),
+            jaccard_threshold=config.get('jaccard_threshold', 0.95)
+        )
+
+    def texts_converged(self, previous: List[str], current: List[str]) -> Optional[str]:
+        """Name of the first text criterion met by every (previous, current) pair, if any"""
+        for name in self.criteria:
+            criterion = self._text_criteria.get(name)
+            if criterion is not None and all(criterion(p, c) for p, c in zip(previous, current)):
+                return name
+        return None
+
+    def feedback_converged(self, feedback: List[str]) -> Optional[str]:
+        """'followers_clean' if that criterion is enabled and every feedback is clean"""
+        if "followers_clean" in self.criteria and feedback and all(is_clean_feedback(f) for f in feedback):
+            return "followers_clean"
+        return None
@@ -0,0 +1,421 @@
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
+
+# Template holes
+STRING = 0        # JSON string contents up to and including the closing quote
+STRING_ARRAY = 1  # JSON array of strings
+
+# Results of feeding one character to a string hole
+_REJECT, _OPEN, _CLOSED = 0, 1, 2
+
+# Most characters a single token can add to `JsonTemplateMachine.completion` (by
+# starting a unicode escape: the escape letter and 4 hex digits)
+_COMPLETION_GROWTH = 5
+
+_HEX_DIGITS = frozenset('0123456789abcdefABCDEF')
+_ESCAPES = frozenset('"\\/bfnrtu')
+
+
+@dataclass(frozen=True)
+class JsonSchema:
+    """
+    Expected shape of an agent reply: an "analysis" object keyed by harm type,
+    followed by either a "response" string or a "recommendations" string array.
+    """
+    analysis_keys: Tuple[str, ...]
+    output_key: str = "response"
+
+    def template(self) -> List[Union[str, int]]:
+        """Literal segments interleaved with the STRING / STRING_ARRAY holes the model fills in"""
+        pieces: List[Union[str, int]] = []
+        literal = '{"analysis": {'
+        for i, key in enumerate(self.analysis_keys):
+            literal += ('' if i == 0 else ', ') + f'"{key}": "'
+            pieces.extend([literal, STRING])
+            literal = ''
+        literal += f'}}, "{self.output_key}": '
+        if self.output_key == "recommendations":
+            pieces.extend([literal, STRING_ARRAY])
+        else:
+            pieces.extend([literal + '"', STRING])
+        pieces.append('}')
+        return pieces
+
+    def json_schema(self) -> Dict[str, Any]:
+        """Equivalent JSON Schema, for inference servers that enforce `response_format`"""
+        if self.output_key == "recommendations":
+            payload = {"type": "array", "items": {"type": "string"}}
+        else:
+            payload = {"type": "string"}
+        return {
+            "type": "object",
+            "properties": {
+                "analysis": {
+                    "type": "object",
+                    "properties": {key: {"type": "string"} for key in self.analysis_keys},
+                    "required": list(self.analysis_keys),
+                    "additionalProperties": False,
+                },
+                self.output_key: payload,
+            },
+            "required": ["analysis", self.output_key],
+            "additionalProperties": False,
+        }
+
+
+class JsonTemplateMachine:
+    """Character-level recognizer for the output of a JsonSchema template"""
+    __slots__ = ('pieces', 'piece', 'offset', 'mode', 'escape')
+
+    def __init__(self, pieces: Sequence[Union[str, int]]):
+        self.pieces = pieces
+        self.piece = 0    # Index of the current template segment
+        self.offset = 0   # Position inside a literal segment
+        self.mode = 0     # Array sub-state (see _feed_array)
+        self.escape = 0   # 0 normal, -1 after a backslash, n > 0 unicode hex digits left
+
+    def clone(self) -> "JsonTemplateMachine":
+        machine = JsonTemplateMachine.__new__(JsonTemplateMachine)
+        machine.pieces = self.pieces
+        machine.piece = self.piece
+        machine.offset = self.offset
+        machine.mode = self.mode
+        machine.escape = self.escape
+        return machine
+
+    @property
+    def complete(self) -> bool:
+        return self.piece >= len(self.pieces)
+
+    @property
+    def state(self) -> Tuple[int, int, int, int]:
+        """Everything but the template that determines which continuations are valid"""
+        return (self.piece, self.offset, self.mode, self.escape)
+
+    def completion(self) -> str:
+        """Shortest text that completes the template from the current state"""
+        if self.complete:
+            return ''
+        if self.escape == -1:
+            text = 'n'
+        elif self.escape > 0:
+            text = '0' * self.escape
+        else:
+            text = ''
+
+        piece = self.pieces[self.piece]
+        if isinstance(piece, str):
+            text += piece[self.offset:]
+        elif piece == STRING:
+            text += '"'
+        else:
+            # Array modes, see _feed_array
+            text += ('[]', ']', '"]', ']', '""]', '""]')[self.mode]
+        for piece in self.pieces[self.piece + 1:]:
+            text += piece if isinstance(piece, str) else ('"' if piece == STRING else '[]')
+        return text
+
+    def accepts(self, text: str) -> bool:
+        """Whether `text` is a valid continuation, without changing the state"""
+        return bool(text) and self.clone().feed(text)
+
+    def feed(self, text: str) -> bool:
+        """Advance over `text`; returns False (leaving a partial state) if it is invalid"""
+        for char in text:
+            if not self._feed_char(char):
+                return False
+        return True
+
+    def _advance(self) -> None:
+        self.piece += 1
+        self.offset = 0
+        self.mode = 0
+        self.escape = 0
+
+    def _feed_string(self, char: str) -> int:
+        if self.escape == -1:
+            if char not in _ESCAPES:
+                return _REJECT
+            self.escape = 4 if char == 'u' else 0
+        elif self.escape > 0:
+            if char not in _HEX_DIGITS:
+                return _REJECT
+            self.escape -= 1
+        elif char == '\\':
+            self.escape = -1
+        elif char == '"':
+            return _CLOSED
+        elif ord(char) < 0x20:
+            # Raw control characters (e.g. newlines) must be escaped inside JSON strings
+            return _REJECT
+        return _OPEN
+
+    def _feed_char(self, char: str) -> bool:
+        if self.complete:
+            return False
+        piece = self.pieces[self.piece]
+
+        if isinstance(piece, str):
+            if char != piece[self.offset]:
+                return False
+            self.offset += 1
+            if self.offset == len(piece):
+                self._advance()
+            return True
+
+        if piece == STRING:
+            result = self._feed_string(char)
+            if result == _CLOSED:
+                self._advance()
+            return result != _REJECT
+
+        return self._feed_array(char)
+
+    def _feed_array(self, char: str) -> bool:
+        # Modes: 0 expect '[', 1 expect '"' or ']', 2 inside a string,
+        # 3 expect ',' or ']', 4 expect ' ' or '"', 5 expect '"'
+        if self.mode == 2:
+            result = self._feed_string(char)
+            if result == _CLOSED:
+                self.mode = 3
+            return result != _REJECT
+
+        if self.mode == 0 and char == '[':
+            self.mode = 1
+        elif self.mode in (1, 4, 5) and char == '"':
+            self.mode = 2
+        elif self.mode in (1, 3) and char == ']':
+            self._advance()
+        elif self.mode == 3 and char == ',':
+            self.mode = 4
+        elif self.mode == 4 and char == ' ':
+            self.mode = 5
+        else:
+            return False
+        return True
+
+
+class JsonObjectScanner:
+    """
+    Incremental scanner that tracks brace depth and string/escape state to detect
+    when the first top-level JSON object of a text is complete. Text before the
+    first '{' (e.g. a markdown fence) is ignored.
+    """
+    __slots__ = ('depth', 'in_string', 'escape', 'started', 'complete')
+
+    def __init__(self):
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.started = False
+        self.complete = False
+
+    def feed(self, text: str) -> bool:
+        """Consume `text`; returns True once the top-level object has closed"""
+        for char in text:
+            if self.complete:
+                break
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif char == '\\':
+                    self.escape = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                if self.started:
+                    self.in_string = True
+            elif char == '{':
+                self.started = True
+                self.depth += 1
+            elif char == '}' and self.started:
+                self.depth -= 1
+                if self.depth == 0:
+                    self.complete = True
+        return self.complete
+
+
+def truncate_after_json_object(text: str) -> str:
+    """Cut `text` right after its first top-level JSON object closes (unchanged if it never does)"""
+    scanner = JsonObjectScanner()
+    for end, char in enumerate(text, start=1):
+        if scanner.feed(char):
+            return text[:end]
+    return text
+
+
+def build_token_texts(tokenizer) -> List[str]:
+    """
+    Text every vocabulary entry adds when decoded mid-sequence; special tokens map
+    to '' so they are never allowed.
+
+    Tokens are decoded after a fixed prefix token whose text is then stripped:
+    SentencePiece tokenizers (Llama, Mistral) drop the leading space of a token
+    decoded on its own, which would make segments like ", " unreachable.
+    """
+    prefix_ids = tokenizer.encode("a", add_special_tokens=False)[-1:]
+    prefix = tokenizer.decode(prefix_ids, clean_up_tokenization_spaces=False)
+    decoded = tokenizer.batch_decode(
+        [prefix_ids + [token_id] for token_id in range(len(tokenizer))],
+        clean_up_tokenization_spaces=False
+    )
+    token_texts = []
+    for token_id, text in enumerate(decoded):
+        if text.startswith(prefix):
+            token_texts.append(text[len(prefix):])
+        else:
+            # The pair merged into something else on decode; fall back to the bare token
+            token_texts.append(tokenizer.decode([token_id], clean_up_tokenization_spaces=False))
+    for token_id in tokenizer.all_special_ids:
+        token_texts[token_id] = ''
+    return token_texts
+
+
+class AllowedTokenCache:
+    """
+    Ids of every vocabulary token a template state accepts, computed on first use
+    and shared by all the generations of a model.
+
+    Tokens are grouped by their first character, so a state only scans the groups
+    whose first character it accepts (a single group inside literal segments).
+    """
+
+    def __init__(self, token_texts: List[str]):
+        self.token_texts = token_texts
+        self._by_first_char: Dict[str, List[int]] = {}
+        for token_id, text in enumerate(token_texts):
+            if text:
+                self._by_first_char.setdefault(text[0], []).append(token_id)
+        self._allowed: Dict[Tuple[Any, ...], List[int]] = {}
+
+    def prefixes(self, text: str) -> List[int]:
+        """Ids of the tokens whose text is a (non-empty) prefix of `text`"""
+        if not text:
+            return []
+        return [token_id for token_id in self._by_first_char.get(text[0], ()) if text.startswith(self.token_texts[token_id])]
+
+    def allowed(self, machine: JsonTemplateMachine) -> List[int]:
+        key = (tuple(machine.pieces), machine.state)
+        allowed = self._allowed.get(key)
+        if allowed is None:
+            allowed = [
+                token_id
+                for char, token_ids in self._by_first_char.items() if machine.accepts(char)
+                for token_id in token_ids if machine.accepts(self.token_texts[token_id])
+            ]
+            self._allowed[key] = allowed
+        return allowed
+
+
+class JsonSchemaLogitsProcessor:
+    """
+    Logits processor (transformers `LogitsProcessor` protocol) that only lets each
+    row emit tokens continuing its JsonSchema template, then forces EOS as soon as
+    the top-level object closes.
+
+    Candidates are checked in descending score order among the `top_k` best tokens;
+    when none of them fits, the best token of the state's allowed set (see
+    `AllowedTokenCache`) is picked.
+
+    With `max_new_tokens`, a row whose remaining budget gets close to the length of
+    its shortest completion (`JsonTemplateMachine.completion`) may only emit tokens
+    that spell that completion, so the object closes before generation is cut off.
+    Without it a reply that runs out of tokens stays unfinished.
+    """
+
+    def __init__(
+        self,
+        schemas: Sequence[JsonSchema],
+        token_texts: List[str],
+        eos_token_id: int,
+        top_k: int = 64,
+        allowed_cache: Optional[AllowedTokenCache] = None,
+        max_new_tokens: Optional[int] = None
+    ):
+        self.machines = [JsonTemplateMachine(schema.template()) for schema in schemas]
+        self.token_texts = token_texts
+        self.eos_token_id = eos_token_id
+        self.top_k = top_k
+        self.allowed_cache = allowed_cache if allowed_cache is not None else AllowedTokenCache(token_texts)
+        self.max_new_tokens = max_new_tokens
+        self.prompt_length: Optional[int] = None
+        self.consumed = [0] * len(self.machines)
+
+    def _accepts(self, machine: JsonTemplateMachine, token_id: int) -> bool:
+        return token_id < len(self.token_texts) and machine.accepts(self.token_texts[token_id])
+
+    def _allowed_tokens(self, machine: JsonTemplateMachine, row_scores) -> List[int]:
+        k = min(self.top_k, row_scores.shape[-1])
+        allowed = [
+            token_id for token_id in row_scores.topk(k).indices.tolist()
+            if self._accepts(machine, token_id)
+        ]
+        if allowed:
+            return allowed
+
+        import torch
+
+        allowed = [token_id for token_id in self.allowed_cache.allowed(machine) if token_id < row_scores.shape[-1]]
+        if not allowed:
+            return [self.eos_token_id]
+        best = int(row_scores[torch.tensor(allowed, device=row_scores.device)].argmax())
+        return [allowed[best]]
+
+    def __call__(self, input_ids, scores):
+        if self.prompt_length is None:
+            self.prompt_length = input_ids.shape[1]
+
+        mask = scores.new_full(scores.shape, float('-inf'))
+        for row, machine in enumerate(self.machines):
+            generated = input_ids[row, self.prompt_length:].tolist()
+            for token_id in generated[self.consumed[row]:]:
+                if machine.complete:
+                    break
+                machine.feed(self.token_texts[token_id])
+            self.consumed[row] = len(generated)
+
+            if machine.complete:
+                mask[row, self.eos_token_id] = 0
+                continue
+            if self.max_new_tokens is not None:
+                # Each closing token spells at least one character of the completion, and
+                # an escape left open by a free token adds at most _COMPLETION_GROWTH to
+                # it, so closing starts while the budget still covers the completion
+                completion = machine.completion()
+                if self.max_new_tokens - len(generated) <= len(completion) + _COMPLETION_GROWTH:
+                    closing = self.allowed_cache.prefixes(completion)
+                    if closing:
+                        mask[row, closing] = 0
+                        continue
+            mask[row, self._allowed_tokens(machine, scores[row])] = 0
+        return scores + mask
+
+
+class JsonObjectStoppingCriteria:
+    """
+    Stopping criterion (transformers `StoppingCriteria` protocol) that marks a row
+    done as soon as its generated text has closed the top-level JSON object, so
+    trailing chatter is never generated.
+    """
+
+    def __init__(self, batch_size: int, token_texts: List[str]):
+        self.scanners = [JsonObjectScanner() for _ in range(batch_size)]
+        self.token_texts = token_texts
+        self.prompt_length: Optional[int] = None
+        self.consumed = [0] * batch_size
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if self.prompt_length is None:
+            # Called after the first token was appended
+            self.prompt_length = input_ids.shape[1] - 1
+
+        done = []
+        for row, scanner in enumerate(self.scanners):
+            generated = input_ids[row, self.prompt_length:].tolist()
+            for token_id in generated[self.consumed[row]:]:
+                if scanner.complete or token_id >= len(self.token_texts):
+                    break
+                scanner.feed(self.token_texts[token_id])
+            self.consumed[row] = len(generated)
+            done.append(int(scanner.complete))
+        return input_ids.new_tensor(done) > 0
@@ -1,82 +1,346 @@
-from typing import List, Dict, Tuple
+from typing import Any, Callable, Iterable, Iterator, List, Dict, Tuple, Union, Optional
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import argparse
+import json
 import yaml
 import logging
+import time
 import traceback
+from itertools import islice
+from pathlib import Path
 from tqdm import tqdm 
-from models import LLMModel, SpecializedAgent
-from reducers import CentralizedReducer, DecentralizedReducer
+from models import LLMModel, ModelRegistry, SpecializedAgent
+from reducers import CentralizedReducer, DecentralizedReducer, ReducerOutput, RoundUpdate
+from scheduler import PipelineScheduler
 from prompts import HARM_DESCRIPTIONS
-from utils.io_utils import IOHandler, DebiasedOutput
+from utils.io_utils import IOHandler, DebiasedOutput, JsonlOutputWriter
+from utils.shards import ShardedOutputWriter, shard_dir_for
+from utils.checkpoint import SHARD_STRATEGIES, ProgressJournal, progress_path_for, shard_of
+from utils.response_cache import ResponseCache
+from utils.profiling import RunProfile
+from utils.metrics import REGISTRY, MetricsExporter
 import os
 
 
-# Set up logging
-os.makedirs('logs', exist_ok=True)  # Create logs directory if it doesn't exist
+# Set up logging; DEBIAS_LOG_FILE overrides the log file, and an empty value only
+# logs to stderr (parallel.py workers, whose stderr goes to their own log)
+LOG_FILE = os.environ.get('DEBIAS_LOG_FILE', os.path.join('logs', 'debiasing.log'))
+if LOG_FILE:
+    os.makedirs(os.path.dirname(LOG_FILE) or '.', exist_ok=True)  # Create logs directory if it doesn't exist
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     handlers=[
-        logging.FileHandler(os.path.join('logs', 'debiasing.log')),
+        *([logging.FileHandler(LOG_FILE)] if LOG_FILE else []),
         logging.StreamHandler()
     ]
 )
 logger = logging.getLogger(__name__)
 
+QUERIES = REGISTRY.counter("debias_queries_total", "Finished queries, by status (ok or error)")
+ROUNDS = REGISTRY.histogram("debias_rounds", "Refinement rounds per completed query", buckets=(0, 1, 2, 3, 4, 5, 6, 8, 10))
+STOP_REASONS = REGISTRY.counter("debias_stop_reasons_total", "Completed queries, by convergence stop reason")
+CONSECUTIVE_ERRORS = REGISTRY.gauge("debias_consecutive_errors", "Failed queries since the last success; the run aborts above debias_error_threshold")
+ERROR_THRESHOLD = REGISTRY.gauge("debias_error_threshold", "Consecutive failures tolerated before the run aborts")
+QUEUE_DEPTH = REGISTRY.gauge("debias_scheduler_queue_depth", "Tasks waiting for each model worker (pipeline scheduler)")
+SCHEDULER_UTILIZATION = REGISTRY.gauge("debias_scheduler_utilization", "Share of time each model worker spent generating (pipeline scheduler)")
+START_TIME = REGISTRY.gauge("debias_start_time_seconds", "Unix time the run started")
+
 class MultiLLMDebiasing:
-    def __init__(self, harm_assignments: Dict[str, List[str]], config: Dict, strategy: str = "centralized"):
+    def __init__(
+        self,
+        harm_assignments: Dict[str, List[str]],
+        config: Dict,
+        strategy: str = "centralized",
+        agent_models: Optional[Dict[str, str]] = None,
+        agent_backends: Optional[Dict[str, Dict[str, Any]]] = None
+    ):
         logger.info(f"Initializing MultiLLMDebiasing with strategy: {strategy}")
+        self.config = config
+        self.response_cache = None
+        if config.get('response_cache'):
+            self.response_cache = ResponseCache(
+                config['response_cache'],
+                max_bytes=config.get('response_cache_mb', 1024) * 1024 * 1024
+            )
+            logger.info(f"Using response cache at {config['response_cache']}")
+
+        # Agents sharing a checkpoint share one copy of its weights
+        self.registry = ModelRegistry(
+            prefix_cache_bytes=config.get('prefix_cache_mb', 0) * 1024 * 1024,
+            splice_templates=config.get('splice_templates', False),
+            response_cache=self.response_cache,
+            compile_mode=config.get('compile_mode', 'off'),
+            compile_cache_dir=config.get('compile_cache_dir'),
+            warmup_lengths=config.get('compile_warmup', ()),
+            length_buckets=config.get('length_buckets', ()),
+            # Prompts per generation call: a pipeline worker's batch, or a batch of queries
+            warmup_batch_size=config.get('scheduler_batch_size', 8) if config.get('scheduler', 'batch') == 'pipeline'
+            else config.get('gen_batch_size', 1)
+        )
+        agent_models = agent_models or {}
+        agent_backends = agent_backends or {}
+
         # Create specialized agents
         self.specialized_agents = []
+        # (model name, backend options) of every acquired model, for release
+        self.model_specs = []
         
-        for i, model_name in enumerate(harm_assignments.keys()):
-            logger.info(f"Loading model: {model_name}")
+        for agent_name in harm_assignments.keys():
+            model_name = agent_models.get(agent_name, agent_name)
+            backend_options = agent_backends.get(agent_name, {})
+            if self.registry.model_key(model_name, **backend_options) in self.registry.loaded_models:
+                logger.info(f"Reusing loaded model {model_name} for {agent_name}")
+            else:
+                logger.info(f"Loading model: {model_name} (backend: {backend_options.get('backend', 'hf')})")
             try:
-                model = LLMModel(model_name)
-                harm_types = set(harm_assignments.get(model_name, []))
-                logger.info(f"Assigned harm types for {model_name}: {harm_types}")
-                self.specialized_agents.append(SpecializedAgent(model, harm_types, strategy))
+                model = self.registry.acquire(model_name, **backend_options)
+                self.model_specs.append((model_name, backend_options))
+                harm_types = set(harm_assignments.get(agent_name, []))
+                logger.info(f"Assigned harm types for {agent_name}: {harm_types}")
+                self.specialized_agents.append(SpecializedAgent(
+                    model,
+                    harm_types,
+                    strategy,
+                    constrained_decoding=config.get('constrained_decoding', False),
+                    name=agent_name
+                ))
             except Exception as e:
                 logger.error(f"Error initializing model {model_name}: {str(e)}")
                 logger.error(traceback.format_exc())
                 raise
         
         # Initialize strategy
+        reducer_class = CentralizedReducer if strategy == "centralized" else DecentralizedReducer
         try:
-            if strategy == "centralized":
-                self.reducer = CentralizedReducer(self.specialized_agents, config)
+            self.scheduler = None
+            if config.get('scheduler', 'batch') == 'pipeline':
+                # Every query runs on its own driver thread; the scheduler batches their
+                # generations per model, so all agents in a round are submitted at once
+                self.scheduler = PipelineScheduler(
+                    self.specialized_agents,
+                    max_batch=config.get('scheduler_batch_size', 8),
+                    max_wait=config.get('scheduler_max_wait_ms', 0) / 1000
+                )
+                self.reducer = reducer_class(
+                    [self.scheduler.wrap(agent) for agent in self.specialized_agents],
+                    {**config, 'feedback_workers': len(self.specialized_agents)}
+                )
             else:
-                self.reducer = DecentralizedReducer(self.specialized_agents, config)
+                self.reducer = reducer_class(self.specialized_agents, config)
             logger.info(f"Successfully initialized {strategy} reducer")
         except Exception as e:
             logger.error(f"Error initializing reducer: {str(e)}")
             logger.error(traceback.format_exc())
             raise
 
-    def get_debiased_response(self, query: str, return_lineage: bool = False, return_feedback: bool = False) -> str:
-        """Get debiased response using the initialized strategy"""
+    def get_debiased_response(
+        self,
+        query: str,
+        return_lineage: bool = False,
+        return_feedback: bool = False,
+        on_round: Optional[Callable[[RoundUpdate], None]] = None
+    ) -> ReducerOutput:
+        """
+        Get debiased response using the initialized strategy.
+
+        `on_round` receives the query's RoundUpdate after every refinement round.
+        Safe to call from many threads at once with the pipeline scheduler, whose
+        model workers batch the concurrent queries' generations together.
+        """
         try:
-            return self.reducer.reduce_bias(query, return_lineage, return_feedback)
+            return self.reducer.reduce_bias(query, return_lineage, return_feedback, on_round)
         except Exception as e:
             logger.error(f"Error getting debiased response for query: {query}")
             logger.error(traceback.format_exc())
             raise
 
+    def get_debiased_responses(
+        self,
+        queries: List[str],
+        return_lineage: bool = False,
+        return_feedback: bool = False
+    ) -> List[Union[ReducerOutput, Exception]]:
+        """Debias a batch of queries together; failed queries are returned as their exception"""
+        try:
+            return self.reducer.reduce_bias_batch(queries, return_lineage, return_feedback)
+        except Exception as e:
+            logger.error(f"Error getting debiased responses for a batch of {len(queries)} queries")
+            logger.error(traceback.format_exc())
+            raise
+
+    def iter_debiased_responses(
+        self,
+        pending: Iterable[Tuple[int, str]],
+        batch_size: int = 1,
+        return_lineage: bool = False,
+        return_feedback: bool = False
+    ) -> Iterator[Tuple[Tuple[int, str], Union[ReducerOutput, Exception]]]:
+        """
+        Debias (index, query) pairs and yield each with its result, in input order.
+
+        Without a scheduler queries advance in batches of `batch_size`. With the
+        pipeline scheduler up to `max_inflight` queries are in flight at once, each
+        at its own round, and results are yielded as soon as all earlier ones are done.
+        """
+        if self.scheduler is None:
+            for chunk in iter_chunks(pending, batch_size):
+                try:
+                    results = self.get_debiased_responses(
+                        [query for _, query in chunk],
+                        return_lineage,
+                        return_feedback
+                    )
+                except Exception as e:
+                    # A failure of the whole generation batch counts against every query in it
+                    results = [e] * len(chunk)
+                yield from zip(chunk, results)
+            return
+
+        def debias(query: str) -> Union[ReducerOutput, Exception]:
+            return self.reducer.reduce_bias_batch([query], return_lineage, return_feedback)[0]
+
+        max_inflight = max(1, self.config.get('max_inflight', 16))
+        with ThreadPoolExecutor(max_workers=max_inflight, thread_name_prefix="query") as executor:
+            inflight = deque()
+            for item in pending:
+                inflight.append((item, executor.submit(debias, item[1])))
+                if len(inflight) >= max_inflight:
+                    item, future = inflight.popleft()
+                    yield item, self._future_result(future)
+            while inflight:
+                item, future = inflight.popleft()
+                yield item, self._future_result(future)
+
+    @staticmethod
+    def _future_result(future) -> Union[ReducerOutput, Exception]:
+        try:
+            return future.result()
+        except Exception as e:
+            return e
+
+    def preload(self) -> None:
+        """Load every in-process model now rather than on its first generation"""
+        for model in {id(agent.model): agent.model for agent in self.specialized_agents}.values():
+            if hasattr(model, 'load'):
+                model.load()
+
+    def scheduler_stats(self) -> Optional[Dict[str, Dict[str, float]]]:
+        return self.scheduler.stats() if self.scheduler is not None else None
+
+    def close(self) -> None:
+        """Release every agent's model so the registry can unload the weights"""
+        if self.scheduler is not None:
+            logger.info(f"Scheduler stats: {self.scheduler.stats()}")
+            self.scheduler.close()
+            self.scheduler = None
+        for model_name, backend_options in self.model_specs:
+            self.registry.release(model_name, **backend_options)
+        self.model_specs = []
+        if self.response_cache is not None:
+            logger.info(f"Response cache stats: {self.response_cache.stats()}")
+            self.response_cache.close()
+            self.response_cache = None
+
+def add_generation_arguments(parser: argparse.ArgumentParser) -> None:
+    """Options shaping how queries are debiased, shared by main.py and server.py"""
+    parser.add_argument('--max-rounds', type=int, default=3,
+                       help='Maximum number of refinement rounds')
+    parser.add_argument('--max-new-tokens', type=int, default=512,
+                       help='Maximum number of new tokens for response generation')
+    parser.add_argument('--temperature', type=float, default=0.0,
+                       help='Temperature for response generation')
+    parser.add_argument('--constrained-decoding', action='store_true',
+                       help='Constrain generation to the expected JSON schema so replies parse on the first try')
+    parser.add_argument('--seed', type=int, default=None,
+                       help='Seed for the feedback shuffling, making re-runs reproducible (default: unseeded)')
+    parser.add_argument('--response-cache', type=str, default=None,
+                       help='SQLite file caching greedy generations across runs (disabled if not set)')
+    parser.add_argument('--response-cache-mb', type=int, default=1024,
+                       help='Size bound (MB) of the response cache; least recently used entries are evicted')
+    parser.add_argument('--feedback-workers', type=int, default=1,
+                       help='Number of follower agents queried concurrently in each round (1 runs them sequentially)')
+    parser.add_argument('--prefix-cache-mb', type=int, default=0,
+                       help='Memory bound (MB) of the per-model KV cache for static system prompts (0, the default, disables it)')
+    parser.add_argument('--splice-templates', action='store_true',
+                       help='Tokenize only message contents and splice them into pre-tokenized chat templates '
+                            '(faster; token ids can differ from full tokenization at message edges)')
+    parser.add_argument('--convergence', type=str, default='exact',
+                       help='Comma-separated convergence criteria, checked in order: exact, edit_distance, jaccard, followers_clean')
+    parser.add_argument('--edit-distance-threshold', type=float, default=0.05,
+                       help='Maximum normalized word-level edit distance between rounds for the edit_distance criterion')
+    parser.add_argument('--jaccard-threshold', type=float, default=0.95,
+                       help='Minimum word overlap similarity between rounds for the jaccard criterion')
+    parser.add_argument('--max-inflight', type=int, default=16,
+                       help='Queries in flight at once with --scheduler pipeline')
+    parser.add_argument('--scheduler-batch-size', type=int, default=8,
+                       help='Maximum prompts per generation call of a model worker with --scheduler pipeline')
+    parser.add_argument('--scheduler-max-wait-ms', type=float, default=0.0,
+                       help='Milliseconds a pipeline model worker waits for more prompts before running a batch that is not full')
+    parser.add_argument('--compile-mode', type=str, default='off',
+                       choices=['off', 'default', 'reduce-overhead', 'max-autotune'],
+                       help='torch.compile mode of the in-process models forward pass (off runs eagerly)')
+    parser.add_argument('--compile-cache-dir', type=str, default=None,
+                       help='Directory persisting compiled kernels across runs')
+    parser.add_argument('--compile-warmup', type=str, default='',
+                       help='Comma-separated prompt lengths compiled at load time when --compile-mode is set '
+                            '(empty uses --length-buckets)')
+    parser.add_argument('--length-buckets', type=str, default='',
+                       help='Comma-separated prompt lengths batches are padded up to, grouping rows by length '
+                            '(empty pads each batch to its longest prompt)')
+    parser.add_argument('--profile', action='store_true',
+                       help='Record per-query timings (prefill/decode/validation), token counts, retries, cache hits and rounds')
+    parser.add_argument('--incremental', action='store_true',
+                       help='Centralized only: re-query a follower only if it flagged an issue or the text changed by more than --diff-threshold')
+    parser.add_argument('--diff-threshold', type=float, default=0.1,
+                       help='Word-level edit distance of the text above which clean followers are re-queried in incremental mode')
+
+def build_config(
+    args: argparse.Namespace,
+    config_options: Dict[str, Any],
+    scheduler: str = 'batch',
+    gen_batch_size: int = 1
+) -> Dict[str, Any]:
+    """MultiLLMDebiasing config from the generation options and the harm assignments' options"""
+    return {
+        'max_rounds': args.max_rounds,
+        'max_new_tokens': args.max_new_tokens,
+        'temperature': args.temperature,
+        'feedback_workers': args.feedback_workers,
+        'prefix_cache_mb': args.prefix_cache_mb,
+        'splice_templates': args.splice_templates,
+        'compile_mode': args.compile_mode,
+        'compile_cache_dir': args.compile_cache_dir,
+        'compile_warmup': [int(length) for length in args.compile_warmup.split(',') if length.strip()],
+        'length_buckets': [int(length) for length in args.length_buckets.split(',') if length.strip()],
+        'response_cache': args.response_cache,
+        'response_cache_mb': args.response_cache_mb,
+        'seed': args.seed,
+        'constrained_decoding': args.constrained_decoding,
+        'convergence': [name.strip() for name in args.convergence.split(',') if name.strip()],
+        'edit_distance_threshold': args.edit_distance_threshold,
+        'jaccard_threshold': args.jaccard_threshold,
+        'incremental': args.incremental,
+        'scheduler': scheduler,
+        'gen_batch_size': gen_batch_size,
+        'max_inflight': args.max_inflight,
+        'scheduler_batch_size': args.scheduler_batch_size,
+        'scheduler_max_wait_ms': args.scheduler_max_wait_ms,
+        'diff_threshold': args.diff_threshold,
+        'profile': args.profile,
+        **config_options
+    }
+
 def parse_args():
     parser = argparse.ArgumentParser(description='Multi-LLM Debiasing Framework')
     
     parser.add_argument('--harm-assignments', type=str, required=True,
                        help='YAML file defining models and their harm types')
     parser.add_argument('--input-file', type=str, required=True,
-                       help='Input file containing queries to debias (json, csv, pkl, txt)')
+                       help='Input file containing queries to debias (json, jsonl, csv, pkl, txt)')
     parser.add_argument('--output-file', type=str, required=True,
-                       help='Output file to save debiased responses (json, csv, pkl)')
-    parser.add_argument('--max-rounds', type=int, default=3,
-                       help='Maximum number of refinement rounds')
-    parser.add_argument('--max-new-tokens', type=int, default=512,
-                       help='Maximum number of new tokens for response generation')
-    parser.add_argument('--temperature', type=float, default=0.0,
-                       help='Temperature for response generation')
+                       help='Output file to save debiased responses (json, jsonl, csv, pkl)')
     parser.add_argument('--return-lineage', action='store_true',
                        help='Return lineage of debiasing steps')
     parser.add_argument('--return-feedback', action='store_true',
@@ -90,16 +354,53 @@ def parse_args():
                        help='Threshold for number of errors')    
     parser.add_argument('--batch-size', type=int, default=100,
                        help='Batch size for saving results')
+    parser.add_argument('--resume', action='store_true',
+                       help='Resume an interrupted run: skip queries recorded in the progress journal, append to its outputs '
+                            'and retry its failed queries (outputs are put back in input order once none fail)')
+    parser.add_argument('--durable', action='store_true',
+                       help='fsync every output and progress journal entry, so --resume also survives power loss (slower)')
+    parser.add_argument('--keep-shards', action='store_true',
+                       help='Leave the results as shards plus a manifest instead of merging them into the output file')
+    parser.add_argument('--offset', type=int, default=0,
+                       help='Number of leading input queries to skip')
+    parser.add_argument('--limit', type=int, default=None,
+                       help='Maximum number of input queries to process')
+    parser.add_argument('--num-shards', type=int, default=1,
+                       help='Split the selected queries across this many workers (see parallel.py)')
+    parser.add_argument('--shard-index', type=int, default=0,
+                       help='Shard processed by this run, from 0 to --num-shards - 1')
+    parser.add_argument('--shard-by', type=str, default='range', choices=list(SHARD_STRATEGIES),
+                       help='range: contiguous blocks of the input; hash: spread by query content')
+    parser.add_argument('--gen-batch-size', type=int, default=1,
+                       help='Number of queries advanced together through each generation round')
+    parser.add_argument('--scheduler', type=str, default='batch', choices=['batch', 'pipeline'],
+                       help='batch: queries advance together in --gen-batch-size groups; '
+                            'pipeline: queries overlap across rounds with per-model workers batching their generations')
+    parser.add_argument('--profile-output', type=str, default=None,
+                       help='JSON file receiving the run profile summary (requires --profile)')
+    parser.add_argument('--metrics-port', type=int, default=None,
+                       help='Serve Prometheus metrics at http://<metrics-host>:<port>/metrics while running')
+    parser.add_argument('--metrics-host', type=str, default='127.0.0.1',
+                       help='Interface the metrics endpoint binds to')
+    parser.add_argument('--metrics-file', type=str, default=None,
+                       help='File rewritten with the metrics (Prometheus text format) every --metrics-interval seconds')
+    parser.add_argument('--metrics-interval', type=float, default=15.0,
+                       help='Seconds between rewrites of --metrics-file')
+    parser.add_argument('--dry-run', action='store_true',
+                       help='Validate the harm assignments, options and input queries, then exit without loading weights or writing outputs')
+    add_generation_arguments(parser)
     args = parser.parse_args()
     
     return args
 
-def save_batch(outputs: List[DebiasedOutput], output_file: str, batch_num: int):
-    """Save a batch of results with a numbered suffix"""
-    base, ext = os.path.splitext(output_file)
-    batch_file = f"{base}_batch_{batch_num}{ext}"
-    logger.info(f"Saving batch {batch_num} to {batch_file}")
-    IOHandler.save_outputs(outputs, batch_file)
+def iter_chunks(items: Iterable[Any], size: int) -> Iterator[List[Any]]:
+    """Group an iterable into lists of at most `size` items"""
+    iterator = iter(items)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
 
 def main():
     args = parse_args()
@@ -112,84 +413,235 @@ def main():
     try:
         # Process harm assignments
         harm_assignments, strategy = IOHandler.process_harm_assignments(args.harm_assignments)
+        agent_models = IOHandler.load_agent_models(args.harm_assignments)
+        agent_backends = IOHandler.load_agent_backends(args.harm_assignments)
+        config_options = IOHandler.load_config_options(args.harm_assignments)
 
         # Load queries
-        queries = IOHandler.load_queries(args.input_file)
-        logger.info(f"Loaded {len(queries)} queries from {args.input_file}")
-        
-        config = {
-            'max_rounds': args.max_rounds,
-            'max_new_tokens': args.max_new_tokens,
-            'temperature': args.temperature
-        }
+        if Path(args.input_file).suffix == '.jsonl':
+            # Stream rows lazily so arbitrarily large inputs run in bounded memory
+            queries = IOHandler.iter_queries(args.input_file, args.offset, args.limit)
+            total = args.limit
+            logger.info(f"Streaming queries from {args.input_file}")
+        else:
+            queries = list(IOHandler.iter_queries(args.input_file, args.offset, args.limit))
+            total = len(queries)
+            logger.info(f"Loaded {total} queries from {args.input_file}")
+
+        if not 0 <= args.shard_index < args.num_shards:
+            raise ValueError(f"--shard-index must be in [0, {args.num_shards}), got {args.shard_index}")
+        in_shard = None
+        if args.num_shards > 1:
+            if args.shard_by == 'range' and not isinstance(queries, list):
+                # Blocks are cut from the query count, so count the streamed rows once
+                total = sum(1 for _ in IOHandler.iter_queries(args.input_file, args.offset, args.limit))
+            num_queries = total
+
+            def in_shard(i: int, query: str) -> bool:
+                position = i - args.offset
+                return shard_of(position, query, args.num_shards, args.shard_by, num_queries) == args.shard_index
+
+            if args.shard_by == 'range':
+                total = sum(1 for position in range(num_queries) if in_shard(args.offset + position, ""))
+            elif isinstance(queries, list):
+                total = sum(1 for i, query in enumerate(queries, start=args.offset) if in_shard(i, query))
+            else:
+                total = None
+            logger.info(f"Processing shard {args.shard_index} of {args.num_shards} ({args.shard_by})")
+
+        config = build_config(args, config_options, scheduler=args.scheduler, gen_batch_size=max(1, args.gen_batch_size))
         logger.debug(f"Configuration: {config}")
 
+        if args.dry_run:
+            # Build the agents (models load on first use, so no weights are read) and
+            # read every query, then stop before anything is written
+            debiasing = MultiLLMDebiasing(
+                harm_assignments=harm_assignments,
+                config={**config, 'response_cache': None},
+                strategy=strategy,
+                agent_models=agent_models,
+                agent_backends=agent_backends
+            )
+            num_queries = sum(1 for _ in queries)
+            debiasing.close()
+            logger.info(
+                f"Dry run OK: {strategy} strategy with {len(harm_assignments)} agents, "
+                f"{num_queries} queries from {args.input_file}; no weights loaded, nothing written"
+            )
+            return
+
+        journal_path = progress_path_for(args.output_file)
+        if args.resume and not journal_path.exists() and (
+            Path(args.output_file).exists() or shard_dir_for(args.output_file).exists()
+        ):
+            # The journal is removed once a run completes without failures
+            logger.info(f"{args.output_file} is from a completed run; nothing to resume")
+            return
+
+        # Record of finished queries, used to skip them with --resume
+        journal = ProgressJournal(journal_path, resume=args.resume, fsync=args.durable)
+
+        # Process queries and write outputs as they complete
+        if Path(args.output_file).suffix == '.jsonl':
+            # .jsonl outputs are appended and flushed one result at a time
+            writer = JsonlOutputWriter(args.output_file, append=args.resume, fsync=args.durable)
+        else:
+            # Other formats are written as shards of --batch-size outputs plus a manifest
+            writer = ShardedOutputWriter(
+                args.output_file, shard_size=args.batch_size, resume=args.resume, fsync=args.durable
+            )
+
+        if args.resume:
+            if writer.count < len(journal):
+                raise ValueError(
+                    f"Progress journal lists {len(journal)} completed queries but only "
+                    f"{writer.count} outputs were found for {args.output_file}"
+                )
+            # Outputs written after the last journal entry belong to queries that will rerun
+            writer.truncate(len(journal))
+            logger.info(f"Resuming run: skipping {len(journal)} completed queries")
+
         debiasing = MultiLLMDebiasing(
             harm_assignments=harm_assignments,
             config=config,
-            strategy=strategy
+            strategy=strategy,
+            agent_models=agent_models,
+            agent_backends=agent_backends
         )
         
-        # Process queries and collect outputs
-        outputs = []
-        current_batch = 1
+        exporter = None
+        # The scheduler workers and the models are shut down however processing ends
+        try:
+            pending = (
+                (i, query)
+                for i, query in enumerate(queries, start=args.offset)
+                if (in_shard is None or in_shard(i, query)) and not journal.is_completed(i, query)
+            )
         
-        for i, query in tqdm(enumerate(queries), desc="Processing queries", total=len(queries)):
-            try:
-                result = debiasing.get_debiased_response(
-                    query, 
-                    args.return_lineage, 
-                    args.return_feedback
-                )
+            run_profile = RunProfile() if args.profile else None
+
+            if args.metrics_port is not None or args.metrics_file:
+                def collect_scheduler():
+                    for model, model_stats in (debiasing.scheduler_stats() or {}).items():
+                        QUEUE_DEPTH.set(model_stats["queue_depth"], model=model)
+                        SCHEDULER_UTILIZATION.set(model_stats["utilization"], model=model)
+
+                START_TIME.set(time.time())
+                ERROR_THRESHOLD.set(args.error_threshold)
+                CONSECUTIVE_ERRORS.set(0)
+                REGISTRY.add_collector(collect_scheduler)
+                exporter = MetricsExporter(
+                    host=args.metrics_host,
+                    port=args.metrics_port,
+                    path=args.metrics_file,
+                    interval=args.metrics_interval
+                ).start()
+                logger.info(f"Publishing metrics to {exporter.url or args.metrics_file}")
+            progress = tqdm(desc="Processing queries", total=total, initial=len(journal))
+            started = time.perf_counter()
+            processed = 0
+            failed = 0
+
+            results = debiasing.iter_debiased_responses(
+                pending,
+                max(1, args.gen_batch_size),
+                args.return_lineage,
+                args.return_feedback
+            )
+            for (i, query), result in results:
+                processed += 1
+                progress.update(1)
+                stats = debiasing.scheduler_stats()
+                if stats is not None:
+                    progress.set_postfix(queued=sum(s["queue_depth"] for s in stats.values()))
+
+                if isinstance(result, Exception):
+                    logger.error(f"Error processing query {i}: {str(result)}")
+                    logger.error("".join(traceback.format_exception(type(result), result, result.__traceback__)))
+                    error_threshold += 1
+                    failed += 1
+                    QUERIES.inc(status="error")
+                    CONSECUTIVE_ERRORS.set(error_threshold)
+                    if error_threshold > args.error_threshold:
+                        # Save current batch before raising error
+                        writer.close()
+                        journal.close()
+                        raise result
+                    continue
+
                 error_threshold = 0
-                
-            except Exception as e:
-                logger.error(f"Error processing query {i}: {str(e)}")
-                logger.error(traceback.format_exc())
-                error_threshold += 1
-                if error_threshold > args.error_threshold:
-                    # Save current batch before raising error
-                    if outputs:
-                        save_batch(outputs, args.output_file, current_batch)
-                    raise e
-                continue    
-
-            if args.include_metadata:
-                metadata = {"query_index": i}
+                QUERIES.inc(status="ok")
+                CONSECUTIVE_ERRORS.set(0)
+                ROUNDS.observe(result.rounds)
+                STOP_REASONS.inc(reason=result.stop_reason)
+                if run_profile is not None:
+                    run_profile.add(result.profile)
+
+                if args.include_metadata:
+                    metadata = {"query_index": i, "stop_reason": result.stop_reason, "rounds": result.rounds}
+                    if result.profile is not None:
+                        metadata["profile"] = result.profile
+                else:
+                    metadata = None
+
+                output = DebiasedOutput(
+                    original_query=query,
+                    debiased_response=result.final_response,
+                    lineage=result.lineage,
+                    feedback=result.feedback,
+                    metadata=metadata
+                )
+                writer.write(output)
+                journal.record(i, query)
+
+
+            progress.close()
+            elapsed = time.perf_counter() - started
+            if processed:
+                logger.info(f"Throughput: {processed / elapsed:.3f} queries/s over {processed} queries")
+            if run_profile is not None:
+                summary = run_profile.summary()
+                logger.info(f"Profile summary: {json.dumps(summary)}")
+                if args.profile_output:
+                    with open(args.profile_output, 'w') as f:
+                        json.dump(summary, f, indent=2)
+
+            writer.close()
+            if failed:
+                # The shards stay unmerged so that --resume can reopen them
+                journal.close()
+                logger.warning(f"{failed} queries failed; kept {journal_path} so --resume retries them")
+                if isinstance(writer, ShardedOutputWriter):
+                    logger.info(f"Left {writer.manifest['total']} outputs sharded under {writer.shard_dir}")
+                else:
+                    logger.info(f"Wrote {writer.count} outputs to {args.output_file}")
             else:
-                metadata = None
-
-            output = DebiasedOutput(
-                original_query=query,
-                debiased_response=result.final_response,
-                lineage=result.lineage,
-                feedback=result.feedback,
-                metadata=metadata
-            )
-            outputs.append(output)
-            
-            # Save batch when we reach batch size
-            if len(outputs) >= args.batch_size:
-                save_batch(outputs, args.output_file, current_batch)
-                current_batch += 1
-                outputs = []  # Clear the outputs list after saving
-        
-        # Save any remaining outputs
-        if outputs:
-            save_batch(outputs, args.output_file, current_batch)
-            
-        # Combine all batches into final output file
-        logger.info(f"Combining all batches into final output file: {args.output_file}")
-        all_outputs = []
-        for batch in range(1, current_batch + 1):
-            base, ext = os.path.splitext(args.output_file)
-            batch_file = f"{base}_batch_{batch}{ext}"
-            if os.path.exists(batch_file):
-                batch_outputs = IOHandler.load_outputs(batch_file)
-                all_outputs.extend(batch_outputs)
-                os.remove(batch_file)  # Clean up batch file
-                
-        IOHandler.save_outputs(all_outputs, args.output_file)
+                # Queries retried by a resumed run were written after later ones
+                order = journal.output_order()
+                if isinstance(writer, ShardedOutputWriter):
+                    if args.keep_shards:
+                        if order is not None:
+                            logger.warning(f"Shards under {writer.shard_dir} are not in input order; merge them to reorder")
+                        logger.info(f"Left {writer.manifest['total']} outputs sharded under {writer.shard_dir}")
+                    else:
+                        # Stream the shards into the final output file
+                        logger.info(f"Merging shards into final output file: {args.output_file}")
+                        writer.merge(order=order)
+                else:
+                    if order is not None:
+                        writer.reorder(order)
+                    logger.info(f"Wrote {writer.count} outputs to {args.output_file}")
+                journal.remove()
+
+            if exporter is not None:
+                # Final scheduler sample while the scheduler still exists
+                collect_scheduler()
+        finally:
+            if exporter is not None:
+                REGISTRY.remove_collector(collect_scheduler)
+            debiasing.close()
+            if exporter is not None:
+                exporter.close()
         logger.info("Processing completed successfully")
 
     except Exception as e:
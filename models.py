@@ -1,77 +1,591 @@
-from typing import Set, List, Dict
+from typing import Set, List, Dict, Optional, Sequence, Union
+import copy
+import gc
 import json
-from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig
-import torch
-from prompts import get_specialized_context, get_feedback_prompt, get_leader_integration_prompt
-from utils.auth import setup_hf_auth
+import logging
+import os
+import threading
+import time
+from prompts import get_specialized_context, get_feedback_prompt, get_leader_integration_prompt, get_initiale_response, get_revision_prompt
+from utils.auth import ensure_hf_auth
+from utils.kv_cache import PrefixCache
+from utils.metrics import REGISTRY
+from utils.profiling import FirstStepTimer, GenerationStats, QueryProfile
+from utils.prompt_cache import EncodedPrompt, PromptTemplateCache
+from utils.response_cache import ResponseCache
+from backends import GenerationBackend, create_backend
+from decoding import (
+    AllowedTokenCache, JsonSchema, JsonSchemaLogitsProcessor, JsonObjectStoppingCriteria, build_token_texts
+)
 import re  # Add this import at the top
 from prompts import HARM_DESCRIPTIONS
 
-class LLMModel:
-    """Simple wrapper for transformer models with chat template support"""
-    def __init__(self, model_name: str):
+logger = logging.getLogger(__name__)
+
+COMPILE_MODES = ("off", "default", "reduce-overhead", "max-autotune")
+
+AGENT_RESPONSES = REGISTRY.counter("debias_agent_responses_total", "Responses requested from each agent (first attempts)")
+JSON_RETRIES = REGISTRY.counter("debias_json_retries_total", "Responses regenerated after failing JSON validation, per agent")
+JSON_FAILURES = REGISTRY.counter("debias_json_failures_total", "Responses still invalid after the retry, per agent")
+
+
+class LLMModel(GenerationBackend):
+    """
+    Simple wrapper for transformer models with chat template support.
+
+    torch and transformers are imported, and the weights loaded, on the first
+    generation (or an explicit `load`), so building agents and validating a
+    configuration stay cheap.
+    """
+    backend_name = "hf"
+    # Calls from concurrent agents sharing the model run one at a time
+    serialize = True
+
+    def __init__(
+        self,
+        model_name: str,
+        prefix_cache_bytes: int = 0,
+        response_cache: Optional[ResponseCache] = None,
+        compile_mode: str = "off",
+        compile_cache_dir: Optional[str] = None,
+        warmup_lengths: Sequence[int] = (),
+        length_buckets: Sequence[int] = (),
+        warmup_batch_size: int = 1,
+        splice_templates: bool = False
+    ):
+        super().__init__(model_name, response_cache)
+        if compile_mode not in COMPILE_MODES:
+            raise ValueError(f"Unknown compile mode: {compile_mode} (expected one of {', '.join(COMPILE_MODES)})")
+        self.tokenizer = None
+        self.model = None
+        # Prompt encoder built with the tokenizer; `splice_templates` precompiles chat templates into token ids
+        self.splice_templates = splice_templates
+        self.prompt_templates: Optional[PromptTemplateCache] = None
+        # torch.compile of the forward pass: mode, persistent cache, and prompt lengths compiled ahead of time
+        self.compile_mode = compile_mode
+        self.compile_cache_dir = compile_cache_dir
+        self.compile_seconds = 0.0
+        # Prompt lengths batches are padded up to, so rows of similar length share a call
+        # and the compiled graph sees a fixed set of shapes (empty pads to the longest row)
+        self.length_buckets = sorted(set(length_buckets))
+        # Warmup shapes default to the buckets, which are the shapes real batches are padded to
+        self.warmup_lengths = sorted(set(warmup_lengths)) if warmup_lengths else list(self.length_buckets)
+        # Rows per call the warmup compiles for, besides single-row calls (e.g. retries)
+        self.warmup_batch_sizes = sorted({1, max(1, warmup_batch_size)})
+        self._bucket_stats: Dict[str, Dict[str, int]] = {}
+        # KV cache of the static system prompts shared by every call of an agent
+        self.prefix_cache = PrefixCache(prefix_cache_bytes) if prefix_cache_bytes > 0 else None
+        # Decoded vocabulary used by constrained decoding and JSON stopping, built on first use
+        self._token_texts: Optional[List[str]] = None
+        # Tokens each constrained decoding state accepts, filled in as states are reached
+        self._allowed_tokens: Optional[AllowedTokenCache] = None
+
+    @property
+    def cache_name(self) -> str:
+        # Bare checkpoint name, so caches written before backends existed stay valid
+        return self.model_name
+
+    @property
+    def loaded(self) -> bool:
+        return self.model is not None
+
+    def load(self) -> None:
+        """Authenticate (once per process) and load the tokenizer and weights"""
+        if self.loaded:
+            return
+        import torch
+        from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig
+
         # Setup HF auth before loading model
-        if not setup_hf_auth():
+        if not ensure_hf_auth(self.model_name):
             raise RuntimeError("Failed to authenticate with Hugging Face")
         
         #quantization_config = BitsAndBytesConfig(load_in_4bit=True, bnb_4bit_compute_dtype=torch.bfloat16)
 
-        self.model_name = model_name  
-        self.tokenizer = AutoTokenizer.from_pretrained(model_name, trust_remote_code=True)
-        self.model = AutoModelForCausalLM.from_pretrained(
-            model_name,
+        logger.info(f"Loading weights of {self.model_name}")
+        tokenizer = AutoTokenizer.from_pretrained(self.model_name, trust_remote_code=True)
+        # Left padding keeps every prompt flush against its generated tokens in batched calls
+        tokenizer.padding_side = "left"
+        if tokenizer.pad_token is None:
+            tokenizer.pad_token = tokenizer.eos_token
+        model = AutoModelForCausalLM.from_pretrained(
+            self.model_name,
             torch_dtype='auto',
             trust_remote_code=True,
             #quantization_config = quantization_config
             device_map="auto"
         ).eval()
-        self.model = torch.compile(self.model, mode="max-autotune")
-
-    @torch.inference_mode()
-    def generate(self, messages: List[Dict[str, str]], max_new_tokens: int = 64, temperature: float = 0.0) -> str:
-        # Apply chat template
-        tokenized_chat = self.tokenizer.apply_chat_template(
-            messages,
-            tokenize=True, 
-            add_generation_prompt=True,
-            return_tensors="pt"
-        ).to(self.model.device)
+        self.tokenizer = tokenizer
+        self.model = model
+        self.prompt_templates = PromptTemplateCache(tokenizer, splice=self.splice_templates)
+        if self.compile_mode != "off":
+            self._compile()
+
+    def _compile(self) -> None:
+        """
+        Compile the forward pass (`generate` itself stays eager) and warm it up on
+        each of `warmup_lengths` at each of `warmup_batch_sizes`, so the first real
+        batches do not pay for compilation. Without length buckets every batch has
+        its own shape, so there is nothing to warm up and recompiles are expected.
+        """
+        import torch
+
+        if self.compile_cache_dir:
+            # Inductor reuses compiled kernels across runs from this directory
+            os.makedirs(self.compile_cache_dir, exist_ok=True)
+            os.environ["TORCHINDUCTOR_CACHE_DIR"] = self.compile_cache_dir
+            try:
+                import torch._inductor.config as inductor_config
+                inductor_config.fx_graph_cache = True
+            except (ImportError, AttributeError):
+                pass
+
+        if not self.warmup_lengths:
+            logger.warning(
+                f"Compiling {self.model_name} without length buckets: batch shapes vary, "
+                "so expect recompiles (set --length-buckets)"
+            )
+
+        start = time.perf_counter()
+        self.model.forward = torch.compile(self.model.forward, mode=None if self.compile_mode == "default" else self.compile_mode)
+        with torch.inference_mode():
+            for length in self.warmup_lengths:
+                for batch_size in self.warmup_batch_sizes:
+                    input_ids = torch.full((batch_size, length), self.tokenizer.pad_token_id, device=self.model.device)
+                    # Two new tokens cover both the prefill and the decode step shapes
+                    self.model.generate(
+                        input_ids=input_ids,
+                        attention_mask=torch.ones_like(input_ids),
+                        max_new_tokens=2,
+                        do_sample=False,
+                        pad_token_id=self.tokenizer.pad_token_id
+                    )
+        self.compile_seconds = time.perf_counter() - start
+        logger.info(
+            f"Compiled {self.model_name} ({self.compile_mode}) in {self.compile_seconds:.1f}s, "
+            f"warmup lengths {self.warmup_lengths} x batch sizes {self.warmup_batch_sizes}: {self.compile_stats()}"
+        )
+
+    def compile_stats(self) -> Dict[str, float]:
+        """torch.compile counters; graph and recompile counts are process-wide"""
+        stats = {"mode": self.compile_mode, "compile_seconds": round(self.compile_seconds, 3)}
+        if self.compile_mode == "off" or not self.loaded:
+            return stats
+        try:
+            from torch._dynamo.utils import counters
+        except ImportError:
+            return stats
+        stats["graphs"] = counters["stats"].get("unique_graphs", 0)
+        stats["frames_compiled"] = counters["frames"].get("ok", 0)
+        stats["recompiles"] = sum(counters["recompiles"].values()) if "recompiles" in counters else None
+        return stats
+
+    def bucket_length(self, length: int) -> int:
+        """Smallest bucket holding `length` tokens; longer prompts round up to a multiple of the largest"""
+        for bucket in self.length_buckets:
+            if length <= bucket:
+                return bucket
+        largest = self.length_buckets[-1]
+        return -(-length // largest) * largest
+
+    def _record_bucket(self, bucket: Optional[int], token_ids: List[List[int]], width: int) -> None:
+        stats = self._bucket_stats.setdefault(
+            "longest" if bucket is None else str(bucket),
+            {"batches": 0, "rows": 0, "tokens": 0, "padded_tokens": 0}
+        )
+        stats["batches"] += 1
+        stats["rows"] += len(token_ids)
+        stats["tokens"] += sum(len(ids) for ids in token_ids)
+        stats["padded_tokens"] += width * len(token_ids)
+
+    def bucket_stats(self) -> Dict[str, Dict[str, float]]:
+        """
+        Per-bucket prompt counters; utilization is the share of prefill positions
+        holding real tokens rather than padding. Rows padded to the longest prompt
+        of their batch (no buckets) are reported under 'longest'.
+        """
+        return {
+            bucket: {
+                **stats,
+                "utilization": round(stats["tokens"] / stats["padded_tokens"], 4) if stats["padded_tokens"] else 0.0,
+            }
+            for bucket, stats in self._bucket_stats.items()
+        }
+
+    def close(self) -> None:
+        if self.compile_mode != "off" and self.loaded:
+            logger.info(f"torch.compile stats for {self.model_name}: {self.compile_stats()}")
+        if self._bucket_stats:
+            logger.info(f"Prompt length buckets of {self.model_name}: {self.bucket_stats()}")
+        if self.prompt_templates is not None:
+            logger.info(f"Prompt templates of {self.model_name}: {self.prompt_templates.stats()}")
+        # Drop the weights and everything built on the tokenizer; `load` brings them back
+        self.model = None
+        self.tokenizer = None
+        self.prompt_templates = None
+        self._token_texts = None
+        self._allowed_tokens = None
+        if self.prefix_cache is not None:
+            self.prefix_cache.clear()
+
+    def _left_pad(self, token_ids: List[List[int]], width: int):
+        """(input_ids, attention_mask) tensors of `token_ids` left-padded to `width`"""
+        import torch
+
+        pad_id = self.tokenizer.pad_token_id
+        input_ids = torch.tensor(
+            [[pad_id] * (width - len(ids)) + ids for ids in token_ids],
+            device=self.model.device
+        )
+        attention_mask = torch.tensor(
+            [[0] * (width - len(ids)) + [1] * len(ids) for ids in token_ids],
+            device=self.model.device
+        )
+        return input_ids, attention_mask
+
+    def _encode_with_prefix_cache(self, encoded: List[EncodedPrompt], pad_to: Optional[int] = None) -> Optional[Dict]:
+        """
+        Encode a batch whose chats share the same system message, reusing the
+        past_key_values of that system block instead of prefilling it again.
+
+        Padding is placed between the cached prefix and each row's remainder so every
+        row keeps the prefix at the same positions; the attention mask hides it. With
+        `pad_to`, the remainders are padded so the whole prompt spans that many tokens.
+
+        Returns:
+            `generate` keyword arguments, or None if the batch cannot use the cache
+        """
+        prefix = encoded[0].prefix
+        if prefix is None or any(row.prefix != prefix for row in encoded):
+            # No shared system block, or the chat template renders it differently inside a conversation
+            return None
+        prefix_length = encoded[0].prefix_length
+
+        import torch
+
+        cached = self.prefix_cache.get(prefix)
+        if cached is None:
+            from transformers import DynamicCache
+
+            prefix_ids = torch.tensor([encoded[0].token_ids[:prefix_length]], device=self.model.device)
+            past_key_values = self.model(
+                input_ids=prefix_ids,
+                past_key_values=DynamicCache(),
+                use_cache=True
+            ).past_key_values
+            if self.prefix_cache.put(prefix, prefix_ids, past_key_values):
+                # The stored entry must stay pristine: `generate` extends its cache in place
+                past_key_values = copy.deepcopy(past_key_values)
+        else:
+            prefix_ids, past_key_values = cached
+
+        suffix_ids = [row.token_ids[prefix_length:] for row in encoded]
+        width = max(len(ids) for ids in suffix_ids)
+        if pad_to is not None:
+            width = max(width, pad_to - prefix_ids.shape[1])
+        suffix, suffix_mask = self._left_pad(suffix_ids, width)
+
+        batch_size = len(encoded)
+        if batch_size > 1:
+            past_key_values.batch_repeat_interleave(batch_size)
+        return {
+            "input_ids": torch.cat([prefix_ids.expand(batch_size, -1), suffix], dim=1),
+            "attention_mask": torch.cat([torch.ones_like(prefix_ids).expand(batch_size, -1), suffix_mask], dim=1),
+            "past_key_values": past_key_values,
+        }
+
+    def _get_token_texts(self) -> List[str]:
+        if self._token_texts is None:
+            self._token_texts = build_token_texts(self.tokenizer)
+        return self._token_texts
+
+    def _get_allowed_tokens(self) -> AllowedTokenCache:
+        if self._allowed_tokens is None:
+            self._allowed_tokens = AllowedTokenCache(self._get_token_texts())
+        return self._allowed_tokens
+
+    def _json_logits_processor(self, json_schemas: List[JsonSchema], max_new_tokens: int):
+        from transformers import LogitsProcessorList
+
+        eos_token_id = self.model.generation_config.eos_token_id
+        if isinstance(eos_token_id, list):
+            eos_token_id = eos_token_id[0]
+        if eos_token_id is None:
+            eos_token_id = self.tokenizer.eos_token_id
+        return LogitsProcessorList([
+            JsonSchemaLogitsProcessor(
+                json_schemas, self._get_token_texts(), eos_token_id,
+                allowed_cache=self._get_allowed_tokens(), max_new_tokens=max_new_tokens
+            )
+        ])
+
+    def _generate_batch(
+        self,
+        batch_messages: List[List[Dict[str, str]]],
+        max_new_tokens: int,
+        temperature: float,
+        json_schemas: Optional[List[JsonSchema]] = None,
+        stop_at_json_end: bool = False,
+        stats: Optional[GenerationStats] = None
+    ) -> List[str]:
+        self.load()
+        import torch
+
+        with torch.inference_mode():
+            return self._generate_loaded(batch_messages, max_new_tokens, temperature, json_schemas, stop_at_json_end, stats)
+
+    def _generate_loaded(
+        self,
+        batch_messages: List[List[Dict[str, str]]],
+        max_new_tokens: int,
+        temperature: float,
+        json_schemas: Optional[List[JsonSchema]],
+        stop_at_json_end: bool,
+        stats: Optional[GenerationStats] = None
+    ) -> List[str]:
+        # Apply chat template (the template carries the special tokens; with splicing, static parts come pre-tokenized)
+        encoded = self.prompt_templates.encode(batch_messages)
+
+        # Group rows by length bucket; each group is one generate call padded to its bucket
+        groups: Dict[Optional[int], List[int]] = {}
+        for row, prompt in enumerate(encoded):
+            bucket = self.bucket_length(len(prompt.token_ids)) if self.length_buckets else None
+            groups.setdefault(bucket, []).append(row)
+
+        outputs: List[Optional[str]] = [None] * len(encoded)
+        for bucket, rows in groups.items():
+            group_stats = GenerationStats.for_rows(len(rows)) if stats is not None else None
+            texts = self._generate_rows(
+                [encoded[row] for row in rows],
+                bucket,
+                max_new_tokens,
+                temperature,
+                [json_schemas[row] for row in rows] if json_schemas is not None else None,
+                stop_at_json_end,
+                group_stats
+            )
+            for row, text in zip(rows, texts):
+                outputs[row] = text
+            if stats is not None:
+                stats.scatter(rows, group_stats)
+        return outputs
+
+    def _generate_rows(
+        self,
+        encoded: List[EncodedPrompt],
+        pad_to: Optional[int],
+        max_new_tokens: int,
+        temperature: float,
+        json_schemas: Optional[List[JsonSchema]],
+        stop_at_json_end: bool,
+        stats: Optional[GenerationStats] = None
+    ) -> List[str]:
+        """Generate one group of rows, left-padded to `pad_to` tokens (or to the longest row)"""
+        from transformers import StoppingCriteriaList
+
+        start = time.perf_counter()
+        token_ids = [row.token_ids for row in encoded]
+        inputs = None
+        if self.prefix_cache is not None:
+            inputs = self._encode_with_prefix_cache(encoded, pad_to)
+        if inputs is None:
+            width = max(len(ids) for ids in token_ids)
+            if pad_to is not None:
+                width = max(width, pad_to)
+            input_ids, attention_mask = self._left_pad(token_ids, width)
+            inputs = {"input_ids": input_ids, "attention_mask": attention_mask}
+        self._record_bucket(pad_to, token_ids, inputs["input_ids"].shape[1])
+
+        stopping_criteria = StoppingCriteriaList()
+        if json_schemas is not None:
+            inputs["logits_processor"] = self._json_logits_processor(json_schemas, max_new_tokens)
+        elif stop_at_json_end:
+            # Constrained decoding already ends on the closing brace
+            stopping_criteria.append(JsonObjectStoppingCriteria(len(encoded), self._get_token_texts()))
+        timer = None
+        if stats is not None:
+            # Marks the end of prefill (including the prefix cache lookup above)
+            timer = FirstStepTimer()
+            stopping_criteria.append(timer)
+        if stopping_criteria:
+            inputs["stopping_criteria"] = stopping_criteria
 
         if temperature > 0.0:
             outputs = self.model.generate(
-                tokenized_chat,
+                **inputs,
                 max_new_tokens=max_new_tokens,
                 temperature=temperature,
-                pad_token_id=self.tokenizer.eos_token_id
+                pad_token_id=self.tokenizer.pad_token_id
             )
         else:
             outputs = self.model.generate(
-                tokenized_chat,
+                **inputs,
                 max_new_tokens=max_new_tokens,
                 do_sample=False,
-                pad_token_id=self.tokenizer.eos_token_id
+                pad_token_id=self.tokenizer.pad_token_id
             )
-        # Ignore the generation prompt
-        return self.tokenizer.decode(outputs[0][len(tokenized_chat[0]):], skip_special_tokens=True)
+        # Ignore the generation prompt (left padding aligns every prompt to the same length)
+        prompt_length = inputs["input_ids"].shape[1]
+        generated = outputs[:, prompt_length:]
+        if stats is not None:
+            end = time.perf_counter()
+            first_step = timer.first_step or end
+            stats.prefill_seconds += first_step - start
+            stats.decode_seconds += end - first_step
+            stats.prompt_tokens[:] = [len(ids) for ids in token_ids]
+            # Finished rows are padded with pad (= EOS) tokens, which are not counted
+            stats.generated_tokens[:] = (generated != self.tokenizer.pad_token_id).sum(dim=1).tolist()
+        return self.tokenizer.batch_decode(generated, skip_special_tokens=True)
+
+
+class ModelRegistry:
+    """
+    Loads each checkpoint once and shares it between every agent that uses it.
+
+    Models are reference counted: `acquire` loads (or reuses) a model and `release`
+    unloads it once the last agent holding it lets go. A model is identified by its
+    name plus its backend options (see `backends.create_backend`), so the same
+    checkpoint served in-process and over HTTP are distinct entries.
+    """
+    def __init__(self, **model_kwargs):
+        # Keyword arguments forwarded to every backend the registry creates
+        self.model_kwargs = model_kwargs
+        self._models: Dict[str, GenerationBackend] = {}
+        self._refcounts: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def model_key(model_name: str, backend: str = "hf", **backend_options) -> str:
+        if backend == "hf":
+            return model_name
+        # Every option counts: agents with different settings get their own backend
+        options = ",".join(f"{name}={backend_options[name]!r}" for name in sorted(backend_options))
+        return f"{backend}:{model_name}" + (f"[{options}]" if options else "")
+
+    def acquire(self, model_name: str, backend: str = "hf", **backend_options) -> GenerationBackend:
+        key = self.model_key(model_name, backend, **backend_options)
+        with self._lock:
+            if key not in self._models:
+                self._models[key] = create_backend(
+                    model_name,
+                    backend,
+                    **(self.model_kwargs if backend == "hf" else {"response_cache": self.model_kwargs.get("response_cache")}),
+                    **backend_options
+                )
+                self._refcounts[key] = 0
+            self._refcounts[key] += 1
+            return self._models[key]
+
+    def release(self, model_name: str, backend: str = "hf", **backend_options) -> None:
+        key = self.model_key(model_name, backend, **backend_options)
+        with self._lock:
+            if key not in self._refcounts:
+                raise KeyError(f"Model {key} is not loaded")
+            self._refcounts[key] -= 1
+            if self._refcounts[key] > 0:
+                return
+        self.unload(key)
+
+    def unload(self, key: str) -> None:
+        """
+        Drop a model regardless of its reference count and free its memory.
+
+        Agents still holding the backend keep a closed model: an hf model reloads
+        its weights on its next call.
+        """
+        with self._lock:
+            self._refcounts.pop(key, None)
+            model = self._models.pop(key, None)
+        if model is None:
+            return
+        was_loaded = isinstance(model, LLMModel) and model.loaded
+        # Releases the weights, tokenizer and KV caches of in-process models
+        model.close()
+        if not was_loaded:
+            return
+        del model
+        gc.collect()
+        import torch
+
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def unload_all(self) -> None:
+        for key in list(self._models):
+            self.unload(key)
+
+    def refcount(self, model_name: str, backend: str = "hf", **backend_options) -> int:
+        return self._refcounts.get(self.model_key(model_name, backend, **backend_options), 0)
+
+    @property
+    def loaded_models(self) -> List[str]:
+        return list(self._models)
         
 
+# Agent tasks: write a debiased response, review a peer's response, or revise a
+# response using the feedback gathered on it
+RESPOND = "respond"
+REVIEW = "review"
+REVISE = "revise"
+
+
 class SpecializedAgent:
-    def __init__(self, model: LLMModel, harm_types: Set[str], strategy: str):
+    def __init__(
+        self,
+        model: GenerationBackend,
+        harm_types: Set[str],
+        strategy: str,
+        constrained_decoding: bool = False,
+        name: Optional[str] = None
+    ):
         self.model = model
+        # Label of the agent in profiles (agents may share a model)
+        self.name = name or model.model_name
         self.is_leader = len(harm_types) == 0  # No harm types assigned (leader)
         self.harm_types = harm_types if not(self.is_leader) else set(HARM_DESCRIPTIONS.keys())
+        # Prompts list harm types in a fixed order so identical agents render identical messages
+        self.harm_type_list = [harm for harm in HARM_DESCRIPTIONS if harm in self.harm_types]
         self.strategy = strategy
+        # Constrain generation to the expected JSON shape instead of retrying bad output
+        self.constrained_decoding = constrained_decoding
+
+    def _default_task(self, feedback_messages: Optional[List[Dict[str, str]]] = None) -> str:
+        """Task implied by the strategy and role when the caller does not name one"""
+        if self.strategy == "centralized":
+            return REVISE if self.is_leader else REVIEW
+        return RESPOND if feedback_messages is None else REVIEW
+
+    def _output_key(self, task: str) -> str:
+        """JSON field carrying the reply payload: "response" (rewritten text) or "recommendations" (review)"""
+        return "recommendations" if task == REVIEW else "response"
+
+    def _json_schema(self, task: str) -> JsonSchema:
+        return JsonSchema(tuple(self.harm_type_list), self._output_key(task))
         
-    def _validate_json_response(self, response: str) -> str:
-        """Extract and validate JSON from model response that may contain markdown formatting"""
+    def _parse_json_object(self, response: str):
+        """
+        Decode the reply's JSON object. Generation stops right after the top-level
+        object closes, so it is decoded directly from its first brace; extracting a
+        fenced markdown block is kept as a fallback.
+        """
+        start = response.find('{')
+        if start >= 0:
+            try:
+                return json.JSONDecoder().raw_decode(response, start)[0]
+            except json.JSONDecodeError:
+                pass
+
         # First try to find JSON within triple backticks
         match = re.search(r'```(?:json)?\n(.*?)\n```', response, re.DOTALL)
         
         # If found within backticks, use that, otherwise try the full response
         json_str = match.group(1).strip() if match else response.strip()
-        
+        return json.loads(json_str)
+
+    def _validate_json_response(self, response: str, output_key: str = "response") -> str:
+        """Extract and validate JSON from model response that may contain markdown formatting"""
         try:
-            response_obj = json.loads(json_str)
+            response_obj = self._parse_json_object(response)
             # Json validation
             if not isinstance(response_obj, dict):
                 raise ValueError("Response must be a JSON object")
@@ -103,6 +617,13 @@ class SpecializedAgent:
             
             elif self.strategy == "decentralized":
 
+                if output_key == "recommendations":
+                    # Review of a peer's response
+                    if "analysis" not in response_obj or "recommendations" not in response_obj:
+                        raise ValueError("Missing required fields")
+
+                    return json.dumps(response_obj)
+
                 if "response" not in response_obj or "analysis" not in response_obj:
                     raise ValueError("Missing required fields")
                 
@@ -111,35 +632,166 @@ class SpecializedAgent:
         except json.JSONDecodeError as e:
             raise ValueError(f"Model {self.model.model_name} returned invalid JSON format: {str(e)}")
         
-    def get_response(self, prompt: str, max_new_tokens: int = 64, temperature: float = 0.0, feedback_messages: List[Dict[str, str]] = None) -> str:
-        
+    def _build_messages(
+        self,
+        prompt: str,
+        feedback_messages: Optional[List[Dict[str, str]]] = None,
+        task: Optional[str] = None
+    ) -> List[Dict[str, str]]:
         if self.strategy == "centralized":
             if self.is_leader:
                 # Should return analysis and response while integrating feedback
-                messages = get_leader_integration_prompt(prompt, feedback_messages)
-            else:
-                # Should return analysis and recommendations
-                messages = get_feedback_prompt(prompt, list(self.harm_types))
+                return get_leader_integration_prompt(prompt, feedback_messages)
+            # Should return analysis and recommendations
+            return get_feedback_prompt(prompt, self.harm_type_list)
 
         elif self.strategy == "decentralized":
-            if feedback_messages is None:   
+            task = task or self._default_task(feedback_messages)
+            if task == RESPOND:
                 # Should return response and analysis
-                messages = get_initiale_response(prompt, list(self.harm_types))
-            else:
-                # Should return analysis and recommendations
-                messages = get_feedback_prompt(prompt, list(self.harm_types))
-        
-        response = self.model.generate(messages, max_new_tokens, temperature)
-        
-        try:
-            return self._validate_json_response(response)
-        except ValueError as e:
-            # Retry with explicit format reminder
-            print(f'Invalid JSON response: {response}')
-            retry_messages = messages + [
-                {"role": "assistant", "content": response},
-                {"role": "user", "content": "Make sure to follow the correct JSON format and use the exact same harm type keys in UPPERCASE as provided in the input list. Please reformat your response."}
+                return get_initiale_response(prompt, self.harm_type_list)
+            if task == REVISE:
+                # Should return analysis and the revised response
+                return get_revision_prompt(prompt, feedback_messages, self.harm_type_list)
+            # Should return analysis and recommendations
+            return get_feedback_prompt(prompt, self.harm_type_list)
+
+        raise ValueError(f"Unknown strategy: {self.strategy}")
+
+    def get_response(
+        self,
+        prompt: str,
+        max_new_tokens: int = 64,
+        temperature: float = 0.0,
+        feedback_messages: List[Dict[str, str]] = None,
+        task: Optional[str] = None
+    ) -> str:
+        return self.get_responses(
+            [prompt],
+            max_new_tokens,
+            temperature,
+            feedback_messages=[feedback_messages],
+            task=task
+        )[0]
+
+    def get_responses(
+        self,
+        prompts: List[str],
+        max_new_tokens: int = 64,
+        temperature: float = 0.0,
+        feedback_messages: Optional[List[Optional[List[Dict[str, str]]]]] = None,
+        return_exceptions: bool = False,
+        task: Optional[str] = None,
+        profiles: Optional[List[Optional[QueryProfile]]] = None
+    ) -> List[Union[str, Exception]]:
+        """
+        Batched counterpart of `get_response`.
+
+        Args:
+            prompts: Texts to analyze, one per query
+            feedback_messages: Optional feedback list per prompt (aligned with `prompts`)
+            return_exceptions: Return validation errors in place of the failed
+                               responses instead of raising the first one
+            task: RESPOND, REVIEW or REVISE for every prompt; defaults to the task
+                  implied by the strategy, role and feedback
+            profiles: Optional profile per prompt (aligned with `prompts`) charged
+                      with its generations, retries and timings
+
+        Returns:
+            Validated responses in the same order as `prompts`
+        """
+        if feedback_messages is None:
+            feedback_messages = [None] * len(prompts)
+
+        tasks = [task or self._default_task(feedback) for feedback in feedback_messages]
+        batch_messages = [
+            self._build_messages(prompt, feedback, prompt_task)
+            for prompt, feedback, prompt_task in zip(prompts, feedback_messages, tasks)
+        ]
+        output_keys = [self._output_key(prompt_task) for prompt_task in tasks]
+        json_schemas = None
+        if self.constrained_decoding:
+            json_schemas = [self._json_schema(prompt_task) for prompt_task in tasks]
+        profiling = profiles is not None and any(profile is not None for profile in profiles)
+        # Stats are only requested when profiling, so backends without them keep working
+        stats = {"stats": GenerationStats.for_rows(len(prompts))} if profiling else {}
+        responses = self.model.generate_batch(
+            batch_messages, max_new_tokens, temperature, json_schemas, stop_at_json_end=True, **stats
+        )
+        if profiling:
+            self._record_generations(profiles, list(range(len(prompts))), stats["stats"])
+
+        AGENT_RESPONSES.inc(len(prompts), agent=self.name)
+
+        results: List[Union[str, Exception]] = [None] * len(prompts)
+        retries = []
+        for i, response in enumerate(responses):
+            start = time.perf_counter()
+            try:
+                results[i] = self._validate_json_response(response, output_keys[i])
+            except ValueError:
+                # Retry with explicit format reminder
+                print(f'Invalid JSON response: {response}')
+                retries.append(i)
+            if profiling and profiles[i] is not None:
+                profiles[i].add(self.name, validate_seconds=time.perf_counter() - start)
+
+        if retries:
+            JSON_RETRIES.inc(len(retries), agent=self.name)
+            retry_messages = [
+                batch_messages[i] + [
+                    {"role": "assistant", "content": responses[i]},
+                    {"role": "user", "content": "Make sure to follow the correct JSON format and use the exact same harm type keys in UPPERCASE as provided in the input list. Please reformat your response."}
+                ]
+                for i in retries
             ]
-            response = self.model.generate(retry_messages, max_new_tokens, temperature)
-            return self._validate_json_response(response)
-        
\ No newline at end of file
+            retry_stats = {"stats": GenerationStats.for_rows(len(retries))} if profiling else {}
+            retried = self.model.generate_batch(
+                retry_messages,
+                max_new_tokens,
+                temperature,
+                [json_schemas[i] for i in retries] if json_schemas else None,
+                stop_at_json_end=True,
+                **retry_stats
+            )
+            if profiling:
+                self._record_generations(profiles, retries, retry_stats["stats"], retries=1)
+            for i, response in zip(retries, retried):
+                start = time.perf_counter()
+                try:
+                    results[i] = self._validate_json_response(response, output_keys[i])
+                except ValueError as e:
+                    JSON_FAILURES.inc(agent=self.name)
+                    if not return_exceptions:
+                        raise
+                    results[i] = e
+                finally:
+                    if profiling and profiles[i] is not None:
+                        profiles[i].add(self.name, validate_seconds=time.perf_counter() - start)
+
+        return results
+
+    def _record_generations(
+        self,
+        profiles: List[Optional[QueryProfile]],
+        rows: List[int],
+        stats: GenerationStats,
+        retries: int = 0
+    ) -> None:
+        """Charge each profile at `rows` with its generation; call times are split across generated rows"""
+        generated = sum(not cached for cached in stats.cached) or 1
+        for i, row in enumerate(rows):
+            profile = profiles[row]
+            if profile is None:
+                continue
+            share = 0.0 if stats.cached[i] else 1.0 / generated
+            profile.add(
+                self.name,
+                generations=1,
+                retries=retries,
+                cache_hits=int(stats.cached[i]),
+                prompt_tokens=stats.prompt_tokens[i],
+                generated_tokens=stats.generated_tokens[i],
+                prefill_seconds=stats.prefill_seconds * share,
+                decode_seconds=stats.decode_seconds * share
+            )
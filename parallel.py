@@ -0,0 +1,351 @@
+"""
+Data-parallel runner: splits the input queries across worker processes, each
+running main.py with its own copies of the models, and merges their outputs.
+
+Arguments not listed below are passed through to every worker unchanged:
+
+    python parallel.py --workers 4 --devices 0 1 2 3 \\
+        --harm-assignments config.yaml --input-file queries.jsonl --output-file outputs.json
+
+Worker k processes shard k (`main.py --num-shards N --shard-index k`) and writes
+`<work-dir>/worker-<k>-of-<N>.jsonl` with its own progress journal and log. A
+worker that exits with an error, or that skipped failed queries, is restarted with
+`--resume` up to `--max-retries` times. Once every query of the input has an
+output the worker outputs are merged into `--output-file` in input order;
+otherwise the missing query indices are reported and nothing is merged.
+
+Shards can also run on separate machines (each calling main.py with the shard
+flags and a worker output file in a shared work directory); `--merge-only` then
+merges them.
+"""
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+import argparse
+import json
+import logging
+import os
+import signal
+import subprocess
+import sys
+import time
+
+from utils.io_utils import DebiasedOutput, IOHandler
+from utils.shards import ShardedOutputWriter
+from utils.checkpoint import SHARD_STRATEGIES, progress_path_for, shard_of
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger("parallel")
+
+MAIN_SCRIPT = Path(__file__).resolve().parent / "main.py"
+
+# Worker options that would collide between workers, made unique per worker
+_PER_WORKER_PATHS = ('--metrics-file', '--profile-output')
+_PER_WORKER_PORTS = ('--metrics-port',)
+# Options the coordinator sets for each worker
+_RESERVED = ('--num-shards', '--shard-index', '--shard-by', '--output-file', '--include-metadata', '--keep-shards')
+
+
+def worker_output_path(work_dir: Path, index: int, num_workers: int) -> Path:
+    return Path(work_dir) / f"worker-{index}-of-{num_workers}.jsonl"
+
+
+def worker_args(passthrough: List[str], index: int) -> List[str]:
+    """Pass-through arguments with per-worker metrics ports and output paths"""
+    args = []
+    iterator = iter(passthrough)
+    for arg in iterator:
+        name, inline, value = arg.partition('=')
+        if name in _PER_WORKER_PATHS + _PER_WORKER_PORTS:
+            value = value if inline else next(iterator, '')
+            if name in _PER_WORKER_PORTS:
+                value = str(int(value) + index)
+            else:
+                path = Path(value)
+                value = str(path.with_name(f"{path.stem}.worker-{index}{path.suffix}"))
+            args.extend([name, value])
+        else:
+            args.append(arg)
+    return args
+
+
+class Worker:
+    """One main.py process debiasing a single shard of the input"""
+
+    def __init__(
+        self,
+        index: int,
+        num_workers: int,
+        work_dir: Path,
+        passthrough: List[str],
+        shard_by: str = 'range',
+        device: Optional[str] = None
+    ):
+        self.index = index
+        self.output_path = worker_output_path(work_dir, index, num_workers)
+        self.log_path = Path(work_dir) / f"worker-{index}.log"
+        self.journal_path = progress_path_for(self.output_path)
+        self.command = [
+            sys.executable, str(MAIN_SCRIPT), *worker_args(passthrough, index),
+            '--output-file', str(self.output_path),
+            '--include-metadata',
+            '--num-shards', str(num_workers),
+            '--shard-index', str(index),
+            '--shard-by', shard_by,
+        ]
+        # Workers log to stderr only, which goes to their own log file
+        self.env = {**os.environ, 'DEBIAS_LOG_FILE': ''}
+        if device is not None:
+            self.env['CUDA_VISIBLE_DEVICES'] = device
+        self.attempts = 0
+        self.process: Optional[subprocess.Popen] = None
+
+    def start(self, resume: bool = False) -> None:
+        command = self.command + (['--resume'] if resume and '--resume' not in self.command else [])
+        self.attempts += 1
+        with open(self.log_path, 'a', encoding='utf-8') as log:
+            self.process = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT, env=self.env)
+
+    def poll(self) -> Optional[int]:
+        return self.process.poll() if self.process is not None else None
+
+    def stop(self) -> None:
+        if self.process is not None and self.process.poll() is None:
+            self.process.send_signal(signal.SIGINT)
+            try:
+                self.process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+
+
+def run_workers(workers: List[Worker], max_retries: int = 2, resume: bool = False, poll_interval: float = 1.0) -> List[int]:
+    """
+    Run the workers to completion, restarting failed ones with `--resume`.
+
+    Returns:
+        Indices of the workers that still failed after `max_retries` restarts
+    """
+    for worker in workers:
+        worker.start(resume=resume)
+        logger.info(f"Started worker {worker.index} (pid {worker.process.pid}), logging to {worker.log_path}")
+
+    running = {worker.index: worker for worker in workers}
+    failed = []
+    try:
+        while running:
+            time.sleep(poll_interval)
+            for index, worker in list(running.items()):
+                code = worker.poll()
+                if code is None:
+                    continue
+                if code == 0 and worker.journal_path.exists() and worker.attempts <= max_retries:
+                    # Workers keep their journal when queries failed below --error-threshold
+                    logger.warning(
+                        f"Worker {index} skipped failed queries; restarting with --resume to retry them "
+                        f"(attempt {worker.attempts + 1} of {max_retries + 1})"
+                    )
+                    worker.start(resume=True)
+                elif code == 0:
+                    logger.info(f"Worker {index} finished")
+                    del running[index]
+                elif worker.attempts <= max_retries:
+                    logger.warning(
+                        f"Worker {index} exited with code {code}; restarting with --resume "
+                        f"(attempt {worker.attempts + 1} of {max_retries + 1})"
+                    )
+                    worker.start(resume=True)
+                else:
+                    logger.error(f"Worker {index} failed {worker.attempts} times; see {worker.log_path}")
+                    del running[index]
+                    failed.append(index)
+    except KeyboardInterrupt:
+        # Workers keep their journals, so the run can continue with --resume
+        logger.warning("Interrupted; stopping workers")
+        for worker in running.values():
+            worker.stop()
+        raise
+    return sorted(failed)
+
+
+def _index_lines(paths: List[Path]) -> List[Tuple[int, int, int]]:
+    """(query_index, file number, byte offset) of every output line, sorted by query index"""
+    entries = []
+    for file_number, path in enumerate(paths):
+        with open(path, 'rb') as f:
+            offset = f.tell()
+            for line in iter(f.readline, b''):
+                if line.strip():
+                    entries.append((json.loads(line)["metadata"]["query_index"], file_number, offset))
+                offset = f.tell()
+    entries.sort()
+    return entries
+
+
+def missing_queries(
+    entries: List[Tuple[int, int, int]],
+    num_shards: int,
+    input_file: str,
+    offset: int = 0,
+    limit: Optional[int] = None,
+    shard_by: str = 'range'
+) -> Dict[int, List[int]]:
+    """
+    Query indices of the selected input without an output among `entries` (see
+    `_index_lines`), by the shard they belong to.
+    """
+    written = {query_index for query_index, _, _ in entries}
+    total = sum(1 for _ in IOHandler.iter_queries(input_file, offset, limit)) if shard_by == 'range' else None
+    missing: Dict[int, List[int]] = {}
+    for position, query in enumerate(IOHandler.iter_queries(input_file, offset, limit)):
+        if offset + position not in written:
+            missing.setdefault(shard_of(position, query, num_shards, shard_by, total), []).append(offset + position)
+    return missing
+
+
+def iter_merged_outputs(paths: List[Path], entries: Optional[List[Tuple[int, int, int]]] = None) -> Iterator[DebiasedOutput]:
+    """
+    Yield the outputs of the worker files in input order.
+
+    Workers write results in completion order (a resumed worker appends reruns of
+    failed queries at the end), so only the line offsets are indexed and sorted in
+    memory (`entries`, built by `_index_lines` when not given); each output is then
+    read back with a seek.
+    """
+    files = [open(path, 'rb') for path in paths]
+    try:
+        for _, file_number, offset in entries if entries is not None else _index_lines(paths):
+            f = files[file_number]
+            f.seek(offset)
+            yield DebiasedOutput(**json.loads(f.readline()))
+    finally:
+        for f in files:
+            f.close()
+
+
+def merge_worker_outputs(
+    paths: List[Path],
+    output_file: str,
+    include_metadata: bool = False,
+    batch_size: int = 100,
+    entries: Optional[List[Tuple[int, int, int]]] = None
+) -> int:
+    """
+    Merge worker output files into `output_file` (any output format) in input
+    order, streamed through sharded batches of `batch_size` outputs.
+
+    Returns:
+        Number of merged outputs
+    """
+    writer = ShardedOutputWriter(output_file, shard_size=batch_size, include_metadata=include_metadata)
+    for output in iter_merged_outputs(paths, entries):
+        if not include_metadata:
+            # Workers always record the query index for the merge; drop it as asked
+            output.metadata = None
+        writer.write(output)
+    total = writer.count
+    writer.merge()
+    return total
+
+
+def selection_args(passthrough: List[str]) -> argparse.Namespace:
+    """The worker arguments that select the input queries"""
+    parser = argparse.ArgumentParser(add_help=False, allow_abbrev=False)
+    parser.add_argument('--input-file', type=str, default=None)
+    parser.add_argument('--offset', type=int, default=0)
+    parser.add_argument('--limit', type=int, default=None)
+    return parser.parse_known_args(passthrough)[0]
+
+
+def parse_args() -> Tuple[argparse.Namespace, List[str]]:
+    parser = argparse.ArgumentParser(
+        description='Run main.py over N worker processes, each debiasing one shard of the input',
+        epilog='Other arguments (e.g. --harm-assignments, --input-file, --resume) are passed to every worker.'
+    )
+    parser.add_argument('--workers', type=int, required=True,
+                       help='Number of worker processes (one copy of the models each)')
+    parser.add_argument('--output-file', type=str, required=True,
+                       help='Merged output file (json, jsonl, csv, pkl)')
+    parser.add_argument('--include-metadata', action='store_true',
+                       help='Keep the metadata in the merged output')
+    parser.add_argument('--shard-by', type=str, default='range', choices=list(SHARD_STRATEGIES),
+                       help='range: contiguous blocks of the input; hash: spread by query content')
+    parser.add_argument('--devices', type=str, nargs='+', default=None,
+                       help='CUDA_VISIBLE_DEVICES of each worker, assigned round-robin (e.g. "0 1 2 3" or "0,1 2,3")')
+    parser.add_argument('--work-dir', type=str, default=None,
+                       help='Directory of the worker outputs, journals and logs (default: <output-file>.workers)')
+    parser.add_argument('--max-retries', type=int, default=2,
+                       help='Restarts (with --resume) of a failed worker before giving up')
+    parser.add_argument('--merge-batch-size', type=int, default=100,
+                       help='Outputs held in memory at once while merging')
+    parser.add_argument('--merge-only', action='store_true',
+                       help='Only merge existing worker outputs from --work-dir (e.g. shards run on several machines)')
+    parser.add_argument('--keep-worker-outputs', action='store_true',
+                       help='Leave the worker outputs and journals in --work-dir after merging')
+    args, passthrough = parser.parse_known_args()
+
+    reserved = [arg for arg in passthrough if arg.partition('=')[0] in _RESERVED]
+    if reserved:
+        parser.error(f"{', '.join(reserved)} are set by the coordinator for each worker")
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    return args, passthrough
+
+
+def main():
+    args, passthrough = parse_args()
+    output_path = Path(args.output_file)
+    work_dir = Path(args.work_dir) if args.work_dir else output_path.with_name(output_path.name + ".workers")
+    work_dir.mkdir(parents=True, exist_ok=True)
+
+    paths = [worker_output_path(work_dir, index, args.workers) for index in range(args.workers)]
+    if not args.merge_only:
+        workers = [
+            Worker(
+                index, args.workers, work_dir, passthrough,
+                shard_by=args.shard_by,
+                device=args.devices[index % len(args.devices)] if args.devices else None
+            )
+            for index in range(args.workers)
+        ]
+        failed = run_workers(workers, args.max_retries, resume='--resume' in passthrough)
+        if failed:
+            logger.error(
+                f"Workers {failed} did not complete; the finished shards are kept in {work_dir}. "
+                "Rerun with --resume to continue the failed shards."
+            )
+            sys.exit(1)
+
+    missing = [str(path) for path in paths if not path.exists()]
+    if missing:
+        raise FileNotFoundError(f"Missing worker outputs: {', '.join(missing)}")
+
+    entries = _index_lines(paths)
+    selection = selection_args(passthrough)
+    if selection.input_file is None:
+        logger.warning("No --input-file given; merging without checking that every query has an output")
+    else:
+        missing = missing_queries(
+            entries, args.workers, selection.input_file, selection.offset, selection.limit, args.shard_by
+        )
+        if missing:
+            for shard, indices in sorted(missing.items()):
+                preview = ', '.join(str(index) for index in indices[:20]) + (', ...' if len(indices) > 20 else '')
+                logger.error(f"Shard {shard} has no output for {len(indices)} queries: {preview}")
+            logger.error(
+                f"Not merging; the worker outputs are kept in {work_dir}. "
+                "Rerun with --resume to retry the missing queries."
+            )
+            sys.exit(1)
+
+    total = merge_worker_outputs(paths, args.output_file, args.include_metadata, args.merge_batch_size, entries)
+    logger.info(f"Merged {total} outputs from {args.workers} workers into {args.output_file}")
+
+    if not args.keep_worker_outputs:
+        for path in paths:
+            for stale in (path, progress_path_for(path)):
+                if stale.exists():
+                    os.remove(stale)
+
+
+if __name__ == "__main__":
+    main()
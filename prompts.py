@@ -1,4 +1,5 @@
-from typing import Dict, List, Any
+from functools import lru_cache
+from typing import Dict, List, Any, Tuple
 import json
 
 
@@ -123,25 +124,29 @@ Read all the provided feedback messages carefully, integrate them with the origi
 """
 
 
-def get_feedback_prompt(response: str, harm_types: list) -> List[Dict[str, str]]:
-    """Generate a structured feedback prompt for specialized bias detection agents."""
-
-    # Construct harm type descriptions
-    harm_descriptions = "\n".join(
+@lru_cache(maxsize=None)
+def _harm_descriptions(harm_types: Tuple[str, ...]) -> str:
+    """Bulleted descriptions of the assigned harm types"""
+    return "\n".join(
         f"   – {harm}: {HARM_DESCRIPTIONS[harm].strip()}"
         for harm in harm_types
     )
 
-    # Construct JSON analysis fields for assigned harm types
-    analysis_fields = ",\n       ".join(
+
+@lru_cache(maxsize=None)
+def _analysis_fields(harm_types: Tuple[str, ...]) -> str:
+    """JSON analysis fields for the assigned harm types"""
+    return ",\n       ".join(
         f'"{harm}": "<explanation or \'none\'>"'
         for harm in harm_types
     )
 
-    return [
-        {
-            "role": "system",
-            "content": f"""You are a specialized bias detection agent responsible for analyzing and mitigating specific harm types. You have been assigned the following categories:
+
+@lru_cache(maxsize=None)
+def _feedback_system_prompt(harm_types: Tuple[str, ...]) -> str:
+    harm_descriptions = _harm_descriptions(harm_types)
+    analysis_fields = _analysis_fields(harm_types)
+    return f"""You are a specialized bias detection agent responsible for analyzing and mitigating specific harm types. You have been assigned the following categories:
 
 {harm_descriptions}
 
@@ -167,6 +172,15 @@ Guidelines:
 • Use 'none' if no bias is detected in a category.
 • Ensure strict adherence to the JSON format.
 • Use the exact same harm type keys in UPPERCASE as provided in the input list."""
+
+
+def get_feedback_prompt(response: str, harm_types: list) -> List[Dict[str, str]]:
+    """Generate a structured feedback prompt for specialized bias detection agents."""
+    return [
+        {
+            "role": "system",
+            # Static per agent, built once per harm type list
+            "content": _feedback_system_prompt(tuple(harm_types))
         },
         {
             "role": "user",
@@ -263,8 +277,45 @@ def get_leader_integration_prompt(original_response: str, feedback_messages: Lis
     return messages
 
 
+def get_revision_prompt(own_response: str, feedback_messages: List[Dict[str, str]], harm_types: list) -> List[Dict[str, str]]:
+    """
+    Constructs a prompt for a decentralized agent to revise its own debiased response
+    using the feedback its peers gave on it.
+
+    Parameters:
+    - own_response: The agent's response from the previous round.
+    - feedback_messages: Peer reviews of that response, each with an "analysis"
+                         and "recommendations".
+    - harm_types: The agent's assigned harm types.
+
+    Returns:
+    - A list of message dictionaries formatted for input to the agent LLM.
+    """
+    # Same system block as the initial response, so both tasks share a prefix
+    messages = get_initiale_response(own_response, harm_types)[:1]
+    messages.append({
+        "role": "assistant",
+        "content": f"YOUR PREVIOUS RESPONSE:\n{own_response}"
+    })
+
+    # Append each peer review
+    messages.extend(process_feedback_messages(feedback_messages))
+
+    messages.append({
+        "role": "user",
+        "content": "Please revise your previous response using the above peer feedback to produce a final debiased output in the specified JSON format."
+    })
+
+    return messages
+
+
 def get_specialized_context(harm_types: list) -> str:
     """Generate specialized context for given harm types"""
+    return _specialized_context(tuple(harm_types))
+
+
+@lru_cache(maxsize=None)
+def _specialized_context(harm_types: Tuple[str, ...]) -> str:
     harm_list = "\n".join(f"- {harm_type}: {HARM_DESCRIPTIONS[harm_type].strip()}" 
                          for harm_type in harm_types)
     
@@ -302,25 +353,11 @@ Read all the provided feedback messages carefully, integrate them with the origi
 """
 
 
-def get_initiale_response(response: str, harm_types: list) -> List[Dict[str, str]]:
-    """Generate a structured feedback prompt for specialized bias detection agents."""
-
-    # Construct harm type descriptions
-    harm_descriptions = "\n".join(
-        f"   – {harm}: {HARM_DESCRIPTIONS[harm].strip()}"
-        for harm in harm_types
-    )
-
-    # Construct JSON analysis fields for assigned harm types
-    analysis_fields = ",\n       ".join(
-        f'"{harm}": "<explanation or \'none\'>"'
-        for harm in harm_types
-    )
-
-    return [
-        {
-            "role": "system",
-            "content": f"""You are a specialized bias detection agent responsible for analyzing and mitigating specific harm types. You have been assigned the following categories:
+@lru_cache(maxsize=None)
+def _initial_response_system_prompt(harm_types: Tuple[str, ...]) -> str:
+    harm_descriptions = _harm_descriptions(harm_types)
+    analysis_fields = _analysis_fields(harm_types)
+    return f"""You are a specialized bias detection agent responsible for analyzing and mitigating specific harm types. You have been assigned the following categories:
 
 {harm_descriptions}
 
@@ -343,6 +380,15 @@ Your tasks are:
 
 Read all the provided feedback messages carefully, integrate them with the original response, and produce your final debiased output.
 """
+
+
+def get_initiale_response(response: str, harm_types: list) -> List[Dict[str, str]]:
+    """Generate a structured feedback prompt for specialized bias detection agents."""
+    return [
+        {
+            "role": "system",
+            # Static per agent, built once per harm type list
+            "content": _initial_response_system_prompt(tuple(harm_types))
         },
         {
             "role": "user",
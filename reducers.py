@@ -1,8 +1,16 @@
-from typing import List, Dict, Union, Tuple, Optional
-from models import SpecializedAgent
+from typing import Any, Callable, List, Dict, Union, Tuple, Optional
+from concurrent.futures import ThreadPoolExecutor
+from models import SpecializedAgent, RESPOND, REVIEW, REVISE
 from prompts import get_feedback_prompt, LEADER_PROMPT
+from convergence import ConvergenceChecker, MAX_ROUNDS, edit_distance, is_clean_feedback
+from topologies import REVIEW_TOPOLOGIES, full_reviews, ring_reviews, random_k_reviews, relevant_reviews
+from utils.profiling import QueryProfile
 from dataclasses import dataclass
+import functools
+import hashlib
+import json
 import random
+import time
 
 @dataclass
 class ReducerOutput:
@@ -10,147 +18,491 @@ class ReducerOutput:
     final_response: str
     lineage: Optional[List[str]] = None
     feedback: Optional[List[List[str]]] = None
+    # Convergence criterion that stopped the query, or "max_rounds"
+    stop_reason: Optional[str] = None
+    # Refinement rounds the query took part in
+    rounds: int = 0
+    # Per-agent timings and token counts (QueryProfile.to_dict) when profiling is enabled
+    profile: Optional[Dict[str, Any]] = None
+
+@dataclass
+class RoundUpdate:
+    """Progress of one query after a refinement round, for streaming"""
+    round: int
+    response: str
+    # Lineage entries added since the previous update (when lineage is returned)
+    lineage: Optional[List[str]] = None
+    # Feedback gathered this round (when feedback is returned), as in ReducerOutput.feedback
+    feedback: Optional[List[Any]] = None
+    done: bool = False
+    stop_reason: Optional[str] = None
+
+@dataclass
+class _QueryState:
+    """Progress of a single query while its batch advances round by round"""
+    query: str
+    text: str = None
+    responses: Optional[List[str]] = None
+    lineage: Optional[List[str]] = None
+    feedback: Optional[List[List[str]]] = None
+    error: Optional[Exception] = None
+    done: bool = False
+    stop_reason: Optional[str] = None
+    rounds: int = 0
+    profile: Optional[QueryProfile] = None
+    # Called with a RoundUpdate after every round the query takes part in
+    on_round: Optional[Callable[[RoundUpdate], None]] = None
+    lineage_sent: int = 0  # Lineage entries already passed to on_round
+    # Incremental refinement: last feedback of each follower and the text it analyzed
+    follower_feedback: Optional[List[str]] = None
+    follower_inputs: Optional[List[str]] = None
+
+    @property
+    def active(self) -> bool:
+        return not self.done and self.error is None
 
 class BiasReducer:
     """Base class for different debiasing strategies"""
     def __init__(self, specialized_agents: List[SpecializedAgent], config: Dict):
         self.specialized_agents = specialized_agents
         self.config = config
+        self.convergence = ConvergenceChecker.from_config(config)
+
+    def _get_feedback_batch(
+        self,
+        agent: SpecializedAgent,
+        responses: List[str],
+        feedback_messages: Optional[List[Optional[List[str]]]] = None,
+        profiles: Optional[List[Optional[QueryProfile]]] = None
+    ) -> List[Union[str, Exception]]:
 
-    def _get_feedback(self, agent: SpecializedAgent, response: str) -> str:
-        
-        return agent.get_response(
-            response,
+        return agent.get_responses(
+            responses,
             max_new_tokens=self.config['max_new_tokens'],
             temperature=self.config['temperature'],
+            feedback_messages=feedback_messages,
+            return_exceptions=True,
+            profiles=profiles
         )
 
-    def reduce_bias(self, query: str) -> str:
-        raise NotImplementedError
+    def _map_agents(self, fn: Callable[[Any], Any], agents: List[Any]) -> List[Any]:
+        """
+        Apply `fn` to every agent, concurrently when `feedback_workers` > 1.
+
+        Results keep the order of `agents` regardless of which agent finishes first,
+        so round latency becomes that of the slowest agent instead of the sum.
+        """
+        workers = min(self.config.get('feedback_workers', 1), len(agents))
+        if workers <= 1:
+            return [fn(agent) for agent in agents]
+
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="feedback") as executor:
+            return list(executor.map(fn, agents))
+
+    def _shuffle(self, items: List[Any], *key: Any) -> None:
+        """
+        Shuffle in place. With a configured `seed` the order depends only on the seed
+        and `key`, so re-runs render identical prompts whatever the batch composition.
+        """
+        seed = self.config.get('seed')
+        if seed is None:
+            random.shuffle(items)
+            return
+        digest = hashlib.sha256(json.dumps([seed, *key]).encode('utf-8')).digest()
+        random.Random(digest).shuffle(items)
+
+    def _new_states(
+        self,
+        queries: List[str],
+        return_lineage: bool,
+        return_feedback: bool,
+        on_round: Optional[Callable[[int, RoundUpdate], None]] = None
+    ) -> List[_QueryState]:
+        return [
+            _QueryState(
+                query=query,
+                text=query,
+                lineage=[] if return_lineage else None,
+                feedback=[] if return_feedback else None,
+                profile=QueryProfile() if self.config.get('profile', False) else None,
+                on_round=functools.partial(on_round, q) if on_round is not None else None
+            )
+            for q, query in enumerate(queries)
+        ]
+
+    @staticmethod
+    def _profiles(states: List[_QueryState]) -> Optional[List[Optional[QueryProfile]]]:
+        """Profiles aligned with `states`, or None when profiling is off"""
+        profiles = [state.profile for state in states]
+        return profiles if any(profile is not None for profile in profiles) else None
+
+    def _end_round(self, states: List[_QueryState], started: float) -> None:
+        seconds = time.perf_counter() - started
+        for state in states:
+            if state.profile is not None:
+                state.profile.add_round(seconds)
+            if state.on_round is not None and state.error is None:
+                lineage = None
+                if state.lineage is not None:
+                    lineage = state.lineage[state.lineage_sent:]
+                    state.lineage_sent = len(state.lineage)
+                state.on_round(RoundUpdate(
+                    round=state.rounds,
+                    response=self._current_response(state),
+                    lineage=lineage,
+                    feedback=state.feedback[-1] if state.feedback and len(state.feedback) == state.rounds else None,
+                    done=state.done,
+                    stop_reason=state.stop_reason
+                ))
+
+    def _current_response(self, state: _QueryState) -> str:
+        return state.text
+
+    def _finish(self, state: _QueryState, reason: str) -> None:
+        state.done = True
+        state.stop_reason = reason
+
+    def _output(self, state: _QueryState, final_response: str) -> ReducerOutput:
+        return ReducerOutput(
+            final_response=final_response,
+            lineage=state.lineage,
+            feedback=state.feedback,
+            stop_reason=state.stop_reason or MAX_ROUNDS,
+            rounds=state.rounds,
+            profile=state.profile.to_dict() if state.profile is not None else None
+        )
 
-class CentralizedReducer(BiasReducer):
-    """Implements leader-follower debiasing approach"""
     def reduce_bias(
-        self, 
-        query: str, 
-        return_lineage: bool = False, 
-        return_feedback: bool = False
+        self,
+        query: str,
+        return_lineage: bool = False,
+        return_feedback: bool = False,
+        on_round: Optional[Callable[[RoundUpdate], None]] = None
     ) -> Union[str, ReducerOutput]:
+        result = self.reduce_bias_batch(
+            [query], return_lineage, return_feedback,
+            on_round=(lambda _, update: on_round(update)) if on_round is not None else None
+        )[0]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def reduce_bias_batch(
+        self,
+        queries: List[str],
+        return_lineage: bool = False,
+        return_feedback: bool = False,
+        on_round: Optional[Callable[[int, RoundUpdate], None]] = None
+    ) -> List[Union[ReducerOutput, Exception]]:
+        """
+        Debias a batch of queries together, one generation call per agent and round.
+
+        Queries that converge (or fail) drop out of the batch while the rest keep going.
+        `on_round(q, update)` is called after each round of query `q` that did not fail.
+
+        Returns:
+            One ReducerOutput per query, or the exception that stopped that query
+        """
+        raise NotImplementedError
+
+class CentralizedReducer(BiasReducer):
+    """
+    Implements leader-follower debiasing approach.
+
+    With the `incremental` option a follower is only re-queried when it flagged an
+    issue in its last feedback or when the text changed by more than
+    `diff_threshold` since it last analyzed it (word-level edit distance, the measure
+    of the `edit_distance` convergence criterion); otherwise its previous feedback
+    is carried forward to the leader.
+    """
+    def _needs_feedback(self, state: _QueryState, follower: int) -> bool:
+        if not self.config.get('incremental', False):
+            return True
+        previous = state.follower_feedback[follower]
+        if previous is None or not is_clean_feedback(previous):
+            return True
+        threshold = self.config.get('diff_threshold', 0.1)
+        return edit_distance(state.follower_inputs[follower], state.text, threshold) > threshold
+
+    def _follower_feedback(self, followers: List[SpecializedAgent], active: List[_QueryState]) -> List[List[Union[str, Exception]]]:
+        """
+        Feedback of every follower on every active query, as follower_outputs[f][q].
+
+        Each follower is queried in one batch over the queries that need its feedback;
+        the others reuse the feedback it gave last time.
+        """
+        for state in active:
+            if state.follower_feedback is None:
+                state.follower_feedback = [None] * len(followers)
+                state.follower_inputs = [None] * len(followers)
+
+        def query_follower(f: int) -> List[Union[str, Exception]]:
+            outputs = [
+                None if self._needs_feedback(state, f) else state.follower_feedback[f]
+                for state in active
+            ]
+            stale = [q for q, output in enumerate(outputs) if output is None]
+            if stale:
+                fresh = self._get_feedback_batch(
+                    followers[f],
+                    [active[q].text for q in stale],
+                    profiles=self._profiles([active[q] for q in stale])
+                )
+                for q, output in zip(stale, fresh):
+                    outputs[q] = output
+                    if not isinstance(output, Exception):
+                        active[q].follower_feedback[f] = output
+                        active[q].follower_inputs[f] = active[q].text
+            return outputs
+
+        return self._map_agents(query_follower, list(range(len(followers))))
+
+    def reduce_bias_batch(
+        self,
+        queries: List[str],
+        return_lineage: bool = False,
+        return_feedback: bool = False,
+        on_round: Optional[Callable[[int, RoundUpdate], None]] = None
+    ) -> List[Union[ReducerOutput, Exception]]:
         leader = self.specialized_agents[0]
         followers = self.specialized_agents[1:]
-        
-        lineage = [] if return_lineage else None
-        feedback = [] if return_feedback else None
-    
-        for _ in range(self.config['max_rounds']):
-            feedback_messages = [self._get_feedback(f, query) for f in followers]
-            
-            if return_lineage:
-                lineage.append(query)
-            if return_feedback:
-                feedback.append(feedback_messages[:])
-                
-            random.shuffle(feedback_messages)
-
-            new_response = leader.get_response(
-                query,
+
+        states = self._new_states(queries, return_lineage, return_feedback, on_round)
+
+        for round_idx in range(self.config['max_rounds']):
+            active = [state for state in states if state.active]
+            if not active:
+                break
+            for state in active:
+                state.rounds += 1
+            round_started = time.perf_counter()
+
+            follower_outputs = self._follower_feedback(followers, active)
+
+            integrating: List[Tuple[_QueryState, List[str]]] = []
+            for i, state in enumerate(active):
+                feedback_messages = [outputs[i] for outputs in follower_outputs]
+                error = next((m for m in feedback_messages if isinstance(m, Exception)), None)
+                if error is not None:
+                    state.error = error
+                    continue
+
+                if return_lineage:
+                    state.lineage.append(state.text)
+                if return_feedback:
+                    state.feedback.append(feedback_messages[:])
+
+                reason = self.convergence.feedback_converged(feedback_messages)
+                if reason is not None:
+                    # Nothing left to fix: keep the current text without another leader pass
+                    self._finish(state, reason)
+                    continue
+
+                self._shuffle(feedback_messages, state.query, round_idx)
+                integrating.append((state, feedback_messages))
+
+            if not integrating:
+                self._end_round(active, round_started)
+                continue
+
+            new_responses = leader.get_responses(
+                [state.text for state, _ in integrating],
                 max_new_tokens=self.config['max_new_tokens'],
                 temperature=self.config['temperature'],
-                feedback_messages=feedback_messages
+                feedback_messages=[feedback_messages for _, feedback_messages in integrating],
+                return_exceptions=True,
+                profiles=self._profiles([state for state, _ in integrating])
             )
-            
-            if new_response == query:
-                break
-            query = new_response
 
-        return ReducerOutput(
-                final_response=query,
-                lineage=lineage,
-                feedback=feedback
-            )
+            for (state, _), new_response in zip(integrating, new_responses):
+                if isinstance(new_response, Exception):
+                    state.error = new_response
+                    continue
+                reason = self.convergence.texts_converged([state.text], [new_response])
+                state.text = new_response
+                if reason is not None:
+                    self._finish(state, reason)
+            self._end_round(active, round_started)
+
+        return [
+            state.error if state.error is not None else self._output(state, state.text)
+            for state in states
+        ]
 
 class DecentralizedReducer(BiasReducer):
-    """Implements decentralized debiasing approach where all agents collaborate equally"""
-    def reduce_bias(
-        self, 
-        query: str,
-        return_lineage: bool = False,
-        return_feedback: bool = False
-    ) -> Union[str, ReducerOutput]:
-        # Track progress if requested
-        lineage = [] if return_lineage else None
-        all_feedback = [] if return_feedback else None
-        
-        # Initial responses from all agents
-        responses = []
-        for agent in self.specialized_agents:
-            
-            temp = []
-            response = agent.get_response(
-                query,
-                max_new_tokens=self.config['max_new_tokens'],
-                temperature=self.config['temperature']
+    """
+    Implements decentralized debiasing approach where all agents collaborate equally.
+
+    Every round each agent reviews some of its peers' current responses, then
+    revises its own response using the reviews it received. Who reviews whom is set
+    by the `review_topology` option (see topologies.py). Each reviewer handles all of
+    its (query, author) pairs in one batched call and reviewers run concurrently, so
+    a round costs one batched review and one batched revision per agent.
+    """
+    def __init__(self, specialized_agents: List[SpecializedAgent], config: Dict):
+        super().__init__(specialized_agents, config)
+        self.review_topology = config.get('review_topology', 'full')
+        if self.review_topology not in REVIEW_TOPOLOGIES:
+            raise ValueError(
+                f"Unknown review topology: {self.review_topology} (expected one of {', '.join(REVIEW_TOPOLOGIES)})"
+            )
+        self.review_k = config.get('review_k', 2)
+
+    def _reviews(self, round_idx: int) -> List[Tuple[int, int]]:
+        """(reviewer, author) pairs reviewed in round `round_idx`"""
+        num_agents = len(self.specialized_agents)
+        if self.review_topology == 'ring':
+            return ring_reviews(num_agents)
+        if self.review_topology == 'random_k':
+            return random_k_reviews(
+                num_agents,
+                self.review_k,
+                lambda candidates, author: self._shuffle(candidates, 'review', author, round_idx)
             )
-            temp.append(response)
+        if self.review_topology == 'relevant':
+            return relevant_reviews([agent.harm_types for agent in self.specialized_agents], self.review_k)
+        return full_reviews(num_agents)
 
-        responses.append(temp)
-        if return_lineage:
-            lineage.extend(responses)
+    def reduce_bias_batch(
+        self,
+        queries: List[str],
+        return_lineage: bool = False,
+        return_feedback: bool = False,
+        on_round: Optional[Callable[[int, RoundUpdate], None]] = None
+    ) -> List[Union[ReducerOutput, Exception]]:
+        agents = self.specialized_agents
+        states = self._new_states(queries, return_lineage, return_feedback, on_round)
+
+        # Initial responses from all agents; responses[i] is agent i's current response
+        initial_responses = self._map_agents(
+            lambda agent: agent.get_responses(
+                queries,
+                max_new_tokens=self.config['max_new_tokens'],
+                temperature=self.config['temperature'],
+                return_exceptions=True,
+                task=RESPOND,
+                profiles=self._profiles(states)
+            ),
+            agents
+        )
+        for q, state in enumerate(states):
+            responses = [agent_responses[q] for agent_responses in initial_responses]
+            state.error = next((r for r in responses if isinstance(r, Exception)), None)
+            state.responses = responses
+            if return_lineage and state.error is None:
+                state.lineage.extend(responses)
 
         # Refinement rounds
-        for _ in range(self.config['max_rounds']):
-            # Collect feedback from each agent on others' responses
-            round_feedback = []
-            for i, agent in enumerate(self.specialized_agents):
-                other_responses = responses[:i] + responses[i+1:]
-                agent_feedback = []
-                
-                for resp in other_responses:
-                    feedback = agent.get_response(
-                        resp,
-                        max_new_tokens=self.config['max_new_tokens'],
-                        temperature=self.config['temperature'],
-                        feedback_messages=[]  # Empty list indicates feedback request
-                    )
-                    agent_feedback.append(feedback)
-                round_feedback.append(agent_feedback)
-            
-            if return_feedback:
-                all_feedback.append(round_feedback)
-            
-            # Generate new responses based on feedback
-            new_responses = []
-            for i, agent in enumerate(self.specialized_agents):
-                # Get feedback received for this agent's last response
-                received_feedback = []
-                for j, agent_feedback in enumerate(round_feedback):
-                    if j != i:  # Skip self-feedback
-                        # Calculate index in agent_feedback for this agent's response
-                        resp_idx = i if i < j else i - 1
-                        received_feedback.append(agent_feedback[resp_idx])
-                
-                # Generate new response considering feedback
-                new_response = agent.get_response(
-                    query,
+        for round_idx in range(self.config['max_rounds']):
+            active = [state for state in states if state.active]
+            if not active:
+                break
+            for state in active:
+                state.rounds += 1
+            round_started = time.perf_counter()
+
+            reviews = self._reviews(round_idx)
+            authors_by_reviewer = [[j for i, j in reviews if i == reviewer] for reviewer in range(len(agents))]
+
+            # One batched call per reviewer over every (query, author) pair it reviews
+            def review(reviewer: int) -> List[Union[str, Exception]]:
+                authors = authors_by_reviewer[reviewer]
+                if not authors:
+                    return []
+                return agents[reviewer].get_responses(
+                    [state.responses[j] for state in active for j in authors],
                     max_new_tokens=self.config['max_new_tokens'],
                     temperature=self.config['temperature'],
-                    feedback_messages=received_feedback
+                    return_exceptions=True,
+                    task=REVIEW,
+                    profiles=self._profiles([state for state in active for _ in authors])
                 )
-                new_responses.append(new_response)
-            
-            # Check for convergence
-            if new_responses == responses:
-                break
-                
-            responses = new_responses
-            if return_lineage:
-                lineage.extend(new_responses)
-        
-        # Select final response (most common among final responses)
-        final_response = max(set(responses), key=responses.count)
-        
-        return ReducerOutput(
-            final_response=final_response,
-            lineage=lineage,
-            feedback=all_feedback
-        ) 
\ No newline at end of file
+            review_outputs = self._map_agents(review, list(range(len(agents))))
+
+            revising = []
+            for q, state in enumerate(active):
+                # round_feedback[i] holds agent i's reviews, in the order of the authors it reviews
+                round_feedback = []
+                for reviewer, authors in enumerate(authors_by_reviewer):
+                    offset = q * len(authors)
+                    round_feedback.append(review_outputs[reviewer][offset:offset + len(authors)])
+
+                error = next(
+                    (m for reviewer_feedback in round_feedback for m in reviewer_feedback if isinstance(m, Exception)),
+                    None
+                )
+                if error is not None:
+                    state.error = error
+                    continue
+                if return_feedback:
+                    state.feedback.append(round_feedback)
+
+                reason = self.convergence.feedback_converged(
+                    [message for reviewer_feedback in round_feedback for message in reviewer_feedback]
+                )
+                if reason is not None:
+                    self._finish(state, reason)
+                    continue
+
+                # received[j] holds the reviews of agent j's response
+                received = [[] for _ in agents]
+                for reviewer, authors in enumerate(authors_by_reviewer):
+                    for author, message in zip(authors, round_feedback[reviewer]):
+                        received[author].append(message)
+                revising.append((state, received))
+
+            if not revising:
+                self._end_round(active, round_started)
+                continue
+
+            # Every agent revises its own response using the reviews it received
+            def revise(author: int) -> List[Union[str, Exception]]:
+                pending = [(q, received[author]) for q, (_, received) in enumerate(revising) if received[author]]
+                results: List[Union[str, Exception]] = [revising[q][0].responses[author] for q in range(len(revising))]
+                if not pending:
+                    return results
+                revised = agents[author].get_responses(
+                    [revising[q][0].responses[author] for q, _ in pending],
+                    max_new_tokens=self.config['max_new_tokens'],
+                    temperature=self.config['temperature'],
+                    feedback_messages=[feedback for _, feedback in pending],
+                    return_exceptions=True,
+                    task=REVISE,
+                    profiles=self._profiles([revising[q][0] for q, _ in pending])
+                )
+                for (q, _), response in zip(pending, revised):
+                    results[q] = response
+                return results
+            new_responses = self._map_agents(revise, list(range(len(agents))))
+
+            for q, (state, _) in enumerate(revising):
+                responses = [agent_responses[q] for agent_responses in new_responses]
+                error = next((r for r in responses if isinstance(r, Exception)), None)
+                if error is not None:
+                    state.error = error
+                    continue
+
+                # Check for convergence
+                reason = self.convergence.texts_converged(state.responses, responses)
+                if reason == "exact":
+                    self._finish(state, reason)
+                    continue
+
+                state.responses = responses
+                if return_lineage:
+                    state.lineage.extend(responses)
+                if reason is not None:
+                    self._finish(state, reason)
+            self._end_round(active, round_started)
+
+        results = []
+        for state in states:
+            if state.error is not None:
+                results.append(state.error)
+                continue
+            results.append(self._output(state, self._current_response(state)))
+        return results
+
+    def _current_response(self, state: _QueryState) -> str:
+        # Most common among the agents' responses, earliest agent on ties
+        return max(state.responses, key=state.responses.count)
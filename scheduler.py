@@ -0,0 +1,216 @@
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple, Union
+import queue
+import threading
+import time
+
+from models import SpecializedAgent
+from utils.profiling import QueryProfile
+
+
+@dataclass
+class _Task:
+    """One agent call (its prompts belong to a single query) waiting for a model worker"""
+    agent: SpecializedAgent
+    prompts: List[str]
+    feedback_messages: List[Optional[List[Dict[str, str]]]]
+    params: Tuple[Any, ...]  # (max_new_tokens, temperature, task); only equal params are batched
+    profiles: Optional[List[Optional[QueryProfile]]] = None
+    future: Future = field(default_factory=Future)
+
+
+class _ModelWorker:
+    """Queue and counters of the thread serving one model"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.queue: "queue.Queue[Optional[_Task]]" = queue.Queue()
+        self.thread: Optional[threading.Thread] = None
+        self.tasks = 0
+        self.batches = 0
+        self.generations = 0
+        self.busy_seconds = 0.0
+        self.max_queue_depth = 0
+
+
+class PipelineScheduler:
+    """
+    Runs agent generations from many in-flight queries on one worker thread per model.
+
+    Reducers keep their per-query logic; their agents are replaced by `ScheduledAgent`
+    proxies whose calls become tasks on the queue of the agent's model. A worker takes
+    whatever is queued (up to `max_batch` prompts) and runs compatible tasks as one
+    batched call, so while the leader integrates feedback for one query the followers'
+    models already analyze the next ones.
+
+    With `max_wait` > 0 a worker holds a batch open for up to that many seconds
+    while it is not full, so requests arriving close together (e.g. on a server)
+    share a generation call at the cost of that much added latency.
+    """
+
+    def __init__(self, agents: List[SpecializedAgent], max_batch: int = 8, max_wait: float = 0.0):
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max(0.0, max_wait)
+        self.started = time.perf_counter()
+        self._workers: Dict[int, _ModelWorker] = {}
+        for agent in agents:
+            key = id(agent.model)
+            if key not in self._workers:
+                name = agent.model.model_name
+                if any(worker.name == name for worker in self._workers.values()):
+                    name = f"{name}#{len(self._workers)}"
+                self._workers[key] = _ModelWorker(name)
+
+        for worker in self._workers.values():
+            worker.thread = threading.Thread(
+                target=self._run,
+                args=(worker,),
+                name=f"scheduler-{worker.name}",
+                daemon=True
+            )
+            worker.thread.start()
+
+    def wrap(self, agent: SpecializedAgent) -> "ScheduledAgent":
+        return ScheduledAgent(agent, self)
+
+    def submit(
+        self,
+        agent: SpecializedAgent,
+        prompts: List[str],
+        feedback_messages: List[Optional[List[Dict[str, str]]]],
+        params: Tuple[Any, ...],
+        profiles: Optional[List[Optional[QueryProfile]]] = None
+    ) -> Future:
+        task = _Task(agent, prompts, feedback_messages, params, profiles)
+        worker = self._workers[id(agent.model)]
+        worker.queue.put(task)
+        worker.max_queue_depth = max(worker.max_queue_depth, worker.queue.qsize())
+        return task.future
+
+    def _take_batch(self, worker: _ModelWorker, first: _Task) -> List[_Task]:
+        """`first` plus every task queued within `max_wait` that fits in `max_batch` prompts"""
+        batch = [first]
+        size = len(first.prompts)
+        deadline = time.perf_counter() + self.max_wait
+        while size < self.max_batch:
+            timeout = deadline - time.perf_counter()
+            try:
+                task = worker.queue.get(timeout=timeout) if timeout > 0 else worker.queue.get_nowait()
+            except queue.Empty:
+                break
+            if task is None:
+                # Keep the shutdown sentinel for the main loop
+                worker.queue.put(None)
+                break
+            batch.append(task)
+            size += len(task.prompts)
+        return batch
+
+    def _run(self, worker: _ModelWorker) -> None:
+        while True:
+            task = worker.queue.get()
+            if task is None:
+                return
+
+            # Tasks of the same agent and parameters share one generation call
+            groups: Dict[Tuple[Any, ...], List[_Task]] = {}
+            for queued in self._take_batch(worker, task):
+                groups.setdefault((id(queued.agent),) + queued.params, []).append(queued)
+
+            for tasks in groups.values():
+                start = time.perf_counter()
+                self._run_group(tasks)
+                worker.busy_seconds += time.perf_counter() - start
+                worker.batches += 1
+                worker.tasks += len(tasks)
+                worker.generations += sum(len(t.prompts) for t in tasks)
+
+    def _run_group(self, tasks: List[_Task]) -> None:
+        max_new_tokens, temperature, agent_task = tasks[0].params
+        profiles = None
+        if any(t.profiles is not None for t in tasks):
+            profiles = [
+                profile
+                for t in tasks
+                for profile in (t.profiles if t.profiles is not None else [None] * len(t.prompts))
+            ]
+        try:
+            results = tasks[0].agent.get_responses(
+                [prompt for t in tasks for prompt in t.prompts],
+                max_new_tokens=max_new_tokens,
+                temperature=temperature,
+                feedback_messages=[feedback for t in tasks for feedback in t.feedback_messages],
+                return_exceptions=True,
+                task=agent_task,
+                profiles=profiles
+            )
+        except Exception as e:
+            for t in tasks:
+                t.future.set_exception(e)
+            return
+
+        offset = 0
+        for t in tasks:
+            t.future.set_result(results[offset:offset + len(t.prompts)])
+            offset += len(t.prompts)
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """Per-model queue depth, batching and utilization since the scheduler started"""
+        elapsed = max(time.perf_counter() - self.started, 1e-9)
+        return {
+            worker.name: {
+                "queue_depth": worker.queue.qsize(),
+                "max_queue_depth": worker.max_queue_depth,
+                "tasks": worker.tasks,
+                "batches": worker.batches,
+                "mean_batch_size": worker.generations / worker.batches if worker.batches else 0.0,
+                "generations_per_sec": worker.generations / elapsed,
+                "utilization": worker.busy_seconds / elapsed,
+            }
+            for worker in self._workers.values()
+        }
+
+    def close(self) -> None:
+        for worker in self._workers.values():
+            worker.queue.put(None)
+        for worker in self._workers.values():
+            worker.thread.join()
+
+
+class ScheduledAgent:
+    """SpecializedAgent proxy whose generations run on the PipelineScheduler"""
+
+    def __init__(self, agent: SpecializedAgent, scheduler: PipelineScheduler):
+        self.agent = agent
+        self.scheduler = scheduler
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.agent, name)
+
+    def get_responses(
+        self,
+        prompts: List[str],
+        max_new_tokens: int = 64,
+        temperature: float = 0.0,
+        feedback_messages: Optional[List[Optional[List[Dict[str, str]]]]] = None,
+        return_exceptions: bool = False,
+        task: Optional[str] = None,
+        profiles: Optional[List[Optional[QueryProfile]]] = None
+    ) -> List[Union[str, Exception]]:
+        if not prompts:
+            return []
+        if feedback_messages is None:
+            feedback_messages = [None] * len(prompts)
+        results = self.scheduler.submit(
+            self.agent,
+            prompts,
+            feedback_messages,
+            (max_new_tokens, temperature, task),
+            profiles
+        ).result()
+        if not return_exceptions:
+            error = next((r for r in results if isinstance(r, Exception)), None)
+            if error is not None:
+                raise error
+        return results
@@ -0,0 +1,333 @@
+"""
+Debiasing as a long-lived local service.
+
+Loads the agents once and serves `MultiLLMDebiasing.get_debiased_response` over
+HTTP on a TCP port or a Unix socket. Every request runs on its own thread through
+the pipeline scheduler, so the generations of concurrent requests are batched
+per model; `--scheduler-max-wait-ms` holds a batch open briefly for requests that
+arrive close together.
+
+    python server.py --harm-assignments config.yaml --port 8080 --scheduler-max-wait-ms 10
+
+    curl -s localhost:8080/debias -d '{"query": "...", "return_lineage": true}'
+    curl -sN localhost:8080/debias -d '{"query": "...", "return_feedback": true, "stream": true}'
+
+Endpoints:
+    POST /debias   {"query", "return_lineage", "return_feedback", "stream"} -> the output
+                   record written by main.py (original_query, debiased_response,
+                   lineage, feedback, metadata). With "stream" the reply is
+                   newline-delimited JSON: one {"event": "round", ...} line per
+                   refinement round, then {"event": "result", ...} or {"event": "error", ...}
+    GET  /health   Strategy, agents and requests in flight
+    GET  /metrics  Prometheus metrics (see README)
+"""
+from dataclasses import asdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+from typing import Any, Callable, Dict, Optional
+import argparse
+import json
+import logging
+import os
+import threading
+import traceback
+
+from main import (
+    MultiLLMDebiasing, add_generation_arguments, build_config,
+    QUERIES, ROUNDS, STOP_REASONS,
+)
+from reducers import ReducerOutput, RoundUpdate
+from utils.io_utils import IOHandler, DebiasedOutput
+from utils.metrics import REGISTRY
+
+logger = logging.getLogger("server")
+
+INFLIGHT = REGISTRY.gauge("debias_server_inflight_requests", "Debiasing requests being processed by the server")
+WAITING = REGISTRY.gauge("debias_server_waiting_requests", "Debiasing requests waiting for a free slot (--max-inflight)")
+
+
+class DebiasingService:
+    """
+    A resident MultiLLMDebiasing shared by request threads.
+
+    At most `max_inflight` requests are debiased at once; later ones wait for a slot.
+    """
+
+    def __init__(self, debiasing: MultiLLMDebiasing, strategy: str, max_inflight: int = 16):
+        self.debiasing = debiasing
+        self.strategy = strategy
+        self._slots = threading.BoundedSemaphore(max(1, max_inflight))
+        self._lock = threading.Lock()
+        self.inflight = 0
+        self.waiting = 0
+
+    def _track(self, inflight: int = 0, waiting: int = 0) -> None:
+        with self._lock:
+            self.inflight += inflight
+            self.waiting += waiting
+            INFLIGHT.set(self.inflight)
+            WAITING.set(self.waiting)
+
+    def debias(
+        self,
+        query: str,
+        return_lineage: bool = False,
+        return_feedback: bool = False,
+        on_round: Optional[Callable[[RoundUpdate], None]] = None
+    ) -> Dict[str, Any]:
+        """Debias one query and return its output record"""
+        self._track(waiting=1)
+        with self._slots:
+            self._track(inflight=1, waiting=-1)
+            try:
+                result: ReducerOutput = self.debiasing.get_debiased_response(
+                    query, return_lineage, return_feedback, on_round
+                )
+            except Exception:
+                QUERIES.inc(status="error")
+                raise
+            finally:
+                self._track(inflight=-1)
+
+        QUERIES.inc(status="ok")
+        ROUNDS.observe(result.rounds)
+        STOP_REASONS.inc(reason=result.stop_reason)
+        metadata = {"stop_reason": result.stop_reason, "rounds": result.rounds}
+        if result.profile is not None:
+            metadata["profile"] = result.profile
+        return asdict(DebiasedOutput(
+            original_query=query,
+            debiased_response=result.final_response,
+            lineage=result.lineage,
+            feedback=result.feedback,
+            metadata=metadata
+        ))
+
+    def health(self) -> Dict[str, Any]:
+        return {
+            "status": "ok",
+            "strategy": self.strategy,
+            "agents": [agent.name for agent in self.debiasing.specialized_agents],
+            "inflight": self.inflight,
+            "waiting": self.waiting,
+        }
+
+
+class _RequestError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class _Handler(BaseHTTPRequestHandler):
+    service: DebiasingService  # Set on the subclass built by DebiasingServer
+
+    def _send_json(self, status: int, payload: Dict[str, Any]) -> None:
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_request(self) -> Dict[str, Any]:
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length) or b"{}")
+        except (ValueError, UnicodeDecodeError) as e:
+            raise _RequestError(400, f"Invalid JSON body: {e}")
+        if not isinstance(request, dict) or not isinstance(request.get("query"), str) or not request["query"].strip():
+            raise _RequestError(400, 'Expected a JSON object with a non-empty "query" string')
+        return request
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if path == '/health':
+            self._send_json(200, self.service.health())
+        elif path == '/metrics':
+            body = REGISTRY.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            self._send_json(404, {"error": f"Unknown path: {path}"})
+
+    def do_POST(self):
+        path = self.path.split('?')[0]
+        if path != '/debias':
+            self._send_json(404, {"error": f"Unknown path: {path}"})
+            return
+        try:
+            request = self._read_request()
+        except _RequestError as e:
+            self._send_json(e.status, {"error": str(e)})
+            return
+
+        args = (request["query"], bool(request.get("return_lineage")), bool(request.get("return_feedback")))
+        if request.get("stream"):
+            self._stream(*args)
+            return
+        try:
+            output = self.service.debias(*args)
+        except Exception as e:
+            self._send_json(500, {"error": str(e)})
+            return
+        self._send_json(200, output)
+
+    def _stream(self, query: str, return_lineage: bool, return_feedback: bool) -> None:
+        """Newline-delimited JSON events, written as each round of the query ends"""
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        connected = True
+
+        def send(event: Dict[str, Any]) -> None:
+            nonlocal connected
+            if not connected:
+                return
+            try:
+                self.wfile.write((json.dumps(event) + "\n").encode('utf-8'))
+                self.wfile.flush()
+            except OSError:
+                # The client went away; the query still finishes (and fills the caches)
+                connected = False
+
+        try:
+            output = self.service.debias(
+                query, return_lineage, return_feedback,
+                on_round=lambda update: send({"event": "round", **asdict(update)})
+            )
+        except Exception as e:
+            send({"event": "error", "error": str(e)})
+            return
+        send({"event": "result", **output})
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+class _UnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+class DebiasingServer:
+    """
+    HTTP front end of a DebiasingService, on `host:port` or on the Unix socket
+    `unix_socket` when given. Use `serve_forever` in the foreground, or `start` to
+    serve from a background thread (e.g. in tests).
+    """
+
+    def __init__(
+        self,
+        service: DebiasingService,
+        host: str = "127.0.0.1",
+        port: int = 8080,
+        unix_socket: Optional[str] = None
+    ):
+        self.service = service
+        self.unix_socket = unix_socket
+        handler = type("Handler", (_Handler,), {"service": service})
+        if unix_socket is not None:
+            if os.path.exists(unix_socket):
+                # Left behind by a previous server that did not shut down cleanly
+                os.remove(unix_socket)
+            self.server = _UnixHTTPServer(unix_socket, handler)
+        else:
+            self.server = ThreadingHTTPServer((host, port), handler)
+            self.server.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        if self.unix_socket is not None:
+            return f"unix:{self.unix_socket}"
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def serve_forever(self) -> None:
+        self.server.serve_forever()
+
+    def start(self) -> "DebiasingServer":
+        self._thread = threading.Thread(target=self.server.serve_forever, name="debias-server", daemon=True)
+        self._thread.start()
+        return self
+
+    def close(self) -> None:
+        """Stop accepting requests; requests in progress are not waited for"""
+        if self._thread is not None:
+            self.server.shutdown()
+            self._thread.join()
+            self._thread = None
+        self.server.server_close()
+        if self.unix_socket is not None and os.path.exists(self.unix_socket):
+            os.remove(self.unix_socket)
+
+    def __enter__(self) -> "DebiasingServer":
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Multi-LLM Debiasing service')
+    parser.add_argument('--harm-assignments', type=str, required=True,
+                       help='YAML file defining models and their harm types')
+    parser.add_argument('--host', type=str, default='127.0.0.1',
+                       help='Interface the HTTP server binds to')
+    parser.add_argument('--port', type=int, default=8080,
+                       help='Port of the HTTP server')
+    parser.add_argument('--unix-socket', type=str, default=None,
+                       help='Serve on this Unix socket instead of --host/--port')
+    parser.add_argument('--lazy-load', action='store_true',
+                       help='Load models on their first request instead of at startup')
+    parser.add_argument('--log-level', type=str, default='INFO',
+                       choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
+                       help='Set the logging level')
+    add_generation_arguments(parser)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    logger.setLevel(getattr(logging, args.log_level))
+    logging.getLogger("main").setLevel(getattr(logging, args.log_level))
+
+    harm_assignments, strategy = IOHandler.process_harm_assignments(args.harm_assignments)
+    config = build_config(args, IOHandler.load_config_options(args.harm_assignments), scheduler='pipeline')
+    debiasing = MultiLLMDebiasing(
+        harm_assignments=harm_assignments,
+        config=config,
+        strategy=strategy,
+        agent_models=IOHandler.load_agent_models(args.harm_assignments),
+        agent_backends=IOHandler.load_agent_backends(args.harm_assignments)
+    )
+    try:
+        if not args.lazy_load:
+            debiasing.preload()
+        server = DebiasingServer(
+            DebiasingService(debiasing, strategy, max_inflight=args.max_inflight),
+            host=args.host,
+            port=args.port,
+            unix_socket=args.unix_socket
+        )
+        logger.info(f"Serving {strategy} debiasing with {len(harm_assignments)} agents at {server.url}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            logger.info("Shutting down")
+        finally:
+            server.close()
+    except Exception:
+        logger.error("Fatal error in server:")
+        logger.error(traceback.format_exc())
+        raise
+    finally:
+        debiasing.close()
+
+
+if __name__ == "__main__":
+    main()
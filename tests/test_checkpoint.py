@@ -0,0 +1,181 @@
+import json
+import os
+import sys
+
+import pytest
+
+# main.py configures logging on import; keep the tests from writing logs/debiasing.log
+os.environ.setdefault('DEBIAS_LOG_FILE', '')
+
+import main
+from utils.checkpoint import ProgressJournal, progress_path_for
+from utils.io_utils import DebiasedOutput, IOHandler, JsonlOutputWriter
+from utils.shards import ShardedOutputWriter, shard_dir_for
+
+FAKE_AGENTS = """\
+a:
+  backend: fake
+  flag_rate: 0.4
+  harm_types: [DEROGATORY, DISPARATE_PERFORMANCE, ERASURE, EXCLUSIONARY, MISREPRESENTATION]
+b:
+  backend: fake
+  flag_rate: 0.4
+  harm_types: [STEREOTYPING, TOXICITY, DIRECT_DISCRIMINATION, INDIRECT_DISCRIMINATION]
+"""
+NUM_QUERIES = 10
+
+
+def output(i: int) -> DebiasedOutput:
+    return DebiasedOutput(original_query=f"query {i}", debiased_response=f"response {i}", metadata={"query_index": i})
+
+
+# ProgressJournal
+
+
+def test_journal_resume_skips_recorded_queries_and_drops_a_torn_line(tmp_path):
+    path = tmp_path / "out.jsonl.progress.jsonl"
+    journal = ProgressJournal(path)
+    for i in range(3):
+        journal.record(i, f"query {i}")
+    journal.close()
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write('{"index": 3, "ha')  # Crash mid-write
+
+    resumed = ProgressJournal(path, resume=True)
+    assert len(resumed) == 3
+    assert resumed.is_completed(2, "query 2")
+    assert not resumed.is_completed(3, "query 3")
+    with pytest.raises(ValueError):
+        resumed.is_completed(1, "a different query")
+    resumed.record(3, "query 3")
+    resumed.close()
+    assert [json.loads(line)["index"] for line in open(path, encoding='utf-8')] == [0, 1, 2, 3]
+
+
+def test_journal_memory_only_holds_resumed_entries(tmp_path):
+    journal = ProgressJournal(tmp_path / "journal.jsonl")
+    for i in range(5):
+        journal.record(i, f"query {i}")
+    assert len(journal) == 0
+    journal.remove()
+    assert not (tmp_path / "journal.jsonl").exists()
+
+
+def test_journal_output_order(tmp_path):
+    journal = ProgressJournal(tmp_path / "journal.jsonl")
+    for i in (0, 1, 2):
+        journal.record(i, f"query {i}")
+    assert journal.output_order() is None
+    for i in (5, 3):
+        journal.record(i, f"query {i}")
+    assert journal.output_order() == [0, 1, 2, 4, 3]
+
+
+# Output writers
+
+
+def test_jsonl_writer_truncate_and_reorder(tmp_path):
+    path = tmp_path / "out.jsonl"
+    writer = JsonlOutputWriter(path, append=False)
+    for i in (0, 2, 1, 3):
+        writer.write(output(i))
+    writer.truncate(3)
+    writer.reorder([0, 2, 1])
+    assert [o.metadata["query_index"] for o in IOHandler.load_outputs(path)] == [0, 1, 2]
+
+
+@pytest.mark.parametrize("suffix", [".json", ".jsonl", ".csv", ".pkl"])
+def test_sharded_writer_resumes_after_a_crash(tmp_path, suffix):
+    path = tmp_path / f"out{suffix}"
+    writer = ShardedOutputWriter(path, shard_size=3)
+    for i in range(7):
+        writer.write(output(i))
+    # Crash: the partial shard only exists in its staging file
+    del writer
+
+    resumed = ShardedOutputWriter(path, shard_size=3, resume=True)
+    assert resumed.count == 7
+    # The journal trailed by one output; it reruns
+    resumed.truncate(6)
+    for i in range(6, 10):
+        resumed.write(output(i))
+    resumed.merge()
+    assert [o.original_query for o in IOHandler.load_outputs(path)] == [f"query {i}" for i in range(10)]
+    assert not shard_dir_for(path).exists()
+
+
+@pytest.mark.parametrize("suffix", [".json", ".jsonl", ".csv", ".pkl"])
+def test_sharded_merge_in_order(tmp_path, suffix):
+    path = tmp_path / f"out{suffix}"
+    writer = ShardedOutputWriter(path, shard_size=2)
+    written = [0, 1, 3, 4, 6, 7, 2, 5]
+    for i in written:
+        writer.write(output(i))
+    writer.merge(order=sorted(range(len(written)), key=written.__getitem__))
+    assert [o.original_query for o in IOHandler.load_outputs(path)] == [f"query {i}" for i in range(8)]
+
+
+# main.py runs with the fake backend
+
+
+@pytest.fixture
+def run(tmp_path, monkeypatch):
+    """Run main.py on NUM_QUERIES queries, failing the given indices or crashing after some results"""
+    agents = tmp_path / "agents.yaml"
+    agents.write_text(FAKE_AGENTS, encoding='utf-8')
+    queries = tmp_path / "queries.jsonl"
+    queries.write_text("".join(json.dumps(f"query {i}") + "\n" for i in range(NUM_QUERIES)), encoding='utf-8')
+    original = main.MultiLLMDebiasing.iter_debiased_responses
+
+    def _run(output_file, resume=False, fail=(), crash_after=None):
+        def iter_debiased_responses(self, pending, *args, **kwargs):
+            for count, (item, result) in enumerate(original(self, pending, *args, **kwargs)):
+                if crash_after is not None and count == crash_after:
+                    raise RuntimeError("crash")
+                yield item, RuntimeError("failed") if item[0] in fail else result
+
+        monkeypatch.setattr(main.MultiLLMDebiasing, "iter_debiased_responses", iter_debiased_responses)
+        monkeypatch.setattr(sys, "argv", [
+            "main.py", "--harm-assignments", str(agents), "--input-file", str(queries),
+            "--output-file", str(output_file), "--batch-size", "3", "--log-level", "WARNING",
+        ] + (["--resume"] if resume else []))
+        main.main()
+
+    return _run
+
+
+def assert_complete(output_file):
+    outputs = IOHandler.load_outputs(output_file)
+    assert [o.original_query for o in outputs] == [f"query {i}" for i in range(NUM_QUERIES)]
+    assert not progress_path_for(output_file).exists()
+    assert not shard_dir_for(output_file).exists() or output_file.suffix == '.jsonl'
+
+
+@pytest.mark.parametrize("suffix", [".json", ".jsonl", ".csv"])
+def test_resume_after_a_crash(tmp_path, run, suffix):
+    output_file = tmp_path / f"out{suffix}"
+    with pytest.raises(RuntimeError, match="crash"):
+        run(output_file, crash_after=7)
+    assert progress_path_for(output_file).exists()
+    run(output_file, resume=True)
+    assert_complete(output_file)
+
+
+@pytest.mark.parametrize("suffix", [".json", ".jsonl", ".csv"])
+def test_resume_retries_failed_queries(tmp_path, run, suffix):
+    output_file = tmp_path / f"out{suffix}"
+    run(output_file, fail={4, 8})
+    # The failed queries are kept for --resume, and the outputs are not merged yet
+    assert progress_path_for(output_file).exists()
+    if suffix != '.jsonl':
+        assert shard_dir_for(output_file).exists()
+    run(output_file, resume=True)
+    assert_complete(output_file)
+
+
+def test_resume_of_a_completed_run_is_a_no_op(tmp_path, run):
+    output_file = tmp_path / "out.json"
+    run(output_file)
+    before = output_file.read_bytes()
+    run(output_file, resume=True)
+    assert output_file.read_bytes() == before
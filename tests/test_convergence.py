@@ -0,0 +1,62 @@
+import random
+
+import pytest
+
+from convergence import _tokens, edit_distance
+
+
+def reference_distance(text1: str, text2: str) -> float:
+    """Unbanded word-level Levenshtein DP, normalized like `edit_distance`"""
+    words1, words2 = _tokens(text1), _tokens(text2)
+    if not words1 and not words2:
+        return 0.0
+    previous = list(range(len(words2) + 1))
+    for i, word1 in enumerate(words1, start=1):
+        current = [i]
+        for j, word2 in enumerate(words2, start=1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (word1 != word2)))
+        previous = current
+    return previous[-1] / max(len(words1), len(words2))
+
+
+def random_text(rng: random.Random) -> str:
+    return " ".join(rng.choice("a b c d e f".split()) for _ in range(rng.randint(0, 15)))
+
+
+def test_unbounded_matches_reference():
+    rng = random.Random(0)
+    for _ in range(500):
+        text1, text2 = random_text(rng), random_text(rng)
+        assert edit_distance(text1, text2) == pytest.approx(reference_distance(text1, text2))
+
+
+@pytest.mark.parametrize("max_distance", [0.0, 0.05, 0.1, 0.25, 0.5, 1.0])
+def test_bounded_is_exact_within_bound_and_above_it_otherwise(max_distance):
+    rng = random.Random(1)
+    for _ in range(500):
+        text1, text2 = random_text(rng), random_text(rng)
+        expected = reference_distance(text1, text2)
+        distance = edit_distance(text1, text2, max_distance)
+        if expected <= max_distance:
+            assert distance == pytest.approx(expected)
+        else:
+            assert distance > max_distance
+
+
+def test_small_edits_of_long_texts():
+    words = [f"w{i}" for i in range(400)]
+    edited = list(words)
+    edited[10] = "x"
+    del edited[200]
+    edited.insert(300, "y")
+    text1, text2 = " ".join(words), " ".join(edited)
+    expected = reference_distance(text1, text2)
+    assert edit_distance(text1, text2, 0.05) == pytest.approx(expected)
+    assert edit_distance(text1, text2, 0.001) > 0.001
+
+
+def test_edge_cases():
+    assert edit_distance("", "") == 0.0
+    assert edit_distance("Same words.", "same, WORDS") == 0.0
+    assert edit_distance("", "a b") == 1.0
+    assert edit_distance("a b", "", 0.1) > 0.1
@@ -0,0 +1,137 @@
+import json
+
+import pytest
+
+from decoding import (
+    AllowedTokenCache, JsonSchema, JsonTemplateMachine, build_token_texts, truncate_after_json_object
+)
+
+RESPONSE = JsonSchema(("BIAS", "TOXICITY"))
+RECOMMENDATIONS = JsonSchema(("BIAS",), output_key="recommendations")
+
+
+def machine(schema: JsonSchema = RESPONSE) -> JsonTemplateMachine:
+    return JsonTemplateMachine(schema.template())
+
+
+def accepts_all(schema: JsonSchema, text: str) -> bool:
+    state = machine(schema)
+    return state.feed(text) and state.complete
+
+
+@pytest.mark.parametrize("text", [
+    '{"analysis": {"BIAS": "none", "TOXICITY": "none"}, "response": "ok"}',
+    '{"analysis": {"BIAS": "say \\"hi\\"", "TOXICITY": "a\\\\b"}, "response": "line\\nbreak"}',
+    '{"analysis": {"BIAS": "\\u00e9\\uABCD", "TOXICITY": ""}, "response": "\\/\\b\\f\\r\\t"}',
+    '{"analysis": {"BIAS": "café — \U0001F600", "TOXICITY": "}{]["}, "response": ""}',
+])
+def test_accepts_valid_response_objects(text):
+    assert accepts_all(RESPONSE, text)
+    json.loads(text)
+
+
+@pytest.mark.parametrize("text", [
+    '{"analysis": {"BIAS": "none"}, "recommendations": []}',
+    '{"analysis": {"BIAS": "none"}, "recommendations": ["a"]}',
+    '{"analysis": {"BIAS": "none"}, "recommendations": ["a", "b \\"c\\"", "\\u0041"]}',
+    '{"analysis": {"BIAS": "none"}, "recommendations": ["a","b"]}',
+])
+def test_accepts_valid_arrays(text):
+    assert accepts_all(RECOMMENDATIONS, text)
+    json.loads(text)
+
+
+@pytest.mark.parametrize("text", [
+    '{"analysis": {"TOXICITY": "none"',                    # Keys in the wrong order
+    '{"analysis": {"BIAS": "raw\nnewline"',                # Unescaped control character
+    '{"analysis": {"BIAS": "bad \\x escape"',              # Unknown escape
+    '{"analysis": {"BIAS": "\\u12G4"',                      # Non-hex digit in \u escape
+    '{"analysis": {"BIAS": "none", "TOXICITY": "none"}, "response": "ok"}}',  # Past the end
+    "{'analysis'",                                          # Single quotes
+])
+def test_rejects_invalid_response_text(text):
+    assert not machine(RESPONSE).feed(text)
+
+
+@pytest.mark.parametrize("text", [
+    '{"analysis": {"BIAS": "none"}, "recommendations": "a"',     # String instead of array
+    '{"analysis": {"BIAS": "none"}, "recommendations": ["a",]',  # Trailing comma
+    '{"analysis": {"BIAS": "none"}, "recommendations": ["a"  ]',  # Space before ]
+    '{"analysis": {"BIAS": "none"}, "recommendations": [1]',     # Non-string item
+])
+def test_rejects_invalid_arrays(text):
+    assert not machine(RECOMMENDATIONS).feed(text)
+
+
+def test_accepts_does_not_change_state():
+    state = machine()
+    assert state.feed('{"analysis": {"BIAS": "')
+    before = state.state
+    assert state.accepts('abc\\')
+    assert not state.accepts('\n')
+    assert state.state == before
+
+
+@pytest.mark.parametrize("schema,prefix", [
+    (RESPONSE, ''),
+    (RESPONSE, '{"analysis": {"BIAS": "half'),
+    (RESPONSE, '{"analysis": {"BIAS": "esc \\'),
+    (RESPONSE, '{"analysis": {"BIAS": "\\u0'),
+    (RESPONSE, '{"analysis": {"BIAS": "a", "TOXICITY": "b"}, "resp'),
+    (RECOMMENDATIONS, '{"analysis": {"BIAS": "a"}, "recommendations": '),
+    (RECOMMENDATIONS, '{"analysis": {"BIAS": "a"}, "recommendations": ["x", '),
+    (RECOMMENDATIONS, '{"analysis": {"BIAS": "a"}, "recommendations": ["x",'),
+    (RECOMMENDATIONS, '{"analysis": {"BIAS": "a"}, "recommendations": ["x"'),
+])
+def test_completion_closes_the_template(schema, prefix):
+    state = machine(schema)
+    assert state.feed(prefix)
+    completion = state.completion()
+    assert accepts_all(schema, prefix + completion)
+    json.loads(prefix + completion)
+
+
+@pytest.mark.parametrize("text,expected", [
+    ('{"a": 1} trailing', '{"a": 1}'),
+    ('```json\n{"a": {"b": "}"}}\n```', '```json\n{"a": {"b": "}"}}'),
+    ('{"a": "\\"}"} x', '{"a": "\\"}"}'),
+    ('{"a": "\\\\"} x', '{"a": "\\\\"}'),
+    ('no object "{" here', 'no object "{" here'),
+    ('{"unterminated": "', '{"unterminated": "'),
+])
+def test_truncate_after_json_object(text, expected):
+    assert truncate_after_json_object(text) == expected
+
+
+def test_allowed_tokens_match_a_full_scan():
+    vocab = ['', '{"', 'analysis', '": {"', 'BIAS', '": "', '"', 'x', '\\', 'u', '0', '", "', ' ', '}', '}, "', 'response', 'a"b']
+    cache = AllowedTokenCache(vocab)
+    state = machine()
+    for token in ['{"', 'analysis', '": {"', 'BIAS', '": "', 'x', '\\']:
+        expected = [token_id for token_id, text in enumerate(vocab) if state.accepts(text)]
+        assert sorted(cache.allowed(state)) == expected
+        assert state.feed(token)
+    assert [vocab[token_id] for token_id in cache.prefixes('", "TOX')] == ['"', '", "']
+
+
+class SentencePieceLike:
+    """Drops the leading space of a decoded sequence, like Llama/Mistral tokenizers"""
+    vocab = ['<s>', '▁a', ',', '▁', '▁"', '":', 'x']
+    all_special_ids = [0]
+
+    def __len__(self):
+        return len(self.vocab)
+
+    def encode(self, text, add_special_tokens=False):
+        return [1]
+
+    def decode(self, ids, clean_up_tokenization_spaces=True):
+        text = ''.join(self.vocab[i] for i in ids if i not in self.all_special_ids).replace('▁', ' ')
+        return text[1:] if text.startswith(' ') else text
+
+    def batch_decode(self, batch, **kwargs):
+        return [self.decode(ids, **kwargs) for ids in batch]
+
+
+def test_token_texts_keep_leading_spaces():
+    assert build_token_texts(SentencePieceLike()) == ['', ' a', ',', ' ', ' "', '":', 'x']
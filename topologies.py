@@ -0,0 +1,64 @@
+from typing import Callable, List, Set, Tuple
+
+# (reviewer, author) index pairs reviewed in a round
+ReviewPairs = List[Tuple[int, int]]
+
+REVIEW_TOPOLOGIES = ('full', 'ring', 'random_k', 'relevant')
+
+
+def full_reviews(num_agents: int) -> ReviewPairs:
+    """Every agent reviews every other agent: n·(n−1) reviews"""
+    return [(i, j) for i in range(num_agents) for j in range(num_agents) if i != j]
+
+
+def ring_reviews(num_agents: int) -> ReviewPairs:
+    """Agent i reviews agent i+1 (wrapping around): n reviews"""
+    if num_agents < 2:
+        return []
+    return [(i, (i + 1) % num_agents) for i in range(num_agents)]
+
+
+def random_k_reviews(num_agents: int, k: int, shuffle: Callable[[List[int], int], None]) -> ReviewPairs:
+    """
+    Every author is reviewed by `k` peers drawn at random: n·k reviews.
+
+    Args:
+        shuffle: Shuffles an author's candidate reviewers in place; called as
+                 `shuffle(candidates, author)` so the draw can be seeded per author
+    """
+    pairs = []
+    for author in range(num_agents):
+        candidates = [i for i in range(num_agents) if i != author]
+        shuffle(candidates, author)
+        pairs.extend((reviewer, author) for reviewer in sorted(candidates[:k]))
+    return sorted(pairs)
+
+
+def relevant_reviews(harm_types: List[Set[str]], k: int) -> ReviewPairs:
+    """
+    Every author is reviewed by the peers covering the harm types it is not assigned.
+
+    Reviewers are picked greedily by how many still uncovered harm types they add,
+    up to `k` per author. An author whose assignment covers every harm type of its
+    peers falls back to its ring reviewer.
+    """
+    num_agents = len(harm_types)
+    pairs = []
+    for author in range(num_agents):
+        uncovered = set().union(*harm_types) - harm_types[author]
+        reviewers = []
+        while uncovered and len(reviewers) < k:
+            gains = [
+                (len(harm_types[i] & uncovered), -i)
+                for i in range(num_agents)
+                if i != author and i not in reviewers
+            ]
+            if not gains or max(gains)[0] == 0:
+                break
+            reviewer = -max(gains)[1]
+            reviewers.append(reviewer)
+            uncovered -= harm_types[reviewer]
+        if not reviewers and num_agents > 1:
+            reviewers = [(author - 1) % num_agents]
+        pairs.extend((reviewer, author) for reviewer in reviewers)
+    return sorted(pairs)
@@ -1,9 +1,13 @@
 from typing import Optional
 import os
-from huggingface_hub import login, HfApi, HfFolder
+import threading
 import yaml
 from pathlib import Path
 
+# Outcome of the first authentication attempt, shared by every model of the process
+_auth_result: Optional[bool] = None
+_auth_lock = threading.Lock()
+
 def setup_hf_auth(token: Optional[str] = None, token_path: str = "config/hf_token.yml") -> bool:
     """Setup Hugging Face authentication using token
     
@@ -50,6 +54,8 @@ def setup_hf_auth(token: Optional[str] = None, token_path: str = "config/hf_toke
                 f"Searched paths: {possible_paths}"
             )
             
+        from huggingface_hub import login, HfApi, HfFolder
+
         # Login to HF
         login(token=hf_token)
         
@@ -64,4 +70,29 @@ def setup_hf_auth(token: Optional[str] = None, token_path: str = "config/hf_toke
         
     except Exception as e:
         print(f"Error setting up HF authentication: {str(e)}")
-        return False 
\ No newline at end of file
+        return False
+
+
+def is_offline() -> bool:
+    """Whether the Hugging Face Hub must not be contacted"""
+    return any(
+        os.environ.get(variable, "").upper() in ("1", "ON", "YES", "TRUE")
+        for variable in ("HF_HUB_OFFLINE", "TRANSFORMERS_OFFLINE")
+    )
+
+
+def ensure_hf_auth(model_name: Optional[str] = None) -> bool:
+    """
+    Authenticate with Hugging Face at most once per process.
+
+    Skipped (returns True) when running offline or when `model_name` is a local
+    checkpoint directory; otherwise the first call runs `setup_hf_auth` and every
+    later call reuses its result.
+    """
+    global _auth_result
+    if is_offline() or (model_name is not None and os.path.isdir(model_name)):
+        return True
+    with _auth_lock:
+        if _auth_result is None:
+            _auth_result = setup_hf_auth()
+        return _auth_result
@@ -0,0 +1,129 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Dict, List, Optional, Union
+
+SHARD_STRATEGIES = ('range', 'hash')
+
+
+def query_hash(query: str) -> str:
+    """Short content hash used to check that a journaled index still maps to the same query"""
+    return hashlib.sha1(query.encode('utf-8')).hexdigest()[:16]
+
+
+def shard_of(position: int, query: str, num_shards: int, shard_by: str = 'range', total: Optional[int] = None) -> int:
+    """
+    Worker shard (0..num_shards-1) a query belongs to.
+
+    `range` splits the `total` queries into contiguous blocks by their position in the
+    selected input; `hash` spreads them by content, which needs no count up front and
+    keeps a query on the same shard however the input is reordered.
+    """
+    if shard_by == 'range':
+        if total is None:
+            raise ValueError("Range sharding needs the total number of queries")
+        return min(position * num_shards // max(total, 1), num_shards - 1)
+    if shard_by == 'hash':
+        return int(query_hash(query), 16) % num_shards
+    raise ValueError(f"Unknown shard strategy: {shard_by} (expected one of {', '.join(SHARD_STRATEGIES)})")
+
+
+def progress_path_for(output_file: Union[str, Path]) -> Path:
+    """Location of the progress journal that belongs to an output file"""
+    output_path = Path(output_file)
+    return output_path.with_name(output_path.name + ".progress.jsonl")
+
+
+class ProgressJournal:
+    """
+    Append-only record of the queries whose outputs have been persisted.
+
+    Each completed query is journaled as one flushed JSON line holding its input
+    index and content hash, so a restarted run can skip finished work; with
+    `fsync` every line is also synced to disk, surviving power loss as well as a
+    crashed process. Entries are written only after the matching output was
+    written, which means the journal can trail the outputs by at most the output
+    being written during a crash.
+
+    Only the entries loaded on resume are kept in memory (queries finished by this
+    run are never looked up again), so memory does not grow with the input.
+    """
+
+    def __init__(self, path: Union[str, Path], resume: bool = False, fsync: bool = False):
+        self.path = Path(path)
+        self.fsync = fsync
+        # Entries of the interrupted run, loaded with `resume`
+        self.completed: Dict[int, str] = {}
+
+        if resume and self.path.exists():
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Torn final line from a crash mid-write
+                        break
+                    self.completed[entry["index"]] = entry["hash"]
+            # Rewrite without a possibly torn tail before appending again
+            self._rewrite()
+
+        self._file = open(self.path, 'a' if resume else 'w', encoding='utf-8')
+
+    def __len__(self) -> int:
+        """Number of queries completed by the interrupted run"""
+        return len(self.completed)
+
+    def _rewrite(self) -> None:
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for index, digest in self.completed.items():
+                f.write(json.dumps({"index": index, "hash": digest}) + "\n")
+        os.replace(tmp_path, self.path)
+
+    def is_completed(self, index: int, query: str) -> bool:
+        """
+        Whether the query at `index` was already processed.
+
+        Raises:
+            ValueError: If the journaled query at this index differs (the input changed)
+        """
+        digest = self.completed.get(index)
+        if digest is None:
+            return False
+        if digest != query_hash(query):
+            raise ValueError(
+                f"Query {index} does not match the progress journal {self.path}; "
+                "the input file changed since the interrupted run"
+            )
+        return True
+
+    def output_order(self) -> Optional[List[int]]:
+        """
+        Positions of the journaled outputs sorted by query index, or None if they
+        were written in input order (always, unless a resumed run retried queries
+        that had failed).
+        """
+        indices = []
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                indices.append(json.loads(line)["index"])
+        if all(previous < index for previous, index in zip(indices, indices[1:])):
+            return None
+        return sorted(range(len(indices)), key=indices.__getitem__)
+
+    def record(self, index: int, query: str) -> None:
+        self._file.write(json.dumps({"index": index, "hash": query_hash(query)}) + "\n")
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+
+    def close(self) -> None:
+        if not self._file.closed:
+            self._file.close()
+
+    def remove(self) -> None:
+        """Delete the journal once the run it tracks has completed"""
+        self.close()
+        if self.path.exists():
+            os.remove(self.path)
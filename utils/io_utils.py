@@ -1,12 +1,17 @@
 import json
 import csv
+import os
 import pickle
 import yaml
+from itertools import islice
 from pathlib import Path
-from typing import List, Union, Dict, Any, Tuple
+from typing import IO, Iterator, List, Optional, Union, Dict, Any, Tuple
 from dataclasses import dataclass, asdict
 from prompts import HARM_DESCRIPTIONS
-import pandas as pd
+
+# Reserved top-level key of the harm assignments YAML holding run options
+OPTIONS_KEY = 'options'
+CONFIG_OPTIONS = ('review_topology', 'review_k')
 
 @dataclass
 class DebiasedOutput:
@@ -26,7 +31,7 @@ class IOHandler:
         Load queries from various file formats.
         
         Args:
-            input_file: Path to input file (supports .json, .csv, .pkl, .txt)
+            input_file: Path to input file (supports .json, .jsonl, .csv, .pkl, .txt)
             
         Returns:
             List of query strings
@@ -50,6 +55,8 @@ class IOHandler:
                     raise ValueError("Invalid JSON format: Expected a list or dict with 'queries' key")
                     
         elif input_path.suffix == '.csv':
+            import pandas as pd
+
             data = pd.read_csv(input_path)
             if "query" in data.columns:
                 return data["query"].tolist()
@@ -63,7 +70,8 @@ class IOHandler:
                     return data
                 elif isinstance(data, dict) and "queries" in data:
                     return data["queries"]
-                elif isinstance(data, pd.DataFrame) and "query" in data.columns:
+                elif "query" in getattr(data, "columns", ()):
+                    # pandas DataFrame (unpickling it already imported pandas)
                     return data["query"].tolist()
                 else:
                     raise ValueError("Invalid pickle format: Expected a list or dict with 'queries' key, or a pandas DataFrame with 'query' column")
@@ -71,10 +79,62 @@ class IOHandler:
         elif input_path.suffix == '.txt':
             with open(input_path, 'r', encoding='utf-8') as f:
                 return [line.strip() for line in f if line.strip()]
+
+        elif input_path.suffix == '.jsonl':
+            return list(IOHandler.iter_queries(input_path))
                 
         else:
             raise ValueError(f"Unsupported file format: {input_path.suffix}")
 
+    @staticmethod
+    def _parse_jsonl_query(line: str, line_number: int) -> str:
+        record = json.loads(line)
+        if isinstance(record, str):
+            return record
+        elif isinstance(record, dict) and "query" in record:
+            return record["query"]
+        raise ValueError(f"Invalid JSONL record on line {line_number}: Expected a string or an object with 'query' key")
+
+    @staticmethod
+    def iter_queries(
+        input_file: Union[str, Path],
+        offset: int = 0,
+        limit: Optional[int] = None
+    ) -> Iterator[str]:
+        """
+        Lazily yield queries, optionally skipping the first `offset` rows and
+        stopping after `limit` rows.
+
+        `.jsonl` files (one JSON string or {"query": ...} object per line) are read
+        line by line in constant memory; other formats are loaded with `load_queries`.
+
+        Args:
+            input_file: Path to input file
+            offset: Number of leading queries to skip
+            limit: Maximum number of queries to yield (None for no limit)
+
+        Yields:
+            Query strings
+        """
+        input_path = Path(input_file)
+        stop = None if limit is None else offset + limit
+
+        if input_path.suffix != '.jsonl':
+            yield from islice(IOHandler.load_queries(input_path), offset, stop)
+            return
+
+        if not input_path.exists():
+            raise FileNotFoundError(f"Input file not found: {input_file}")
+
+        with open(input_path, 'r', encoding='utf-8') as f:
+            rows = (
+                (line_number, line)
+                for line_number, line in enumerate(f, start=1)
+                if line.strip()
+            )
+            for line_number, line in islice(rows, offset, stop):
+                yield IOHandler._parse_jsonl_query(line, line_number)
+
     @staticmethod
     def save_outputs(
         outputs: List[DebiasedOutput],
@@ -86,7 +146,7 @@ class IOHandler:
         
         Args:
             outputs: List of DebiasedOutput objects
-            output_file: Path to output file (supports .json, .csv, .pkl)
+            output_file: Path to output file (supports .json, .jsonl, .csv, .pkl)
             include_metadata: Whether to include metadata in output
             
         Raises:
@@ -108,16 +168,10 @@ class IOHandler:
             if not outputs:
                 return
                 
-            fieldnames = ['original_query', 'debiased_response']
-            if any(o.lineage for o in outputs):
-                fieldnames.append('lineage')
-            if any(o.feedback for o in outputs):
-                fieldnames.append('feedback')
-            if include_metadata and any(o.metadata for o in outputs):
-                fieldnames.append('metadata')
+            fieldnames = IOHandler.csv_fieldnames(outputs, include_metadata)
                 
             with open(output_path, 'w', newline='', encoding='utf-8') as f:
-                writer = csv.DictWriter(f, fieldnames=fieldnames)
+                writer = csv.DictWriter(f, fieldnames=fieldnames, extrasaction='ignore')
                 writer.writeheader()
                 for output_dict in output_dicts:
                     # Convert lists to strings for CSV
@@ -132,10 +186,55 @@ class IOHandler:
         elif output_path.suffix == '.pkl':
             with open(output_path, 'wb') as f:
                 pickle.dump(outputs, f)
+
+        elif output_path.suffix == '.jsonl':
+            with JsonlOutputWriter(output_path, include_metadata=include_metadata, append=False) as writer:
+                for output in outputs:
+                    writer.write(output)
                 
         else:
             raise ValueError(f"Unsupported output format: {output_path.suffix}")
 
+    @staticmethod
+    def csv_fieldnames(outputs: List[DebiasedOutput], include_metadata: bool = True) -> List[str]:
+        """CSV columns needed for a list of outputs (optional columns only when populated)"""
+        fieldnames = ['original_query', 'debiased_response']
+        if any(o.lineage for o in outputs):
+            fieldnames.append('lineage')
+        if any(o.feedback for o in outputs):
+            fieldnames.append('feedback')
+        if include_metadata and any(o.metadata for o in outputs):
+            fieldnames.append('metadata')
+        return fieldnames
+
+    @staticmethod
+    def _load_harm_config(config_path: Union[str, Path]) -> Tuple[Dict[str, Dict], Dict[str, Any]]:
+        """Split the harm assignments YAML into its agent entries and its reserved `options` block"""
+        with open(config_path) as f:
+            harm_config = yaml.safe_load(f)
+        options = harm_config.pop(OPTIONS_KEY, None) or {}
+        return harm_config, options
+
+    @staticmethod
+    def load_config_options(config_path: Union[str, Path]) -> Dict[str, Any]:
+        """
+        Read the optional `options` block of the harm assignments YAML.
+
+        Supported keys:
+            review_topology: Decentralized review topology (full, ring, random_k, relevant)
+            review_k: Reviewers per author for random_k and relevant
+
+        Raises:
+            ValueError: If the block holds unknown keys
+        """
+        _, options = IOHandler._load_harm_config(config_path)
+        if not isinstance(options, dict):
+            raise ValueError(f"'{OPTIONS_KEY}' must be a mapping")
+        unknown = set(options) - set(CONFIG_OPTIONS)
+        if unknown:
+            raise ValueError(f"Unknown options in {config_path}: {sorted(unknown)}")
+        return options
+
     @staticmethod
     def process_harm_assignments(config_path: Union[str, Path]) -> Tuple[Dict[str, List[str]], str]:
         """
@@ -159,8 +258,7 @@ class IOHandler:
         if config_path.suffix != '.yaml' and config_path.suffix != '.yml':
             raise ValueError("Config file must be YAML format")
 
-        with open(config_path) as f:
-            harm_config = yaml.safe_load(f)
+        harm_config, _ = IOHandler._load_harm_config(config_path)
         
         harm_assignments = {
             model: config['harm_types']
@@ -195,6 +293,42 @@ class IOHandler:
         
         return harm_assignments, strategy
 
+    @staticmethod
+    def load_agent_models(config_path: Union[str, Path]) -> Dict[str, str]:
+        """
+        Map every agent entry of the harm assignments YAML to the checkpoint it runs.
+
+        An entry may name its checkpoint with an optional `model` key, which lets one
+        checkpoint play several roles; otherwise the entry key is the checkpoint name.
+
+        Returns:
+            Dictionary of agent name -> model checkpoint
+        """
+        harm_config, _ = IOHandler._load_harm_config(config_path)
+
+        return {
+            agent: config.get('model', agent)
+            for agent, config in harm_config.items()
+        }
+
+    @staticmethod
+    def load_agent_backends(config_path: Union[str, Path]) -> Dict[str, Dict[str, Any]]:
+        """
+        Backend options of every agent entry of the harm assignments YAML.
+
+        An entry may set `backend` ('hf' by default, 'openai' or 'fake') plus the
+        options of that backend, e.g. `base_url`, `api_key_env` and `max_connections`
+        for an OpenAI-compatible server.
+
+        Returns:
+            Dictionary of agent name -> keyword arguments of `backends.create_backend`
+        """
+        harm_config, _ = IOHandler._load_harm_config(config_path)
+        return {
+            agent: {key: value for key, value in config.items() if key not in ('harm_types', 'model')}
+            for agent, config in harm_config.items()
+        }
+
     @staticmethod
     def load_outputs(input_file: Union[str, Path]) -> List[DebiasedOutput]:
         """Load outputs from a file"""
@@ -208,6 +342,94 @@ class IOHandler:
         elif input_path.suffix == '.pkl':
             with open(input_path, 'rb') as f:
                 return pickle.load(f)
+
+        elif input_path.suffix == '.jsonl':
+            with open(input_path, 'r', encoding='utf-8') as f:
+                return [DebiasedOutput(**json.loads(line)) for line in f if line.strip()]
+
+        elif input_path.suffix == '.csv':
+            with open(input_path, 'r', newline='', encoding='utf-8') as f:
+                outputs = []
+                for row in csv.DictReader(f):
+                    # List and dict columns were serialized as JSON strings
+                    for column in ('lineage', 'feedback', 'metadata'):
+                        row[column] = json.loads(row[column]) if row.get(column) else None
+                    outputs.append(DebiasedOutput(**row))
+                return outputs
             
         else:
-            raise ValueError(f"Unsupported input format: {input_path.suffix}")
\ No newline at end of file
+            raise ValueError(f"Unsupported input format: {input_path.suffix}")
+
+
+class JsonlOutputWriter:
+    """
+    Append-only `.jsonl` writer: each DebiasedOutput becomes one line and is
+    flushed as soon as it is written, so completed results survive a crash and
+    nothing accumulates in memory.
+    """
+
+    def __init__(
+        self,
+        output_file: Union[str, Path],
+        include_metadata: bool = True,
+        append: bool = True,
+        fsync: bool = False
+    ):
+        self.output_path = Path(output_file)
+        self.include_metadata = include_metadata
+        self.fsync = fsync
+        self.count = 0
+        if append and self.output_path.exists():
+            with open(self.output_path, 'r', encoding='utf-8') as f:
+                self.count = sum(1 for _ in f)
+        self._file: IO[str] = open(self.output_path, 'a' if append else 'w', encoding='utf-8')
+
+    def write(self, output: DebiasedOutput) -> None:
+        output_dict = asdict(output)
+        if not self.include_metadata:
+            output_dict.pop('metadata', None)
+        self._file.write(json.dumps(output_dict) + "\n")
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+        self.count += 1
+
+    def truncate(self, total: int) -> None:
+        """Drop the most recent lines so that exactly `total` outputs remain"""
+        if self.count <= total:
+            return
+        self._file.close()
+        with open(self.output_path, 'r+b') as f:
+            for _ in range(total):
+                f.readline()
+            f.truncate(f.tell())
+        self.count = total
+        self._file = open(self.output_path, 'a', encoding='utf-8')
+
+    def reorder(self, order: List[int]) -> None:
+        """
+        Rewrite the file with its lines in `order` (positions of the current lines).
+
+        Only the line offsets are held in memory; each line is read back with a seek.
+        """
+        self.close()
+        with open(self.output_path, 'rb') as f:
+            offsets = [f.tell()]
+            for _ in iter(f.readline, b''):
+                offsets.append(f.tell())
+        tmp_path = self.output_path.with_name(self.output_path.name + ".tmp")
+        with open(self.output_path, 'rb') as f, open(tmp_path, 'wb') as out:
+            for position in order:
+                f.seek(offsets[position])
+                out.write(f.readline())
+        os.replace(tmp_path, self.output_path)
+
+    def close(self) -> None:
+        if not self._file.closed:
+            self._file.close()
+
+    def __enter__(self) -> "JsonlOutputWriter":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
\ No newline at end of file
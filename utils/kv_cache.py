@@ -0,0 +1,92 @@
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Tuple
+import copy
+import threading
+
+
+def cache_nbytes(past_key_values: Any) -> int:
+    """Approximate memory held by a transformers KV cache object"""
+    tensors = []
+    if hasattr(past_key_values, "layers"):
+        # transformers >= 4.54 stores one object per layer
+        for layer in past_key_values.layers:
+            tensors.extend([getattr(layer, "keys", None), getattr(layer, "values", None)])
+    else:
+        tensors.extend(getattr(past_key_values, "key_cache", []))
+        tensors.extend(getattr(past_key_values, "value_cache", []))
+    return sum(t.numel() * t.element_size() for t in tensors if t is not None)
+
+
+class PrefixCache:
+    """
+    LRU store of precomputed past_key_values for static prompt prefixes.
+
+    Entries are keyed by the rendered prefix (e.g. an agent's system block) and hold
+    the prefix token ids alongside their KV cache. The total size is bounded by
+    `max_bytes`; the least recently used prefixes are evicted first.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: "OrderedDict[Hashable, Tuple[Any, Any, int]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Tuple[Any, Any]]:
+        """
+        Return a private copy of the cached (prefix_ids, past_key_values) for `key`.
+
+        The KV cache is deep-copied because `generate` extends it in place.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            prefix_ids, past_key_values, _ = entry
+        return prefix_ids, copy.deepcopy(past_key_values)
+
+    def put(self, key: Hashable, prefix_ids: Any, past_key_values: Any) -> bool:
+        """
+        Store a prefix, evicting least recently used entries to stay within `max_bytes`.
+
+        The cache takes `past_key_values` as is, without a copy: once this returns
+        True the caller must not extend it (use a copy, as `get` hands out).
+
+        Returns:
+            Whether the prefix was stored (False if it alone exceeds `max_bytes`)
+        """
+        nbytes = cache_nbytes(past_key_values)
+        if nbytes > self.max_bytes:
+            return False
+
+        with self._lock:
+            if key in self._entries:
+                self.current_bytes -= self._entries.pop(key)[2]
+            while self._entries and self.current_bytes + nbytes > self.max_bytes:
+                _, (_, _, evicted_bytes) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_bytes
+                self.evictions += 1
+            self._entries[key] = (prefix_ids, past_key_values, nbytes)
+            self.current_bytes += nbytes
+        return True
+
+    def clear(self) -> None:
+        """Drop every cached prefix (e.g. once their model is unloaded)"""
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self._entries),
+            "bytes": self.current_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
@@ -0,0 +1,155 @@
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+import threading
+import time
+
+# Counters kept per agent for every query
+PROFILE_COUNTERS = (
+    "generations", "retries", "cache_hits", "prompt_tokens", "generated_tokens",
+    "prefill_seconds", "decode_seconds", "validate_seconds",
+)
+
+
+@dataclass
+class GenerationStats:
+    """
+    Measurements of one `generate_batch` call, filled in by the backend.
+
+    Token counts are per row; times cover the whole call. Backends that cannot tell
+    prefill from decode (HTTP servers) report the whole call as decode time.
+    """
+    prompt_tokens: List[int]
+    generated_tokens: List[int]
+    cached: List[bool]
+    prefill_seconds: float = 0.0
+    decode_seconds: float = 0.0
+
+    @classmethod
+    def for_rows(cls, num_rows: int) -> "GenerationStats":
+        return cls([0] * num_rows, [0] * num_rows, [False] * num_rows)
+
+    def scatter(self, rows: List[int], other: "GenerationStats") -> None:
+        """Copy the rows of `other`, a call over `rows` of this batch, and add its times"""
+        for i, row in enumerate(rows):
+            self.prompt_tokens[row] = other.prompt_tokens[i]
+            self.generated_tokens[row] = other.generated_tokens[i]
+            self.cached[row] = other.cached[i]
+        self.prefill_seconds += other.prefill_seconds
+        self.decode_seconds += other.decode_seconds
+
+
+class FirstStepTimer:
+    """
+    Stopping criterion (transformers `StoppingCriteria` protocol) that never stops
+    generation and records when the first token is out, i.e. the end of prefill.
+    """
+
+    def __init__(self):
+        self.first_step: Optional[float] = None
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if self.first_step is None:
+            # Reading a value waits for the queued device work of the prefill step
+            int(input_ids[0, -1])
+            self.first_step = time.perf_counter()
+        return input_ids.new_zeros(input_ids.shape[0]) > 0
+
+
+class QueryProfile:
+    """
+    Per-agent counters and round timings of one query.
+
+    The time of a batched generation call is split evenly across the rows it
+    generated, so each query is charged its share.
+    """
+
+    def __init__(self):
+        self.agents: Dict[str, Dict[str, float]] = {}
+        self.round_seconds: List[float] = []
+        self._lock = threading.Lock()
+
+    def add(self, agent: str, **values: float) -> None:
+        with self._lock:
+            counters = self.agents.setdefault(agent, dict.fromkeys(PROFILE_COUNTERS, 0))
+            for name, value in values.items():
+                counters[name] += value
+
+    def add_round(self, seconds: float) -> None:
+        with self._lock:
+            self.round_seconds.append(seconds)
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            totals = dict.fromkeys(PROFILE_COUNTERS, 0)
+            for counters in self.agents.values():
+                for name, value in counters.items():
+                    totals[name] += value
+            return {
+                "rounds": len(self.round_seconds),
+                "round_seconds": [round(seconds, 6) for seconds in self.round_seconds],
+                **{name: _rounded(value) for name, value in totals.items()},
+                "agents": {
+                    agent: {name: _rounded(value) for name, value in counters.items()}
+                    for agent, counters in self.agents.items()
+                },
+            }
+
+
+class RunProfile:
+    """Aggregate of the query profiles of a run, summarized per agent"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.rounds = 0
+        self.round_seconds = 0.0
+        self.agents: Dict[str, Dict[str, float]] = {}
+
+    def add(self, profile: Optional[Dict[str, Any]]) -> None:
+        if not profile:
+            return
+        self.queries += 1
+        self.rounds += profile["rounds"]
+        self.round_seconds += sum(profile["round_seconds"])
+        for agent, counters in profile["agents"].items():
+            totals = self.agents.setdefault(agent, dict.fromkeys(PROFILE_COUNTERS, 0))
+            for name, value in counters.items():
+                totals[name] += value
+
+    def summary(self) -> Dict[str, Any]:
+        """
+        Run totals, per-agent totals and each agent's share of the generation time;
+        the agent with the largest share is reported as the bottleneck.
+        """
+        generation_seconds = {
+            agent: counters["prefill_seconds"] + counters["decode_seconds"]
+            for agent, counters in self.agents.items()
+        }
+        total_generation = sum(generation_seconds.values())
+        agents = {}
+        for agent, counters in self.agents.items():
+            first_attempts = counters["generations"] - counters["retries"]
+            agents[agent] = {
+                **{name: _rounded(value) for name, value in counters.items()},
+                "generation_share": _rounded(generation_seconds[agent] / total_generation) if total_generation else 0.0,
+                "decode_tokens_per_sec": _rounded(counters["generated_tokens"] / counters["decode_seconds"])
+                if counters["decode_seconds"] else None,
+                "retry_rate": _rounded(counters["retries"] / first_attempts) if first_attempts > 0 else 0.0,
+            }
+        totals = {
+            name: _rounded(sum(counters[name] for counters in self.agents.values()))
+            for name in PROFILE_COUNTERS
+        }
+        return {
+            "queries": self.queries,
+            "wall_seconds": _rounded(time.perf_counter() - self.started),
+            "rounds_per_query": _rounded(self.rounds / self.queries) if self.queries else 0.0,
+            "mean_round_seconds": _rounded(self.round_seconds / self.rounds) if self.rounds else 0.0,
+            **totals,
+            "bottleneck": max(generation_seconds, key=generation_seconds.get) if total_generation else None,
+            "agents": agents,
+        }
+
+
+def _rounded(value: float) -> float:
+    return round(value, 6) if isinstance(value, float) else value
@@ -0,0 +1,177 @@
+from dataclasses import dataclass
+from typing import Dict, Hashable, List, Optional, Tuple
+
+# Stand-in message contents used to locate the variable parts of a rendered chat template
+_SLOT = "<<<slot{}>>>"
+_PADDED_SLOT = "\n " + _SLOT + " \n"
+
+
+@dataclass
+class EncodedPrompt:
+    """Token ids of a rendered chat, plus its system block when that is a token prefix"""
+    token_ids: List[int]
+    prefix: Optional[str] = None  # Rendered system block (PrefixCache key)
+    prefix_length: int = 0        # Tokens of `prefix` at the start of `token_ids`
+
+
+@dataclass
+class _CompiledTemplate:
+    segments: List[List[int]]  # Static token ids around each variable message content
+    strip: bool                # Whether the chat template trims message contents
+    prefix: Optional[str]
+    prefix_length: int
+
+
+class PromptTemplateCache:
+    """
+    Encodes chats into token ids, optionally from chat templates precompiled per
+    prompt shape.
+
+    By default every chat is rendered and tokenized in full, which is exact; the
+    system block is reported as a token prefix (for PrefixCache) when the chat's
+    ids start with the ids of the system block tokenized on its own.
+
+    With `splice`, a shape is an agent's system message plus the roles of the
+    messages after it. The first time a shape is seen, the chat template is
+    rendered with placeholder contents and the static text between them (the system
+    block, role markers and generation prompt) is tokenized once; later calls only
+    tokenize the variable message contents and splice them in. Segments are
+    tokenized independently, so no token merges across a message edge: ids can
+    differ from full tokenization where a pre-tokenizer would merge across it (e.g.
+    contents starting with newlines under Qwen's `\s*[\r\n]+`). Shapes whose
+    template transforms contents beyond trimming whitespace fall back to rendering
+    and tokenizing the full chat.
+
+    Not thread-safe: LLMModel runs its calls one at a time.
+    """
+
+    def __init__(self, tokenizer, splice: bool = False):
+        self.tokenizer = tokenizer
+        self.splice = splice
+        self._templates: Dict[Hashable, Optional[_CompiledTemplate]] = {}
+        # Rendered system block and its token ids, per system message content
+        self._prefixes: Dict[str, Optional[Tuple[str, List[int]]]] = {}
+        self.compiled = 0
+        self.hits = 0
+        self.fallbacks = 0
+
+    def _tokenize(self, texts: List[str]) -> List[List[int]]:
+        return self.tokenizer(texts, add_special_tokens=False)["input_ids"] if texts else []
+
+    def _render(self, messages: List[Dict[str, str]], add_generation_prompt: bool = True) -> str:
+        return self.tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=add_generation_prompt)
+
+    @staticmethod
+    def _split(text: str, slots: List[str]) -> Optional[List[str]]:
+        """Static pieces of `text` around `slots` (in order), or None if one is missing"""
+        pieces, position = [], 0
+        for slot in slots:
+            index = text.find(slot, position)
+            if index < 0:
+                return None
+            pieces.append(text[position:index])
+            position = index + len(slot)
+        pieces.append(text[position:])
+        return pieces
+
+    def _compile(self, system: Optional[Dict[str, str]], roles: Tuple[str, ...]) -> Optional[_CompiledTemplate]:
+        head = [system] if system is not None else []
+        padded = [_PADDED_SLOT.format(i) for i in range(len(roles))]
+        bare = [_SLOT.format(i) for i in range(len(roles))]
+        try:
+            padded_text = self._render(head + [{"role": r, "content": c} for r, c in zip(roles, padded)])
+            pieces, strip = self._split(padded_text, padded), False
+            if pieces is None:
+                # Accept templates that trim contents (e.g. Llama 3): the padded
+                # placeholders must render exactly like already trimmed ones
+                bare_text = self._render(head + [{"role": r, "content": c} for r, c in zip(roles, bare)])
+                if bare_text != padded_text:
+                    return None
+                pieces, strip = self._split(bare_text, bare), True
+            if pieces is None:
+                return None
+
+            prefix = self._render(head, add_generation_prompt=False) if system is not None else None
+        except Exception:
+            return None
+
+        if prefix and pieces[0].startswith(prefix):
+            # Tokenized on its own so every prompt of this agent shares the same prefix ids
+            prefix_ids, rest_ids = self._tokenize([prefix, pieces[0][len(prefix):]])
+            segments = [prefix_ids + rest_ids] + self._tokenize(pieces[1:])
+            prefix_length = len(prefix_ids)
+        else:
+            segments = self._tokenize(pieces)
+            prefix, prefix_length = None, 0
+        return _CompiledTemplate(segments, strip, prefix, prefix_length)
+
+    def _template(self, messages: List[Dict[str, str]]) -> Tuple[Optional[_CompiledTemplate], List[str]]:
+        """Compiled template of a chat's shape and the chat's variable contents"""
+        system = messages[0] if messages and messages[0]["role"] == "system" else None
+        variable = messages[1:] if system is not None else messages
+        key = (system["content"] if system is not None else None, tuple(m["role"] for m in variable))
+        if key not in self._templates:
+            self._templates[key] = self._compile(system, key[1])
+            self.compiled += 1
+        return self._templates[key], [m["content"] for m in variable]
+
+    def _system_prefix(self, system: Dict[str, str]) -> Optional[Tuple[str, List[int]]]:
+        content = system["content"]
+        if content not in self._prefixes:
+            try:
+                prefix = self._render([system], add_generation_prompt=False)
+                self._prefixes[content] = (prefix, self._tokenize([prefix])[0])
+            except Exception:
+                self._prefixes[content] = None
+        return self._prefixes[content]
+
+    def _encode_full(self, batch_messages: List[List[Dict[str, str]]]) -> List[EncodedPrompt]:
+        """Render and tokenize every chat in full, locating the system block in the ids"""
+        encoded = []
+        token_ids = self._tokenize([self._render(messages) for messages in batch_messages])
+        for messages, ids in zip(batch_messages, token_ids):
+            self.fallbacks += 1
+            system = self._system_prefix(messages[0]) if messages and messages[0]["role"] == "system" else None
+            if system is not None and system[1] and ids[:len(system[1])] == system[1]:
+                encoded.append(EncodedPrompt(ids, system[0], len(system[1])))
+            else:
+                encoded.append(EncodedPrompt(ids))
+        return encoded
+
+    def encode(self, batch_messages: List[List[Dict[str, str]]]) -> List[EncodedPrompt]:
+        """Token ids of each chat with the generation prompt appended"""
+        if not self.splice:
+            return self._encode_full(batch_messages)
+
+        templates, contents = [], []
+        for messages in batch_messages:
+            template, variable = self._template(messages)
+            templates.append(template)
+            if template is not None:
+                contents.extend(text.strip() if template.strip else text for text in variable)
+
+        # One tokenizer call for every variable content of the batch
+        content_ids = iter(self._tokenize(contents))
+        fallback_rows = [row for row, template in enumerate(templates) if template is None]
+        fallback_ids = dict(zip(
+            fallback_rows,
+            self._tokenize([self._render(batch_messages[row]) for row in fallback_rows])
+        ))
+
+        encoded = []
+        for row, template in enumerate(templates):
+            if template is None:
+                self.fallbacks += 1
+                encoded.append(EncodedPrompt(fallback_ids[row]))
+                continue
+            self.hits += 1
+            token_ids = list(template.segments[0])
+            for segment in template.segments[1:]:
+                token_ids.extend(next(content_ids))
+                token_ids.extend(segment)
+            encoded.append(EncodedPrompt(token_ids, template.prefix, template.prefix_length))
+        return encoded
+
+    def stats(self) -> Dict[str, int]:
+        """Shapes compiled, chats spliced from them, and chats tokenized in full"""
+        return {"splice": self.splice, "templates": self.compiled, "hits": self.hits, "fallbacks": self.fallbacks}
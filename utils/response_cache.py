@@ -0,0 +1,126 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Union
+
+
+def make_cache_key(model_name: str, messages: List[Dict[str, str]], **generation_params: Any) -> str:
+    """Content hash of a rendered chat and the parameters that determine its generation"""
+    payload = json.dumps(
+        {"model": model_name, "messages": messages, "params": generation_params},
+        sort_keys=True,
+        ensure_ascii=False
+    )
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """
+    Persistent SQLite store of raw model generations keyed by `make_cache_key`.
+
+    The total size of cached responses is bounded by `max_bytes`; when it is
+    exceeded the least recently used entries are evicted. Safe to share between
+    models and threads.
+
+    Hits only touch the database to read: their access times are kept in memory
+    and written in one batch on the next `put`, every `flush_every` hits, and on `close`.
+    """
+
+    def __init__(self, path: Union[str, Path], max_bytes: int = 1024 * 1024 * 1024, flush_every: int = 1024):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.flush_every = flush_every
+        # Access times of hits not yet written to `last_access`
+        self._pending_access: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, response TEXT NOT NULL, "
+            "size INTEGER NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses(last_access)")
+        self._conn.commit()
+        self.current_bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._pending_access[key] = time.time()
+            if len(self._pending_access) >= self.flush_every:
+                self._flush_access()
+                self._conn.commit()
+            self.hits += 1
+            return row[0]
+
+    def _flush_access(self) -> None:
+        """Write the pending access times (the caller commits)"""
+        if self._pending_access:
+            self._conn.executemany(
+                "UPDATE responses SET last_access = ? WHERE key = ?",
+                [(timestamp, key) for key, timestamp in self._pending_access.items()]
+            )
+            self._pending_access.clear()
+
+    def put(self, key: str, response: str) -> None:
+        size = len(response.encode('utf-8'))
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            # Eviction below must see the recent hits as recently used
+            self._flush_access()
+            previous = self._conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            if previous is not None:
+                self.current_bytes -= previous[0]
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, response, size, last_access) VALUES (?, ?, ?, ?)",
+                (key, response, size, time.time())
+            )
+            self.current_bytes += size
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self) -> None:
+        """Delete least recently used entries until the cache fits in `max_bytes`"""
+        while self.current_bytes > self.max_bytes:
+            rows = self._conn.execute(
+                "SELECT key, size FROM responses ORDER BY last_access LIMIT 64"
+            ).fetchall()
+            if not rows:
+                self.current_bytes = 0
+                return
+            for key, size in rows:
+                if self.current_bytes <= self.max_bytes:
+                    break
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.current_bytes -= size
+                self.evictions += 1
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "bytes": self.current_bytes,
+        }
+
+    def close(self) -> None:
+        with self._lock:
+            self._flush_access()
+            self._conn.commit()
+            self._conn.close()
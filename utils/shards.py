@@ -0,0 +1,257 @@
+import csv
+import json
+import os
+import pickle
+import shutil
+import textwrap
+from pathlib import Path
+from bisect import bisect_right
+from collections import OrderedDict
+from typing import Any, Dict, Iterator, List, Optional, Union
+
+from utils.io_utils import IOHandler, DebiasedOutput, JsonlOutputWriter
+
+MANIFEST_NAME = "manifest.json"
+PENDING_PATTERN = "pending-*.jsonl"
+# Shards kept loaded while merging in a given order
+MERGE_CACHED_SHARDS = 4
+CSV_COLUMNS = ['original_query', 'debiased_response', 'lineage', 'feedback', 'metadata']
+
+
+def shard_dir_for(output_file: Union[str, Path]) -> Path:
+    """Directory holding the shards and manifest of an output file"""
+    output_path = Path(output_file)
+    return output_path.with_name(output_path.stem + ".shards")
+
+
+class ShardedOutputWriter:
+    """
+    Writes outputs as numbered shards in the final output format, indexed by a
+    manifest that is rewritten atomically after every shard.
+
+    Only the current shard is held in memory. Its outputs are also appended to
+    a `pending-<shard>.jsonl` staging file as they arrive, so a crashed run can be
+    reopened with `resume=True` without losing the partial shard. `merge` then
+    builds the final artifact by streaming the shards one at a time; a run can
+    also stop at the sharded layout and be read back with `iter_sharded_outputs`.
+    """
+
+    def __init__(
+        self,
+        output_file: Union[str, Path],
+        shard_size: int = 100,
+        include_metadata: bool = True,
+        resume: bool = False,
+        fsync: bool = False
+    ):
+        self.output_path = Path(output_file)
+        self.format = self.output_path.suffix
+        if self.format not in ('.json', '.jsonl', '.csv', '.pkl'):
+            raise ValueError(f"Unsupported output format: {self.format}")
+
+        self.shard_size = shard_size
+        self.fsync = fsync
+        self.include_metadata = include_metadata
+        self.shard_dir = shard_dir_for(self.output_path)
+        self.manifest: Dict[str, Any] = {
+            "output_file": str(self.output_path),
+            "format": self.format,
+            "total": 0,
+            "shards": [],
+        }
+        self._buffer: List[DebiasedOutput] = []
+
+        if resume and self.manifest_path.exists():
+            with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                self.manifest = json.load(f)
+        elif not resume and self.shard_dir.exists():
+            # A fresh run must not pick up shards left by a previous one
+            shutil.rmtree(self.shard_dir)
+        self.shard_dir.mkdir(parents=True, exist_ok=True)
+
+        # Staging files of shards that were already written are stale
+        for path in self.shard_dir.glob(PENDING_PATTERN):
+            if path != self.pending_path:
+                os.remove(path)
+        if resume and self.pending_path.exists():
+            self._buffer = IOHandler.load_outputs(self.pending_path)
+        self._pending = JsonlOutputWriter(self.pending_path, append=True, fsync=self.fsync)
+
+    @property
+    def manifest_path(self) -> Path:
+        return self.shard_dir / MANIFEST_NAME
+
+    @property
+    def pending_path(self) -> Path:
+        """Staging file of the shard currently being filled"""
+        return self.shard_dir / f"pending-{len(self.manifest['shards']) + 1:05d}.jsonl"
+
+    @property
+    def count(self) -> int:
+        """Number of outputs persisted so far (sharded or pending)"""
+        return self.manifest["total"] + len(self._buffer)
+
+    def write(self, output: DebiasedOutput) -> None:
+        self._pending.write(output)
+        self._buffer.append(output)
+        if len(self._buffer) >= self.shard_size:
+            self.flush()
+
+    def flush(self) -> None:
+        """Persist the buffered outputs as the next shard"""
+        if not self._buffer:
+            return
+
+        shard_name = f"part-{len(self.manifest['shards']) + 1:05d}{self.format}"
+        IOHandler.save_outputs(self._buffer, self.shard_dir / shard_name, self.include_metadata)
+
+        shard = {"file": shard_name, "count": len(self._buffer)}
+        if self.format == '.csv':
+            shard["fieldnames"] = IOHandler.csv_fieldnames(self._buffer, self.include_metadata)
+        self.manifest["shards"].append(shard)
+        self.manifest["total"] += len(self._buffer)
+        self._write_manifest()
+        self._buffer = []
+        self._reset_pending()
+
+    def close(self) -> None:
+        self.flush()
+        self._pending.close()
+
+    def _reset_pending(self, outputs: List[DebiasedOutput] = ()) -> None:
+        """Start the staging file of the current shard, dropping the previous one"""
+        self._pending.close()
+        if self._pending.output_path != self.pending_path:
+            os.remove(self._pending.output_path)
+        self._pending = JsonlOutputWriter(self.pending_path, append=False, fsync=self.fsync)
+        for output in outputs:
+            self._pending.write(output)
+
+    def truncate(self, total: int) -> None:
+        """Drop the most recent outputs so that exactly `total` remain persisted"""
+        while self.count > total:
+            if self._buffer:
+                drop = min(len(self._buffer), self.count - total)
+                self._buffer = self._buffer[:len(self._buffer) - drop]
+                self._reset_pending(self._buffer)
+                continue
+
+            shard_path = self.shard_dir / self.manifest["shards"][-1]["file"]
+            outputs = IOHandler.load_outputs(shard_path)
+            keep = max(0, len(outputs) - (self.count - total))
+            self.manifest["total"] -= len(outputs)
+            self.manifest["shards"].pop()
+            # Re-stage the surviving outputs; they become part of the next shard
+            self._buffer = outputs[:keep]
+            self._reset_pending(self._buffer)
+            self._write_manifest()
+            os.remove(shard_path)
+
+    def _write_manifest(self) -> None:
+        tmp_path = self.manifest_path.with_suffix(".tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(tmp_path, self.manifest_path)
+
+    def _load_shard_items(self, path: Path) -> List[Any]:
+        """Raw items of one shard: lines, JSON objects, csv rows or unpickled outputs"""
+        if self.format == '.jsonl':
+            with open(path, 'rb') as f:
+                return f.readlines()
+        if self.format == '.json':
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        if self.format == '.csv':
+            with open(path, 'r', newline='', encoding='utf-8') as f:
+                return list(csv.DictReader(f))
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+    def _iter_items(self, shard_paths: List[Path], order: Optional[List[int]] = None) -> Iterator[Any]:
+        """
+        Raw items of the shards, in shard order or in `order` (positions across all
+        shards). Reordering keeps the last few shards read loaded, which suits
+        outputs that are in order apart from a few written late.
+        """
+        if order is None:
+            for path in shard_paths:
+                yield from self._load_shard_items(path)
+            return
+
+        starts = [0]
+        for shard in self.manifest["shards"]:
+            starts.append(starts[-1] + shard["count"])
+        loaded: "OrderedDict[int, List[Any]]" = OrderedDict()
+        for position in order:
+            shard = bisect_right(starts, position) - 1
+            if shard in loaded:
+                loaded.move_to_end(shard)
+            else:
+                if len(loaded) >= MERGE_CACHED_SHARDS:
+                    loaded.popitem(last=False)
+                loaded[shard] = self._load_shard_items(shard_paths[shard])
+            yield loaded[shard][position - starts[shard]]
+
+    def merge(self, keep_shards: bool = False, order: Optional[List[int]] = None) -> Path:
+        """
+        Concatenate the shards into the final output file, optionally with the
+        outputs rearranged in `order` (positions in write order, e.g. from
+        `ProgressJournal.output_order`).
+
+        json, jsonl and csv are streamed shard by shard. A pickle holds a single
+        list, so the merged list is built in memory once (without the per-batch copies).
+        """
+        self.close()
+        if self.pending_path.exists():
+            os.remove(self.pending_path)
+        shard_paths = [self.shard_dir / shard["file"] for shard in self.manifest["shards"]]
+        tmp_path = self.output_path.with_name(self.output_path.name + ".tmp")
+
+        if self.format == '.jsonl':
+            with open(tmp_path, 'wb') as out:
+                if order is None:
+                    for path in shard_paths:
+                        with open(path, 'rb') as f:
+                            shutil.copyfileobj(f, out)
+                else:
+                    out.writelines(self._iter_items(shard_paths, order))
+
+        elif self.format == '.json':
+            # Same layout as json.dump(outputs, indent=2)
+            with open(tmp_path, 'w', encoding='utf-8') as out:
+                first = True
+                out.write("[")
+                for item in self._iter_items(shard_paths, order):
+                    out.write("\n" if first else ",\n")
+                    out.write(textwrap.indent(json.dumps(item, indent=2), "  "))
+                    first = False
+                out.write("]" if first else "\n]")
+
+        elif self.format == '.csv':
+            used = set()
+            for shard in self.manifest["shards"]:
+                used.update(shard["fieldnames"])
+            fieldnames = [column for column in CSV_COLUMNS if column in used]
+            with open(tmp_path, 'w', newline='', encoding='utf-8') as out:
+                writer = csv.DictWriter(out, fieldnames=fieldnames, restval='')
+                writer.writeheader()
+                writer.writerows(self._iter_items(shard_paths, order))
+
+        elif self.format == '.pkl':
+            outputs = list(self._iter_items(shard_paths, order))
+            with open(tmp_path, 'wb') as out:
+                pickle.dump(outputs, out)
+
+        os.replace(tmp_path, self.output_path)
+        if not keep_shards:
+            shutil.rmtree(self.shard_dir)
+        return self.output_path
+
+
+def iter_sharded_outputs(shard_dir: Union[str, Path]) -> Iterator[DebiasedOutput]:
+    """Yield the outputs of a sharded run in order, loading one shard at a time"""
+    shard_dir = Path(shard_dir)
+    with open(shard_dir / MANIFEST_NAME, 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    for shard in manifest["shards"]:
+        yield from IOHandler.load_outputs(shard_dir / shard["file"])